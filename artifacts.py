@@ -0,0 +1,184 @@
+# Description:  Content-addressed local cache of the dashboard's downloaded inputs
+
+
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+class ArtifactStore:
+    """
+    Keeps downloaded files under their SHA-256 in `cache_dir/objects`, with an index of
+    the ETag and Last-Modified of every source URL so that copies on disk are revalidated
+    with a conditional request instead of being downloaded again.
+
+    The source is either a base URL (GitHub or a local HTTP server standing in for it)
+    or a local folder. In offline mode no request is made: files come from the local
+    folder or from the copies already in the cache.
+    """
+
+    def __init__(self, cache_dir, source, offline=False, max_age=3600, timeout=30):
+        """
+        Parameters:
+            cache_dir (str): Folder of the cache.
+            source (str): Base URL or local folder the artifacts are fetched from.
+            offline (bool): Never make a network request.
+            max_age (int): Seconds during which a validated copy is used without revalidating.
+            timeout (int): Seconds before a request is abandoned.
+        """
+        self.cache_dir = cache_dir
+        self.source = source
+        self.offline = offline
+        self.max_age = max_age
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cache_dir, 'objects'), exist_ok=True)
+        self._index_path = os.path.join(cache_dir, 'index.json')
+        self._index = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as file:
+                self._index = json.load(file)
+
+    def _is_url(self):
+        return self.source.startswith(('http://', 'https://'))
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest)
+
+    def _store(self, content):
+        """Writes content under its hash and returns the hash."""
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            temp_path = '%s.%d.tmp' % (path, threading.get_ident())
+            with open(temp_path, 'wb') as file:
+                file.write(content)
+            os.replace(temp_path, path)
+        return digest
+
+    def _record(self, name, entry):
+        with self._lock:
+            self._index[name] = entry
+            temp_path = self._index_path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(self._index, file, indent=1)
+            os.replace(temp_path, self._index_path)
+
+    def _cached(self, name):
+        """Index entry of an artifact whose object is on disk, or None."""
+        with self._lock:
+            entry = self._index.get(name)
+        if entry and entry.get('source') == self.source and os.path.exists(self._object_path(entry['sha256'])):
+            return entry
+        return None
+
+    def fetch(self, name):
+        """
+        Path of an up-to-date local copy of the artifact `name`.
+
+        Parameters:
+            name (str): File name relative to the source, e.g. 'taxi_zones.shp'.
+
+        Returns:
+            str: Path of the cached object.
+        """
+        entry = self._cached(name)
+
+        if not self._is_url():
+            # A local folder: re-hash only when the file changed since it was stored
+            stat = os.stat(os.path.join(self.source, name))
+            if entry is None or entry.get('size') != stat.st_size or entry.get('mtime_ns') != stat.st_mtime_ns:
+                with open(os.path.join(self.source, name), 'rb') as file:
+                    digest = self._store(file.read())
+                entry = {'source': self.source, 'sha256': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+                self._record(name, entry)
+            return self._object_path(entry['sha256'])
+
+        if entry is not None and (self.offline or time.time() - entry.get('validated', 0) < self.max_age):
+            return self._object_path(entry['sha256'])
+        if self.offline:
+            raise FileNotFoundError('%s is not in the artifact cache and the store is offline' % name)
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            response = requests.get(self.source.rstrip('/') + '/' + name, headers=headers, timeout=self.timeout)
+        except requests.RequestException:
+            if entry is not None:
+                # Keep serving the last good copy when the source cannot be reached
+                return self._object_path(entry['sha256'])
+            raise
+
+        if response.status_code == 304 and entry is not None:
+            entry = dict(entry, validated=time.time())
+        elif response.status_code == 200:
+            entry = {
+                'source': self.source,
+                'sha256': self._store(response.content),
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'validated': time.time()
+            }
+        elif entry is None:
+            response.raise_for_status()
+            raise FileNotFoundError('Failed to download %s (HTTP %d)' % (name, response.status_code))
+        self._record(name, entry)
+        return self._object_path(entry['sha256'])
+
+    def fetch_all(self, names, max_workers=8):
+        """
+        Fetches several artifacts concurrently.
+
+        Parameters:
+            names (list): File names relative to the source.
+            max_workers (int): Number of parallel downloads.
+
+        Returns:
+            dict: Path of the cached object of every name.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(names, executor.map(self.fetch, names)))
+
+    def materialize(self, names, target_dir, max_workers=8):
+        """
+        Fetches artifacts and places them under their own names in `target_dir`, for
+        readers that need sibling files such as the parts of a shapefile. Files already
+        holding the right object are left untouched.
+
+        Parameters:
+            names (list): File names relative to the source.
+            target_dir (str): Folder the files are placed in.
+            max_workers (int): Number of parallel downloads.
+
+        Returns:
+            dict: Path of every file in `target_dir`.
+        """
+        os.makedirs(target_dir, exist_ok=True)
+        paths = {}
+        for name, object_path in self.fetch_all(names, max_workers).items():
+            target = os.path.join(target_dir, name)
+            paths[name] = target
+            if os.path.exists(target) and os.path.samefile(target, object_path):
+                continue
+            temp_path = target + '.tmp'
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            try:
+                # A hard link keeps the object's modification time, so file fingerprints stay stable
+                os.link(object_path, temp_path)
+            except OSError:
+                shutil.copy2(object_path, temp_path)
+            os.replace(temp_path, target)
+        return paths
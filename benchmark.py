@@ -0,0 +1,227 @@
+# Description:  Times the data.py stages and the dashboards' filter_and_aggregate queries on synthetic trips
+
+
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import time
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+import data
+from od_cubes import build_od_cubes, filter_and_aggregate, load_zone_dimension, od_columns, sketch_columns
+from storage import formats, read_table, write_table
+from synthetic import write_trips, zones_path
+from zone_store import ZoneMetricStore, directions
+
+results_file = 'benchmark_results.json'
+
+# Queries timed per filter_and_aggregate variant, sampled evenly from every filter combination
+max_queries = 200
+
+# A result slower than the baseline by more than this factor is reported as a regression
+tolerance = 1.25
+
+
+def timed(results, name, function, *args, **kwargs):
+    """Runs function(*args, **kwargs), records its wall time in results[name] and returns its result."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    results[name] = {'seconds': round(time.perf_counter() - start, 6)}
+    return result
+
+
+def timed_queries(results, name, query, selections):
+    """Runs query(selection) for every selection and records the latency distribution in milliseconds."""
+    step = max(1, len(selections) // max_queries)
+    latencies = []
+    for selection in selections[::step][:max_queries]:
+        start = time.perf_counter()
+        query(selection)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies = np.array(latencies)
+    results[name] = {
+        'queries': len(latencies),
+        'mean_ms': round(float(latencies.mean()), 4),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 4),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 4)
+    }
+
+
+def bench_pipeline(path, results, format='csv', chunksize=None, workers=None, monthly_path=None):
+    """
+    Times every stage of data.run on path+'trips.csv', then data.run_streaming when
+    `chunksize` is given and data.ingest_files over the files in `monthly_path` when
+    `workers` is given. Outputs are written under `path`.
+    """
+    raw = timed(results, 'data.read_csv', pd.read_csv, path + 'trips.csv', dtype=data.read_dtypes)
+    lyft = timed(results, 'data.clean_trips', data.clean_trips, raw)
+    del raw
+    lyft = timed(results, 'data.add_od_means', data.add_od_means, lyft)
+    partials = timed(results, 'data.partial_aggregates', data.partial_aggregates, lyft)
+    stats = timed(results, 'data.pickup_dropoff_stats', data.pickup_dropoff_stats, lyft)
+    lyft = timed(results, 'data.label_od_pairs', data.label_od_pairs, lyft)
+    timed(results, 'data.write_table.lyft_cleaned', write_table, lyft, path, 'lyft_cleaned', format)
+    del lyft
+    timed(results, 'data.write_table.pickup_cleaned', write_table, partials['pickup_cleaned'], path, 'pickup_cleaned', format)
+    timed(results, 'data.write_table.dropoff_cleaned', write_table, partials['dropoff_cleaned'], path, 'dropoff_cleaned', format)
+    timed(results, 'data.write_table.pickup_dropoff_cleaned', write_table, stats, path, 'pickup_dropoff_cleaned', format)
+    timed(results, 'data.write_sketches', data.write_sketches, partials['pickup_dropoff_sketch'], path, format)
+
+    if chunksize:
+        streaming_path = path + 'streaming/'
+        os.makedirs(streaming_path, exist_ok=True)
+        if not os.path.exists(streaming_path + 'trips.csv'):
+            os.link(path + 'trips.csv', streaming_path + 'trips.csv')
+        timed(results, 'data.run_streaming', data.run_streaming, streaming_path, chunksize, format)
+
+    if workers:
+        ingest_path = path + 'ingest/'
+        os.makedirs(ingest_path, exist_ok=True)
+        trip_files = [os.path.join(monthly_path, name) for name in sorted(os.listdir(monthly_path))
+                      if name.startswith('trips_')]
+        timed(results, 'data.ingest_files.workers_%d' % workers, data.ingest_files,
+              ingest_path, trip_files, format, None, workers, True)
+
+
+def _selections(labels):
+    """Every combination of 'All' and the labels of each dimension."""
+    return list(product(*[['All'] + list(dim_labels) for dim_labels in labels]))
+
+
+def bench_queries(path, results):
+    """
+    Times the cube builds and the filter_and_aggregate variants of tlc_pickup.py,
+    tlc_dropoff.py and final_dashboard.py on the tables written by `bench_pipeline`.
+    final_dashboard.py is a Streamlit script, so its cubes and query are called from
+    od_cubes.py, as the app does.
+    """
+    # tlc_pickup.py and tlc_dropoff.py query the shared zone store
+    store = timed(results, 'zone_store.build', ZoneMetricStore, path, zones_path)
+    for direction in directions:
+        timed_queries(results, 'tlc_%s.filter_and_aggregate' % direction,
+                      lambda selection, direction=direction: store.aggregate(direction, *selection),
+                      _selections(store.labels(direction)))
+
+    # final_dashboard: the zone dimension, cubes and query of the app (see od_cubes.py)
+    zones = timed(results, 'final_dashboard.load_zones', load_zone_dimension, zones_path)
+    facts = timed(results, 'final_dashboard.read_table', read_table, path, 'pickup_dropoff_cleaned', columns=od_columns)
+    facts['PULocationID'] = facts['PULocationID'].astype(int)
+    facts['DOLocationID'] = facts['DOLocationID'].astype(int)
+    sketches = timed(results, 'final_dashboard.read_sketches', read_table, path, 'pickup_dropoff_sketch',
+                     columns=sketch_columns)
+    # Without the sketches (the zip file) and with them (a Parquet folder)
+    cubes = timed(results, 'final_dashboard.load_cubes', build_od_cubes, facts, zones)
+    sketch_cubes = timed(results, 'final_dashboard.load_cubes_with_sketches', build_od_cubes, facts, zones, sketches)
+
+    names = zones['zone'].reindex(range(int(facts[['PULocationID', 'DOLocationID']].max().max()) + 1)).fillna('Unknown')
+    busiest_pickup = names[facts.groupby('PULocationID')['trip_count'].sum().idxmax()]
+    busiest_dropoff = names[facts.groupby('DOLocationID')['trip_count'].sum().idxmax()]
+
+    selections = _selections(cubes['by_pickup']['labels'])
+    for name, query_cubes in [('filter_and_aggregate', cubes), ('filter_and_aggregate_quantiles', sketch_cubes)]:
+        for variant, pickup_location, dropoff_location in [
+            ('all_locations', 'All', 'All'),
+            ('pickup_location', busiest_pickup, 'All'),
+            ('dropoff_location', 'All', busiest_dropoff),
+            ('pickup_and_dropoff_location', busiest_pickup, busiest_dropoff)
+        ]:
+            timed_queries(results, 'final_dashboard.%s.%s' % (name, variant),
+                          lambda selection: filter_and_aggregate(query_cubes, zones, *selection, pickup_location,
+                                                                 dropoff_location), selections)
+
+
+def environment():
+    """Versions and machine the results were measured with."""
+    import pyarrow
+    return {
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'pyarrow': pyarrow.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+
+def compare(results, baseline):
+    """
+    Prints every result next to the same result of a previous run.
+
+    Parameters:
+        results (dict): 'results' of the current run.
+        baseline (dict): 'results' of the previous run.
+
+    Returns:
+        list: Names of the results slower than the baseline by more than `tolerance`.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        key = 'seconds' if 'seconds' in result else 'p50_ms'
+        ratio = result[key] / max(baseline[name][key], 1e-9)
+        flag = ''
+        if ratio > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-55s %12.4f %12.4f %7.2fx%s' % (name, baseline[name][key], result[key], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the cleaning pipeline and the dashboard queries.')
+    parser.add_argument('--path', default='benchmark/', help='Working folder for the synthetic trips and outputs.')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Number of synthetic trips (1M to 100M).')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=formats, default='csv', help='Format of the cleaned tables.')
+    parser.add_argument('--chunksize', type=int, default=None, help='Also time data.run_streaming with this chunk size.')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Also time data.ingest_files over monthly files with this many processes.')
+    parser.add_argument('--output', default=results_file, help='JSON file the results are written to.')
+    parser.add_argument('--compare', default=None, help='Results of a previous run to compare with.')
+    args = parser.parse_args()
+
+    path = os.path.join(args.path, '%d_%d' % (args.rows, args.seed), '')
+    # The trips only depend on the row count and the seed, so they are generated once
+    if not os.path.exists(path + 'trips.csv'):
+        write_trips(path, args.rows, args.seed)
+    if args.workers and not os.path.isdir(path + 'monthly'):
+        write_trips(path + 'monthly/', args.rows, args.seed, monthly=True)
+
+    # One output folder per format, since a Parquet table is read instead of a CSV one next to it
+    output_path = path + args.format + '/'
+    os.makedirs(output_path, exist_ok=True)
+    if not os.path.exists(output_path + 'trips.csv'):
+        os.link(path + 'trips.csv', output_path + 'trips.csv')
+
+    results = {}
+    bench_pipeline(output_path, results, args.format, args.chunksize, args.workers, path + 'monthly/')
+    bench_queries(output_path, results)
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'rows': args.rows,
+        'seed': args.seed,
+        'format': args.format,
+        'environment': environment(),
+        'results': results
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=1)
+
+    for name, result in results.items():
+        print('%-55s %s' % (name, result))
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        print()
+        if compare(results, baseline['results']):
+            sys.exit(1)
@@ -0,0 +1,358 @@
+# Description:  Choropleth filtered and recolored in the browser, from trip aggregates and zone geometry sent once
+
+
+
+import base64
+import gzip
+import json
+
+import numpy as np
+import pandas as pd
+from branca.utilities import color_brewer
+
+# JavaScript typed array each NumPy type is decoded into
+array_types = {
+    np.dtype(np.uint8): 'Uint8Array',
+    np.dtype(np.uint16): 'Uint16Array',
+    np.dtype(np.uint32): 'Uint32Array',
+    np.dtype(np.float32): 'Float32Array'
+}
+
+# Leaflet release folium draws its maps with
+leaflet_url = 'https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/'
+
+
+def encode_array(values, dtype):
+    """
+    Packs an array for the browser: the little-endian bytes, gzipped and base64-encoded,
+    with the name of the typed array they are read back into.
+    """
+    values = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder('<'))
+    return {
+        'type': array_types[np.dtype(dtype)],
+        'data': base64.b64encode(gzip.compress(values.tobytes(), 6)).decode('ascii')
+    }
+
+
+def cube_data(cube, metrics):
+    """
+    Browser copy of a cube from `cube.build_cube`. Every combination of filters is one
+    slice of it, so the browser only indexes it.
+
+    Parameters:
+        cube (dict): Output of `build_cube`.
+        metrics (dict): Type of every metric sent, e.g. {'trip_count': np.uint32}.
+
+    Returns:
+        dict: Labels, zone count and the encoded metric arrays.
+    """
+    return {
+        'kind': 'cube',
+        'labels': cube['labels'],
+        'n_zones': int(next(iter(cube['metrics'].values())).shape[-1]),
+        'metrics': {metric: encode_array(cube['metrics'][metric], dtype) for metric, dtype in metrics.items()}
+    }
+
+
+def rows_data(data, dims, zone_columns, metrics, n_zones):
+    """
+    Browser copy of aggregated rows, for filters on pickup and dropoff zones that a cube
+    with rollups over both zones would be too large for. The browser sums the matching
+    rows per zone, like `cube.query_pair_index`.
+
+    Parameters:
+        data (DataFrame): Trip statistics, one row per group.
+        dims (list): (column, labels) of each filter dimension; rows whose value is not
+            in labels are left out.
+        zone_columns (list): LocationID columns the rows can be filtered and mapped by.
+        metrics (dict): Type of every metric sent.
+        n_zones (int): Largest LocationID + 1.
+
+    Returns:
+        dict: Labels, zone count and the encoded codes, LocationIDs and metrics.
+    """
+    labels = [list(dim_labels) for _, dim_labels in dims]
+    # Position of every value in its labels, starting at 1 (0 is the 'All' selection)
+    codes = [pd.Categorical(data[column], categories=dim_labels).codes.astype(np.int64) + 1
+             for (column, _), dim_labels in zip(dims, labels)]
+    zones = {column: data[column].to_numpy().astype(np.int64) for column in zone_columns}
+
+    keep = np.ones(len(data), dtype=bool)
+    for dim_codes in codes:
+        keep &= dim_codes > 0
+    for zone_ids in zones.values():
+        keep &= (zone_ids >= 0) & (zone_ids < n_zones)
+
+    return {
+        'kind': 'rows',
+        'labels': labels,
+        'n_zones': int(n_zones),
+        'codes': [encode_array(dim_codes[keep], np.uint8) for dim_codes in codes],
+        'zones': {column: encode_array(zone_ids[keep], np.uint16) for column, zone_ids in zones.items()},
+        'metrics': {metric: encode_array(data[metric].to_numpy()[keep], dtype) for metric, dtype in metrics.items()}
+    }
+
+
+def client_map_html(topology, data, controls, value, caption, palette, tooltip, table,
+                    zone_filters=(), averages=None, highlight=None, known_zones_only=False, map_height=500, bins=6):
+    """
+    A self-contained page with the filters, the choropleth map and the top zones table,
+    all driven by JavaScript. Once loaded, changing a filter never reaches the server.
+
+    Parameters:
+        topology (dict): Zone geometry from `zone_layer.load_zone_topology`.
+        data (dict): Output of `cube_data` or `rows_data`.
+        controls (list): Filters in display order, as (title, ('dim', index)) for a
+            dimension of `data` or (title, ('zone', index)) for one of `zone_filters`.
+        value (str): Metric the zones are colored and ranked by.
+        caption (str): Legend caption.
+        palette (str): ColorBrewer palette of the equal-width bins, as in `zone_layer.step_colormap`.
+        tooltip (list): (field, alias) shown when hovering a zone.
+        table (dict): 'title', 'top_n' and 'columns' as (header, field) of the table.
+        zone_filters (list): For rows data, dicts with the zone 'column' a filter selects
+            on and the LocationIDs of every zone name ('ids'). The map shows the zones of the
+            first column whose filter is 'All', or of the last column.
+        averages (dict): Fields averaged over the matching rows, with their decimals.
+        highlight (int): Zone filter whose zone is drawn in red when every zone filter is set.
+        known_zones_only (bool): Leave the LocationIDs missing from the geometry out of the table.
+        map_height (int): Height of the map in pixels.
+        bins (int): Number of color bins.
+
+    Returns:
+        str: The HTML page.
+    """
+    spec = {
+        'topology': {key: topology[key] for key in ['transform', 'objects', 'arcs']},
+        'data': data,
+        'controls': controls,
+        'value': value,
+        'caption': caption,
+        'colors': color_brewer(palette, n=bins),
+        'tooltip': tooltip,
+        'table': table,
+        'zone_filters': list(zone_filters),
+        'averages': averages or {},
+        'highlight': highlight,
+        'known_zones_only': known_zones_only
+    }
+    # Keep '</script>' in zone names from ending the script
+    spec_json = json.dumps(spec, separators=(',', ':')).replace('</', '<\\/')
+    return page_template.replace('$leaflet', leaflet_url).replace('$map_height', str(map_height)).replace('$spec', spec_json)
+
+
+page_template = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<link rel="stylesheet" href="$leafletleaflet.css">
+<script src="$leafletleaflet.js"></script>
+<style>
+  body { margin: 0; font-family: "Source Sans Pro", sans-serif; font-size: 14px; color: #31333f; }
+  #controls { display: flex; flex-wrap: wrap; gap: 12px; margin-bottom: 8px; }
+  #controls label { display: flex; flex-direction: column; font-size: 13px; }
+  #controls select { min-width: 140px; padding: 4px; }
+  #map { height: $map_heightpx; }
+  #message { color: #926c05; background: #fffce7; padding: 8px; display: none; }
+  .legend { background: white; padding: 6px; line-height: 16px; }
+  .legend i { display: inline-block; width: 28px; height: 10px; }
+  table { border-collapse: collapse; margin-top: 8px; }
+  th, td { border-bottom: 1px solid #e6e9ef; padding: 4px 8px; text-align: left; }
+  td.number { text-align: right; }
+</style>
+</head>
+<body>
+<div id="controls"></div>
+<div id="message">No data available for the selected filters.</div>
+<div id="map"></div>
+<h3 id="table-title"></h3>
+<table id="table"></table>
+<script>
+const spec = $spec;
+
+async function decodeArray(encoded) {
+  const bytes = Uint8Array.from(atob(encoded.data), c => c.charCodeAt(0));
+  const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'));
+  const buffer = await new Response(stream).arrayBuffer();
+  return new window[encoded.type](buffer);
+}
+
+// Same decoding as zone_layer.from_topojson
+function decodeTopology(topology) {
+  const [sx, sy] = topology.transform.scale;
+  const [tx, ty] = topology.transform.translate;
+  const arcs = topology.arcs.map(arc => {
+    let x = 0, y = 0;
+    return arc.map(([dx, dy]) => { x += dx; y += dy; return [x * sx + tx, y * sy + ty]; });
+  });
+  return topology.objects.zones.geometries.map(geometry => ({
+    type: 'Feature',
+    properties: geometry.properties,
+    geometry: {type: 'MultiPolygon', coordinates: geometry.arcs.map(polygon => polygon.map(ring => arcs[ring[0]]))}
+  }));
+}
+
+// Rounds half to even, like numpy.round
+function round(x, digits) {
+  const factor = 10 ** digits, scaled = x * factor, floor = Math.floor(scaled);
+  const rounded = scaled - floor === 0.5 ? (floor % 2 === 0 ? floor : floor + 1) : Math.round(scaled);
+  return rounded / factor;
+}
+
+// Equal-width bins, like numpy.histogram_bin_edges and zone_layer.step_colormap
+function binEdges(values, bins) {
+  let low = Math.min(...values), high = Math.max(...values);
+  if (low === high) { low -= 0.5; high += 0.5; }
+  return Array.from({length: bins + 1}, (_, i) => low + (high - low) * i / bins);
+}
+
+function binColor(edges, value) {
+  let bin = 0;
+  while (bin < spec.colors.length - 1 && value >= edges[bin + 1]) bin++;
+  return spec.colors[bin];
+}
+
+function escape(text) {
+  const element = document.createElement('span');
+  element.textContent = text;
+  return element.innerHTML;
+}
+
+function format(field, value) {
+  if (typeof value !== 'number') return escape(value);
+  const digits = spec.averages[field] || 0;
+  return value.toFixed(digits);
+}
+
+(async () => {
+  const data = spec.data;
+  const nZones = data.n_zones;
+  const features = decodeTopology(spec.topology);
+  const zones = new Map(features.map(feature => [feature.properties.LocationID, feature.properties]));
+
+  const metrics = {};
+  for (const [name, encoded] of Object.entries(data.metrics)) metrics[name] = await decodeArray(encoded);
+  const codes = data.kind === 'rows' ? await Promise.all(data.codes.map(decodeArray)) : [];
+  const zoneIds = {};
+  for (const [column, encoded] of Object.entries(data.zones || {})) zoneIds[column] = await decodeArray(encoded);
+
+  // Filters
+  const dimSelects = [], zoneSelects = [];
+  for (const [title, [kind, index]] of spec.controls) {
+    const label = document.createElement('label');
+    const select = document.createElement('select');
+    const options = kind === 'dim' ? data.labels[index] : Object.keys(spec.zone_filters[index].ids).sort();
+    for (const option of ['All', ...options]) select.add(new Option(option, option));
+    select.addEventListener('change', update);
+    label.append(title, select);
+    document.getElementById('controls').append(label);
+    (kind === 'dim' ? dimSelects : zoneSelects)[index] = select;
+  }
+
+  // Per-zone sums for the selected filters ('records' counts the matching rows)
+  function aggregate() {
+    const slots = dimSelects.map((select, d) => select.value === 'All' ? 0 : data.labels[d].indexOf(select.value) + 1);
+    if (data.kind === 'cube') {
+      let cell = 0;
+      slots.forEach((slot, d) => { cell = cell * (data.labels[d].length + 1) + slot; });
+      const sums = {};
+      for (const [name, values] of Object.entries(metrics)) sums[name] = values.subarray(cell * nZones, (cell + 1) * nZones);
+      sums.records = sums[spec.value];
+      return sums;
+    }
+
+    const selected = spec.zone_filters.map((filter, f) => {
+      const name = zoneSelects[f].value;
+      if (name === 'All') return null;
+      const mask = new Uint8Array(nZones);
+      for (const id of filter.ids[name] || []) if (id >= 0 && id < nZones) mask[id] = 1;
+      return mask;
+    });
+    const open = spec.zone_filters.findIndex((filter, f) => selected[f] === null);
+    const zoneColumn = spec.zone_filters[open >= 0 ? open : spec.zone_filters.length - 1].column;
+
+    const names = Object.keys(metrics);
+    const sums = Object.fromEntries(names.map(name => [name, new Float64Array(nZones)]));
+    sums.records = new Float64Array(nZones);
+    const columns = spec.zone_filters.map(filter => zoneIds[filter.column]);
+    const target = zoneIds[zoneColumn];
+    const rows = target.length;
+    rows: for (let row = 0; row < rows; row++) {
+      for (let d = 0; d < slots.length; d++) if (slots[d] && codes[d][row] !== slots[d]) continue rows;
+      for (let f = 0; f < selected.length; f++) if (selected[f] && !selected[f][columns[f][row]]) continue rows;
+      const zone = target[row];
+      for (const name of names) sums[name][zone] += metrics[name][row];
+      sums.records[zone] += 1;
+    }
+    return sums;
+  }
+
+  const map = L.map('map').setView([40.7685, -73.9822], 10);
+  L.tileLayer('https://{s}.basemaps.cartocdn.com/light_all/{z}/{x}/{y}{r}.png', {
+    attribution: '&copy; OpenStreetMap contributors &copy; CARTO', subdomains: 'abcd', maxZoom: 20
+  }).addTo(map);
+  const legend = L.control({position: 'topright'});
+  legend.onAdd = () => L.DomUtil.create('div', 'legend');
+  legend.addTo(map);
+  let layers = [];
+
+  function update() {
+    const sums = aggregate();
+    const rows = [];
+    for (let zone = 0; zone < nZones; zone++) {
+      if (!(sums.records[zone] > 0)) continue;
+      const properties = zones.get(zone);
+      if (spec.known_zones_only && !properties) continue;
+      const row = {LocationID: zone, zone: properties ? properties.zone : 'Unknown', borough: properties ? properties.borough : ''};
+      for (const name of Object.keys(metrics)) row[name] = sums[name][zone];
+      for (const [field, digits] of Object.entries(spec.averages)) row[field] = round(sums[field][zone] / sums.records[zone], digits);
+      rows.push(row);
+    }
+
+    layers.forEach(layer => map.removeLayer(layer));
+    layers = [];
+    document.getElementById('message').style.display = rows.length ? 'none' : 'block';
+    const tableElement = document.getElementById('table');
+    tableElement.innerHTML = '';
+    legend.getContainer().innerHTML = '';
+    if (!rows.length) return;
+
+    // Choropleth of the zones with trips
+    const byZone = new Map(rows.map(row => [row.LocationID, row]));
+    const edges = binEdges(rows.map(row => row[spec.value]), spec.colors.length);
+    layers.push(L.geoJSON(features.filter(feature => byZone.has(feature.properties.LocationID)), {
+      style: feature => ({fillColor: binColor(edges, byZone.get(feature.properties.LocationID)[spec.value]),
+                          fillOpacity: 0.7, color: 'black', weight: 0.3}),
+      onEachFeature: (feature, layer) => {
+        const row = byZone.get(feature.properties.LocationID);
+        layer.bindTooltip(spec.tooltip.map(([field, alias]) => '<b>' + escape(alias) + '</b> ' + format(field, row[field])).join('<br>'));
+      }
+    }).addTo(map));
+
+    // The selected zone of the highlight filter, when every zone filter is set
+    if (spec.highlight !== null && zoneSelects.length && zoneSelects.every(select => select.value !== 'All')) {
+      const name = zoneSelects[spec.highlight].value;
+      layers.push(L.geoJSON(features.filter(feature => feature.properties.zone === name), {
+        style: () => ({fillColor: 'red', color: 'black', weight: 2, fillOpacity: 0.6}),
+        onEachFeature: (feature, layer) => layer.bindTooltip(
+          '<b>Location ID</b> ' + feature.properties.LocationID + '<br><b>Zone:</b> ' + escape(feature.properties.zone) +
+          '<br><b>Borough:</b> ' + escape(feature.properties.borough))
+      }).addTo(map));
+    }
+
+    legend.getContainer().innerHTML = '<b>' + escape(spec.caption) + '</b><br>' + spec.colors.map((color, bin) =>
+      '<i style="background:' + color + '"></i> ' + Math.round(edges[bin]) + ' - ' + Math.round(edges[bin + 1])).join('<br>');
+
+    // Top zones table
+    document.getElementById('table-title').textContent = spec.table.title;
+    rows.sort((a, b) => b[spec.value] - a[spec.value]);
+    const header = '<tr>' + spec.table.columns.map(([title]) => '<th>' + escape(title) + '</th>').join('') + '</tr>';
+    tableElement.innerHTML = header + rows.slice(0, spec.table.top_n).map(row => '<tr>' + spec.table.columns.map(([, field]) =>
+      '<td class="' + (typeof row[field] === 'number' ? 'number' : '') + '">' + format(field, row[field]) + '</td>').join('') + '</tr>').join('');
+  }
+
+  update();
+})();
+</script>
+</body>
+</html>
+"""
@@ -0,0 +1,201 @@
+# Description:  Precomputed trip cubes behind the dashboards' filter_and_aggregate
+
+
+
+import numpy as np
+import pandas as pd
+
+
+def _codes(values, labels):
+    """Position of every value in `labels`, starting at 1 (0 is the 'All' slot), -1 when absent."""
+    codes = pd.Categorical(values, categories=labels).codes.astype(np.int64)
+    return np.where(codes < 0, -1, codes + 1)
+
+
+def _index(labels, label):
+    """Slot of a selected label in a cube dimension: 0 for 'All', None when the label is absent."""
+    if label == 'All':
+        return 0
+    if label not in labels:
+        return None
+    return labels.index(label) + 1
+
+
+def build_cube(data, zone_column, dims, metrics, n_zones):
+    """
+    Sums trip metrics into a dense array per metric, with one axis per filter dimension
+    and the zone last. Slot 0 of each filter axis holds the 'All' rollup over that axis,
+    so every combination of filters is materialized.
+
+    Parameters:
+        data (DataFrame): Trip counts or statistics, one row per group.
+        zone_column (str): Column holding the LocationID the results are indexed by.
+        dims (list): (column, labels) of each filter dimension; rows whose value is not
+            in labels are left out.
+        metrics (list): Columns summed per cell.
+        n_zones (int): Length of the zone axis, i.e. the largest LocationID + 1.
+
+    Returns:
+        dict: 'labels' (list of labels per dimension) and 'metrics' (ndarray per metric).
+    """
+    labels = [list(dim_labels) for _, dim_labels in dims]
+    shape = tuple(len(dim_labels) + 1 for dim_labels in labels) + (n_zones,)
+
+    codes = [_codes(data[column], dim_labels) for (column, _), dim_labels in zip(dims, labels)]
+    zones = data[zone_column].to_numpy().astype(np.int64)
+    keep = (zones >= 0) & (zones < n_zones)
+    for dim_codes in codes:
+        keep &= dim_codes > 0
+    cells = np.ravel_multi_index([dim_codes[keep] for dim_codes in codes] + [zones[keep]], shape)
+
+    values = {}
+    for metric in metrics:
+        cube = np.bincount(cells, weights=data[metric].to_numpy()[keep], minlength=int(np.prod(shape)))
+        cube = cube.reshape(shape)
+        # Roll every filter axis up into its slot 0, one axis after the other, so that the
+        # slots of earlier axes are included in the later rollups
+        for axis in range(len(dims)):
+            total = [slice(None)] * cube.ndim
+            total[axis] = 0
+            rest = [slice(None)] * cube.ndim
+            rest[axis] = slice(1, None)
+            cube[tuple(total)] = cube[tuple(rest)].sum(axis=axis)
+        values[metric] = cube
+    return {'labels': labels, 'metrics': values}
+
+
+def query_cube(cube, selection):
+    """
+    Per-zone metrics for one combination of filters, as a slice of the cube.
+
+    Parameters:
+        cube (dict): Output of `build_cube`.
+        selection (tuple): Selected label (or 'All') of every dimension.
+
+    Returns:
+        dict: Per-metric arrays indexed by LocationID.
+    """
+    slots = tuple(_index(labels, label) for labels, label in zip(cube['labels'], selection))
+    if None in slots:
+        return {metric: np.zeros(values.shape[-1]) for metric, values in cube['metrics'].items()}
+    return {metric: values[slots] for metric, values in cube['metrics'].items()}
+
+
+def build_pair_index(data, key_column, zone_column, dims, metrics, n_zones):
+    """
+    Origin-destination rows grouped by one side of the trip, for the queries that select
+    a zone. A dense (time x zone x zone) cube with rollups would not fit in memory, so the
+    rows are sorted by `key_column` and each key's rows are found by offset.
+
+    Parameters:
+        data (DataFrame): Trip statistics, one row per group.
+        key_column (str): LocationID column that is filtered on.
+        zone_column (str): LocationID column the results are indexed by.
+        dims (list): (column, labels) of each filter dimension.
+        metrics (list): Columns summed by `query_pair_index`.
+        n_zones (int): Largest LocationID + 1.
+
+    Returns:
+        dict: 'labels', 'offsets' (row range of each key), 'codes', 'zones' and 'metrics'.
+    """
+    index, rows = _sorted_pairs(data, key_column, zone_column, dims, n_zones)
+    index['metrics'] = {metric: data[metric].to_numpy()[rows] for metric in metrics}
+    return index
+
+
+def _sorted_pairs(data, key_column, zone_column, dims, n_zones):
+    """Pair index without its values, and the rows of `data` it holds, in index order."""
+    labels = [list(dim_labels) for _, dim_labels in dims]
+    codes = np.stack([_codes(data[column], dim_labels) for (column, _), dim_labels in zip(dims, labels)])
+    keys = data[key_column].to_numpy().astype(np.int64)
+    zones = data[zone_column].to_numpy().astype(np.int64)
+
+    keep = (codes > 0).all(axis=0) & (keys >= 0) & (keys < n_zones) & (zones >= 0) & (zones < n_zones)
+    rows = np.flatnonzero(keep)[np.argsort(keys[keep], kind='stable')]
+    return {
+        'labels': labels,
+        'offsets': np.searchsorted(keys[rows], np.arange(n_zones + 1)),
+        'codes': codes[:, rows].astype(np.int8),
+        'zones': zones[rows],
+    }, rows
+
+
+def query_pair_index(index, keys, selection):
+    """
+    Per-zone metrics of the rows whose key is one of `keys`, for one combination of filters.
+
+    Parameters:
+        index (dict): Output of `build_pair_index`.
+        keys (list): Selected LocationIDs.
+        selection (tuple): Selected label (or 'All') of every dimension.
+
+    Returns:
+        dict: Per-metric arrays indexed by LocationID.
+    """
+    n_zones = len(index['offsets']) - 1
+    rows = _selected_rows(index, keys, selection)
+    zones = index['zones'][rows]
+    return {
+        metric: np.bincount(zones, weights=values[rows], minlength=n_zones)
+        for metric, values in index['metrics'].items()
+    }
+
+
+def _selected_rows(index, keys, selection):
+    """Rows of a pair or sketch index whose key is one of `keys` and that match the filters."""
+    n_zones = len(index['offsets']) - 1
+    rows = np.concatenate([np.arange(index['offsets'][key], index['offsets'][key + 1])
+                           for key in keys if 0 <= key < n_zones] + [np.zeros(0, dtype=np.int64)])
+
+    for labels, label, codes in zip(index['labels'], selection, index['codes']):
+        slot = _index(labels, label)
+        if slot is None:
+            rows = rows[:0]
+        elif slot:
+            rows = rows[codes[rows] == slot]
+    return rows
+
+
+def build_sketch_index(sketches, key_column, zone_column, dims, n_zones, n_buckets):
+    """
+    Quantile sketch buckets (see quantile_sketch.py) of one metric, grouped by one side of
+    the trip as in `build_pair_index`, so the sketches of the matching rows are merged per
+    zone at query time. With key_column equal to zone_column, querying every key merges
+    the sketches of each zone.
+
+    Parameters:
+        sketches (DataFrame): Trip counts per group and bucket, one row per non-empty bucket.
+        key_column (str): LocationID column that is filtered on.
+        zone_column (str): LocationID column the results are indexed by.
+        dims (list): (column, labels) of each filter dimension.
+        n_zones (int): Largest LocationID + 1.
+        n_buckets (int): Number of sketch buckets.
+
+    Returns:
+        dict: 'labels', 'offsets', 'codes', 'zones', 'buckets', 'counts' and 'n_buckets'.
+    """
+    index, rows = _sorted_pairs(sketches, key_column, zone_column, dims, n_zones)
+    index['buckets'] = sketches['bucket'].to_numpy().astype(np.int64)[rows]
+    index['counts'] = sketches['trip_count'].to_numpy()[rows]
+    index['n_buckets'] = n_buckets
+    return index
+
+
+def query_sketch_index(index, keys, selection):
+    """
+    Merged sketch of every zone, from the rows whose key is one of `keys`, for one
+    combination of filters.
+
+    Parameters:
+        index (dict): Output of `build_sketch_index`.
+        keys (list): Selected LocationIDs.
+        selection (tuple): Selected label (or 'All') of every dimension.
+
+    Returns:
+        ndarray: Trips per zone and bucket, shape (n_zones, n_buckets).
+    """
+    n_zones = len(index['offsets']) - 1
+    rows = _selected_rows(index, keys, selection)
+    cells = index['zones'][rows] * index['n_buckets'] + index['buckets'][rows]
+    counts = np.bincount(cells, weights=index['counts'][rows], minlength=n_zones * index['n_buckets'])
+    return counts.reshape(n_zones, index['n_buckets'])
@@ -4,149 +4,973 @@
 
 
 
+import argparse
+import json
+import operator
+import os
+import shutil
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
+
+import features
+import od_matrix
+import quantile_sketch
+import query_cache
+import storage
+from features import calendar_features, day_order, month_names, period_order
+from od_matrix import od_folder, write_od_matrix
+from profiler import load_hook, profiler, stage
+from quantile_sketch import compact_sketches, partial_sketches, sketch_dtypes
+from query_cache import file_fingerprint
+from stage_dag import StageDAG
+from storage import formats, table_path, write_table
 
 path = r"C:\Users\USAR705244\OneDrive - WSP O365\Documents\Kaggle\TLC 2024\\"
 
-lyft = pd.read_csv(path+'trips.csv')
-lyft = lyft.dropna()
+# Folder (under path) keeping the mergeable sums and counts of every ingested trip file
+state_folder = 'aggregate_state'
+
+# Cached stage outputs of `run_cached`, in the data folder
+stage_cache_folder = 'stage_cache'
+
+# Group keys of the three aggregate tables written by this program
+pickup_keys = ['PULocationID', 'month', 'day_pickup', 'pickup_period']
+dropoff_keys = ['DOLocationID', 'month', 'day_dropoff', 'dropoff_period']
+pickup_dropoff_keys = ['PULocationID', 'DOLocationID', 'month', 'day_pickup', 'pickup_period']
+
+# Group keys of each aggregate table, and the groupby observed flag its partials are folded with
+aggregate_keys = {
+    'pickup_cleaned': (pickup_keys, False),
+    'dropoff_cleaned': (dropoff_keys, False),
+    'pickup_dropoff_cleaned': (pickup_dropoff_keys, True),
+    'pickup_dropoff_sketch': (pickup_dropoff_keys + ['metric', 'bucket'], True)
+}
+
+# Types of the group key columns, restored when the state is read back
+key_dtypes = {
+    'PULocationID': np.int64,
+    'DOLocationID': np.int64,
+    'month': pd.CategoricalDtype(month_names, ordered=True),
+    'day_pickup': pd.CategoricalDtype(day_order, ordered=True),
+    'day_dropoff': pd.CategoricalDtype(day_order, ordered=True),
+    'pickup_period': pd.CategoricalDtype(period_order, ordered=True),
+    'dropoff_period': pd.CategoricalDtype(period_order, ordered=True),
+    'metric': sketch_dtypes['metric'],
+    'bucket': sketch_dtypes['bucket']
+}
+
+# Compact types of the raw trip columns, applied when the file is read. The ID and count
+# columns are read as float32 because they may hold NaN; clean_trips narrows them once
+# NaN rows are gone
+read_dtypes = {
+    'PULocationID': np.float32,
+    'DOLocationID': np.float32,
+    'passenger_count': np.float32,
+    'RatecodeID': np.float32,
+    'trip_distance': np.float64
+}
+
+# Compact types of the cleaned trip columns (day, month, week and the periods are categoricals).
+# The distances and durations stay float64: their sums and means are the published
+# averages, which must not depend on whether the file was read whole or in chunks
+trip_dtypes = {
+    'PULocationID': np.uint16,
+    'DOLocationID': np.uint16,
+    'passenger_count': np.uint8,
+    'RatecodeID': np.uint8,
+    'trip_distance': np.float64,
+    'trip_duration': np.float64,
+    'hour_pickup': np.uint8,
+    'hour_dropoff': np.uint8,
+    'weekday_pickup': np.uint8,
+    'weekday_dropoff': np.uint8,
+    'year': np.uint16,
+    'pickup_dropoff': np.uint32,
+    'mean_distance': np.float64,
+    'mean_duration': np.float64
+}
+
+# Rules of clean_trips, as (name, column, operator, value): a trip for which
+# `column operator value` holds is rejected. The DuckDB backend (duckdb_backend.py)
+# builds its WHERE clause from the same list
+cleaning_rules = [
+    ('december', 'month', '==', 'December'),
+    ('week_52', 'week', '==', 'W52'),
+    ('ratecode_99', 'RatecodeID', '==', 99),
+    ('no_passengers', 'passenger_count', '==', 0),
+    ('negative_duration', 'trip_duration', '<', 0),
+    ('zero_distance', 'trip_distance', '==', 0)
+]
+rule_operators = {'==': operator.eq, '<': operator.lt}
+
+# Engines the --ingest files can be cleaned and aggregated with; pandas is the reference
+backends = ['pandas', 'duckdb']
+
+# Coordinate columns of the trip files that have no LocationIDs (older TLC files, GPS
+# feeds); the trips are assigned to the zone their coordinates fall in (see zone_assign.py)
+coordinate_columns = {
+    'PULocationID': ('pickup_longitude', 'pickup_latitude'),
+    'DOLocationID': ('dropoff_longitude', 'dropoff_latitude')
+}
+
+# The pickup_dropoff key packs both LocationIDs (all under 512) into one integer
+od_key_bits = 9
+od_key_count = 1 << (2 * od_key_bits)
+
+
+def clean_trips(lyft, rejected=None):
+    """
+    Drops incomplete and invalid trips and derives the calendar and time period columns.
+
+    The columns are derived for every trip, and the trips with a missing value (in any
+    column of the file) or rejected by a cleaning rule are then dropped in one go, with
+    a single mask. The 'filters' stage records how many trips were missing values and
+    how many complete trips each rule rejected (a trip may break several rules).
+
+    Parameters:
+        lyft (DataFrame): Raw trips as read from the TLC trip file (or one chunk of it).
+        rejected (dict): Rows rejected by reason, which the counts of these trips are
+            added to (e.g. over the chunks of a file), see `print_rejections`.
+
+    Returns:
+        DataFrame: The cleaned trips, with the trip_dtypes types.
+    """
+    with stage('missing_values', len(lyft)) as record:
+        missing = np.zeros(len(lyft), dtype=bool)
+        for column in lyft:
+            missing |= lyft[column].isna().to_numpy()
+
+        # A copy, the derived columns are added to it and not to the caller's frame
+        lyft = lyft.loc[:, ['tpep_pickup_datetime','tpep_dropoff_datetime',"PULocationID","DOLocationID",'passenger_count','RatecodeID','trip_distance']].copy()
+        record['rows_out'] = len(lyft) - int(missing.sum())
+
+    with stage('parse_datetimes', len(lyft)):
+        lyft['tpep_pickup_datetime'] = pd.to_datetime(lyft['tpep_pickup_datetime'])
+        lyft['tpep_dropoff_datetime'] = pd.to_datetime(lyft['tpep_dropoff_datetime'])
+        lyft['trip_duration'] = (lyft['tpep_dropoff_datetime']-lyft['tpep_pickup_datetime'])/ np.timedelta64(1,'m')
+
+    # Calendar columns are derived once per distinct date, see features.py
+    with stage('calendar_features', len(lyft)):
+        pickup = calendar_features(lyft['tpep_pickup_datetime'])
+        lyft['hour_pickup'] = pickup['hour']
+        lyft['day_pickup'] = pickup['day']
+        lyft['month'] = pickup['month']
+        lyft['year'] = pickup['year']
+        lyft['weekday_pickup'] = pickup['weekday']
+        lyft['week'] = pickup['week']
+
+        dropoff = calendar_features(lyft['tpep_dropoff_datetime'])
+        lyft['hour_dropoff'] = dropoff['hour']
+        lyft['day_dropoff'] = dropoff['day']
+        lyft['weekday_dropoff'] = dropoff['weekday']
+
+        lyft['pickup_period'] = pickup['period']
+        lyft['dropoff_period'] = dropoff['period']
+
+    with stage('filters', len(lyft)) as record:
+        keep = ~missing
+        counts = {'missing_values': int(missing.sum())}
+        for name, column, rule, value in cleaning_rules:
+            broken = rule_operators[rule](lyft[column], value).to_numpy()
+            counts[name] = int((broken & ~missing).sum())
+            keep &= ~broken
+        if rejected is not None:
+            for name, rows in counts.items():
+                rejected[name] = rejected.get(name, 0) + rows
+        lyft = lyft.loc[keep]
+        record['rows_out'] = len(lyft)
+        record['rejected'] = counts
+
+    with stage('compact', len(lyft)):
+        lyft['pickup_dropoff'] = od_key(lyft['PULocationID'], lyft['DOLocationID'])
+        return lyft.astype({column: dtype for column, dtype in trip_dtypes.items() if column in lyft})
+
+
+def print_rejections(source, rows, trips, rejected):
+    """Prints the trips kept out of the rows read from a trip file, and the rows rejected by reason."""
+    print('%s: kept %d of %d rows, rejected %s' % (
+        source, trips, rows, ', '.join('%s %d' % (name, count) for name, count in rejected.items())))
+
+
+def od_key(pickup_ids, dropoff_ids):
+    """
+    Packs pickup and dropoff LocationIDs into one integer pickup_dropoff key.
+
+    Parameters:
+        pickup_ids (Series): PULocationID values (0-511).
+        dropoff_ids (Series): DOLocationID values (0-511).
+
+    Returns:
+        Series: PULocationID in the high bits and DOLocationID in the low od_key_bits bits.
+    """
+    return pickup_ids.astype(np.int64) * (1 << od_key_bits) + dropoff_ids.astype(np.int64)
+
+
+def label_od_pairs(lyft):
+    """
+    Replaces the packed pickup_dropoff key of the trips by its 'PULocationID-DOLocationID'
+    label (e.g. '142-24'), the format of the pickup_dropoff column of lyft_cleaned. The
+    integer key is only used inside this program.
+    """
+    keys, codes = np.unique(lyft['pickup_dropoff'].to_numpy(), return_inverse=True)
+    labels = np.array(['%d-%d' % (key >> od_key_bits, key & ((1 << od_key_bits) - 1)) for key in keys], dtype=object)
+    return lyft.assign(pickup_dropoff=labels[codes.ravel()])
+
+
+def add_od_means(lyft, od_means=None):
+    """
+    Adds the mean distance and mean duration of each pickup-dropoff pair to every trip.
+
+    Parameters:
+        lyft (DataFrame): Cleaned trips.
+        od_means (ndarray): Output of `finalize_od_means`. Computed from `lyft` when not given.
+
+    Returns:
+        DataFrame: The trips with the mean_distance and mean_duration columns.
+    """
+    if od_means is None:
+        od_means = finalize_od_means(partial_od_sums(lyft))
+
+    # Broadcast the pair means back to the trips by indexing with the pickup_dropoff key
+    key = lyft['pickup_dropoff'].to_numpy()
+    lyft['mean_distance'] = od_means[0, key].astype(trip_dtypes['mean_distance'])
+    lyft['mean_duration'] = od_means[1, key].astype(trip_dtypes['mean_duration'])
+    return lyft
 
 
-lyft = lyft[['tpep_pickup_datetime','tpep_dropoff_datetime',"PULocationID","DOLocationID",'passenger_count','RatecodeID','trip_distance']]
+def partial_od_sums(lyft):
+    """
+    Trip count, distance sum and duration sum of every pickup_dropoff key in one pass.
+
+    Returns:
+        ndarray: Shape (3, od_key_count), indexed by the pickup_dropoff key. The arrays
+        of several chunks are folded by adding them.
+    """
+    key = lyft['pickup_dropoff'].to_numpy()
+    return np.stack([
+        np.bincount(key, minlength=od_key_count),
+        np.bincount(key, weights=lyft['trip_distance'].to_numpy(), minlength=od_key_count),
+        np.bincount(key, weights=lyft['trip_duration'].to_numpy(), minlength=od_key_count)
+    ])
+
+
+def finalize_od_means(od_sums):
+    """
+    Divides pickup_dropoff sums by their counts.
 
-lyft['tpep_pickup_datetime'] = pd.to_datetime(lyft['tpep_pickup_datetime'])
-lyft['tpep_dropoff_datetime'] = pd.to_datetime(lyft['tpep_dropoff_datetime'])
-lyft['trip_duration'] = (lyft['tpep_dropoff_datetime']-lyft['tpep_pickup_datetime'])/ np.timedelta64(1,'m')
+    Returns:
+        ndarray: Shape (2, od_key_count) with the mean distance and mean duration of
+        every pickup_dropoff key, NaN for pairs without trips.
+    """
+    counts = od_sums[0]
+    return np.divide(od_sums[1:], counts, out=np.full(od_sums[1:].shape, np.nan), where=counts > 0)
 
-month_order = ['January', 'February', 'March', 'April', 'May', 'June','July']
 
-day_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+def partial_counts(lyft, keys):
+    """Number of trips per group of `keys`, kept mergeable (zero counts are not dropped)."""
+    return (
+        lyft.groupby(keys, as_index=False, observed=False)
+        .size()
+        .rename(columns={'size': 'trip_count'})
+    )
 
-lyft['hour_pickup'] = lyft['tpep_pickup_datetime'].dt.hour
-lyft['day_pickup'] = lyft['tpep_pickup_datetime'].dt.day_name()
-lyft['day_pickup'] = pd.Categorical(lyft['day_pickup'], categories=day_order, ordered=True)
 
-lyft['month'] = lyft['tpep_pickup_datetime'].dt.month_name()
-lyft['month'] = pd.Categorical(lyft['month'], categories=month_order, ordered=True)
+def finalize_counts(counts):
+    """Drops the empty groups of a (folded) trip count table."""
+    # Fill NaN values in trip_count with 0 (if necessary), on a new frame as `counts` may be a slice
+    counts = counts.assign(trip_count=counts['trip_count'].fillna(0))
+    return counts[counts['trip_count'] > 0]
 
-lyft['year'] = lyft['tpep_pickup_datetime'].dt.year
-lyft['weekday_pickup'] = lyft['tpep_pickup_datetime'].dt.weekday
-lyft['week'] = lyft['tpep_pickup_datetime'].dt.strftime('W%V')
 
-lyft['hour_dropoff'] = lyft['tpep_dropoff_datetime'].dt.hour
-lyft['day_dropoff'] = lyft['tpep_dropoff_datetime'].dt.day_name()
-lyft['day_dropoff'] = pd.Categorical(lyft['day_dropoff'], categories=day_order, ordered=True)
-lyft['weekday_dropoff'] = lyft['tpep_dropoff_datetime'].dt.weekday
+def partial_pickup_dropoff_stats(lyft):
+    """Trip count and distance/duration sums per pickup_dropoff_keys group."""
+    return lyft.groupby(pickup_dropoff_keys, as_index=False, observed=True).agg(
+        trip_count=('PULocationID', 'size'),
+        trip_distance=('trip_distance', 'sum'),
+        trip_duration=('trip_duration', 'sum')
+    )
+
+
+def finalize_pickup_dropoff_stats(stats):
+    """Turns (folded) pickup_dropoff sums into the average trip distance and duration."""
+    stats = stats.assign(
+        avg_trip_distance=stats['trip_distance'] / stats['trip_count'],
+        avg_trip_duration=stats['trip_duration'] / stats['trip_count']
+    )
+    stats = stats[pickup_dropoff_keys + ['trip_count', 'avg_trip_distance', 'avg_trip_duration']]
+    stats = stats.reset_index(drop=True).dropna()
+    return stats[stats['trip_count'] > 0]
 
 
-# Define a function to check if a given time is during rush hour
-def get_time_period(time):
+def fold_partials(total, part, keys, observed=False):
     """
-    Divides the day into four time periods based on the hour of the day.
+    Folds the partial aggregate of one chunk into the running total by summing per group.
 
     Parameters:
-        hour (int): The hour in 24-hour format (0-23).
+        total (DataFrame): Running total, or None for the first chunk.
+        part (DataFrame): Partial aggregate of the current chunk.
+        keys (list): Group columns.
+        observed (bool): Passed on to groupby for categorical keys: False keeps every
+            combination of their categories, True only those with rows.
 
     Returns:
-        str: The time period (am_rush_hour, day_time, pm_rush_hour, night_time).
-    """
-    if 6 <= time.hour < 10:
-        return 'am_rush'
-    elif 10 <= time.hour < 16:
-        return 'day_time'
-    elif 16 <= time.hour < 19:
-        return 'pm_rush'
-    else:
-        return 'night_time'
+        DataFrame: The merged partial aggregate.
+    """
+    if total is None:
+        return part
+    merged = pd.concat([total, part])
+    return merged.groupby(keys, as_index=False, observed=observed).sum()
+
+
+def pickup_dropoff_stats(lyft):
+    """Trip count, average distance and average duration per pickup_dropoff_keys group."""
+    stats = (
+        lyft.groupby(
+            pickup_dropoff_keys,
+            as_index=False,
+            observed=True  # Explicitly set observed=True to handle categorical data properly
+        )
+        .agg(
+            trip_count=('PULocationID', 'size'),        # Count trips
+            avg_trip_distance=('trip_distance', 'mean'),  # Average distance
+            avg_trip_duration=('trip_duration', 'mean')   # Average duration
+        )
+        .reset_index(drop=True)  # Reset index to avoid mismatches
+    )
+
+    # Drop rows with NaN values in any column
+    stats = stats.dropna()
+    return stats[stats['trip_count'] > 0]
+
+
+def partial_aggregates(lyft):
+    """
+    Mergeable trip counts and distance/duration sums of the three aggregate tables, and
+    the distance/duration quantile sketches of the pickup_dropoff groups.
+
+    Parameters:
+        lyft (DataFrame): Cleaned trips, or one chunk of them.
+
+    Returns:
+        dict: Partial aggregate of every table in aggregate_keys, without empty groups.
+    """
+    return {
+        'pickup_cleaned': finalize_counts(partial_counts(lyft, pickup_keys)),
+        'dropoff_cleaned': finalize_counts(partial_counts(lyft, dropoff_keys)),
+        'pickup_dropoff_cleaned': partial_pickup_dropoff_stats(lyft),
+        'pickup_dropoff_sketch': partial_sketches(lyft, pickup_dropoff_keys)
+    }
+
 
+def fold_aggregates(total, part):
+    """Folds the partial aggregates of `part` into `total` (None for the first one)."""
+    if total is None:
+        return part
+    return {name: fold_partials(total[name], part[name], *aggregate_keys[name]) for name in aggregate_keys}
 
-lyft['pickup_period'] = lyft['tpep_pickup_datetime'].apply(get_time_period)
-lyft['dropoff_period'] = lyft['tpep_dropoff_datetime'].apply(get_time_period)
 
+def write_aggregates(partials, path, format='csv'):
+    """
+    Writes pickup_cleaned, dropoff_cleaned, pickup_dropoff_cleaned and pickup_dropoff_sketch
+    from their (folded) partials.
+    """
+    stats = finalize_pickup_dropoff_stats(partials['pickup_dropoff_cleaned'])
+    print(stats.head())
+    write_tables({
+        'pickup_cleaned': finalize_counts(partials['pickup_cleaned']),
+        'dropoff_cleaned': finalize_counts(partials['dropoff_cleaned']),
+        'pickup_dropoff_cleaned': stats,
+        'pickup_dropoff_sketch': compact_sketches(finalize_counts(partials['pickup_dropoff_sketch']), pickup_dropoff_keys)
+    }, path, format)
+    with stage('write.od_matrix', len(partials['pickup_dropoff_cleaned'])):
+        write_od(partials['pickup_dropoff_cleaned'], path)
 
-lyft = lyft.loc[lyft['month']!='December']
-lyft = lyft.loc[lyft['week'] != 'W52']
-lyft = lyft.loc[lyft['RatecodeID'] != 99]
-lyft = lyft.loc[lyft['passenger_count'] != 0]
 
-lyft['pickup_dropoff'] = lyft['PULocationID'].astype(str) + '-' +lyft['DOLocationID'].astype(str)
-grouped =  lyft.groupby(by='pickup_dropoff').mean(numeric_only=True)['trip_distance']
-grouped_dict = grouped.to_dict()
-# 1. Create a mean_distance column that is a copy of the pickup_dropoff helper column
-lyft['mean_distance'] = lyft['pickup_dropoff']
+def write_sketches(sketches, path, format='csv'):
+    """Writes pickup_dropoff_sketch without the sketches of single trips, see `compact_sketches`."""
+    write_table(compact_sketches(sketches, pickup_dropoff_keys), path, 'pickup_dropoff_sketch', format)
 
-# 2. Map `grouped_dict` to the `mean_distance` column
-lyft['mean_distance'] = lyft['mean_distance'].map(grouped_dict)
 
-grouped = lyft.groupby(by='pickup_dropoff').mean(numeric_only=True)['trip_duration']
-grouped_dict = grouped.to_dict()
+def write_od(od_sums, path):
+    """
+    Writes the dense OD matrix (see od_matrix.py) from the pickup_dropoff partials,
+    versioned by pickup_dropoff_cleaned, which must be written first.
+    """
+    write_od_matrix(od_sums, path, version=file_fingerprint(table_path(path, 'pickup_dropoff_cleaned')))
 
 
-# 1. Create a mean_distance column that is a copy of the pickup_dropoff helper column
-lyft['mean_duration'] = lyft['pickup_dropoff']
+def write_tables(tables, path, format='csv', part=None):
+    """Writes every table of `tables` (by name) with `write_table`, one profiler stage each."""
+    for name, table in tables.items():
+        with stage('write.' + name, len(table)):
+            write_table(table, path, name, format, part)
 
-# 2. Map `grouped_dict` to the `mean_distance` column
-lyft['mean_duration'] = lyft['mean_duration'].map(grouped_dict)
 
-lyft.to_csv(path_or_buf=path+'lyft_cleaned.csv')
+def profiled_chunks(chunks):
+    """Yields the chunks of a chunked reader, profiling the read of each one as the stage 'read'."""
+    chunks = iter(chunks)
+    while True:
+        with stage('read') as record:
+            chunk = next(chunks, None)
+            record['rows_out'] = None if chunk is None else len(chunk)
+        if chunk is None:
+            return
+        yield chunk
 
-pickup = lyft.drop(columns=['tpep_pickup_datetime', 'tpep_dropoff_datetime','DOLocationID','trip_distance','trip_duration',
-                            'hour_dropoff', 'day_dropoff',
-                            'weekday_dropoff','dropoff_period'])
 
-dropoff = lyft.drop(columns=['tpep_pickup_datetime', 'tpep_dropoff_datetime', 'PULocationID','trip_distance','trip_duration',
-                            'hour_pickup', 'day_pickup',
-                            'weekday_pickup','pickup_period'])
+def save_state(path, source, partials, fingerprint=None):
+    """
+    Keeps the partial aggregates of one trip file under path+state_folder, replacing any
+    earlier state of the same file.
 
-# Aggregating the data to get the number of trips from each start station
-pickup_counts = (
-    pickup.groupby(['PULocationID','month','day_pickup','pickup_period'], as_index=False)
-    .size()
-    .rename(columns={'size': 'trip_count'})
-)
-# Fill NaN values in trip_count with 0 (if necessary)
-pickup_counts['trip_count'] = pickup_counts['trip_count'].fillna(0)
+    Parameters:
+        path (str): Folder holding the cleaned tables.
+        source (str): Name of the trip file the partials were computed from.
+        partials (dict): Output of `partial_aggregates` (or folded partials).
+        fingerprint (str): Version of the trip file, used to skip unchanged files.
+    """
+    folder = os.path.join(path + state_folder, source)
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    for name, partial in partials.items():
+        partial.to_parquet(os.path.join(folder, name + '.parquet'), engine='pyarrow', index=False)
+    # Written last, so that an interrupted save is never taken for a complete one
+    with open(os.path.join(folder, 'source.json'), 'w') as file:
+        json.dump({'source': source, 'fingerprint': fingerprint}, file)
 
-pickup_counts = pickup_counts[pickup_counts['trip_count'] > 0]
 
-pickup_counts.to_csv(path_or_buf=path+'pickup_cleaned.csv')
+def replace_state(path, partials):
+    """Replaces the whole state by the partials of a full run of trips.csv."""
+    shutil.rmtree(path + state_folder, ignore_errors=True)
+    save_state(path, 'trips.csv', partials, file_fingerprint(path+'trips.csv'))
 
 
-# Aggregating the data to get the number of trips to each end station
-dropoff_counts = (
-    dropoff.groupby(['DOLocationID','month','day_dropoff','dropoff_period'], as_index=False)
-    .size()
-    .rename(columns={'size': 'trip_count'})
-)
-# Fill NaN values in trip_count with 0 (if necessary)
-dropoff_counts['trip_count'] = dropoff_counts['trip_count'].fillna(0)
+def state_sources(path):
+    """
+    Trip files whose partial aggregates are kept in the state.
 
-dropoff_counts = dropoff_counts[dropoff_counts['trip_count'] > 0]
+    Returns:
+        dict: Fingerprint of every ingested trip file, by file name. The fingerprint is
+        None for a state missing some of the aggregate_keys tables (kept by an earlier
+        version of this program), so that the file is ingested again.
+    """
+    sources = {}
+    if os.path.isdir(path + state_folder):
+        for source in sorted(os.listdir(path + state_folder)):
+            folder = os.path.join(path + state_folder, source)
+            if os.path.exists(os.path.join(folder, 'source.json')):
+                with open(os.path.join(folder, 'source.json')) as file:
+                    sources[source] = json.load(file)['fingerprint']
+                if not all(os.path.exists(os.path.join(folder, name + '.parquet')) for name in aggregate_keys):
+                    sources[source] = None
+    return sources
+
+
+def load_state(path):
+    """
+    Folds the partial aggregates of every ingested trip file.
 
-dropoff_counts.to_csv(path_or_buf=path+'dropoff_cleaned.csv')
+    Returns:
+        dict: Folded partial aggregate of every table, or None when nothing was ingested.
+    """
+    total = None
+    for source in state_sources(path):
+        part = {}
+        for name in aggregate_keys:
+            state_file = os.path.join(path + state_folder, source, name + '.parquet')
+            if not os.path.exists(state_file):
+                raise ValueError('The state of %s has no %s, ingest the file again or rebuild the state '
+                                 '(--ingest ... --rebuild).' % (source, name))
+            partial = pd.read_parquet(state_file, engine='pyarrow')
+            # Categories read back from Parquet only hold the values present in the file
+            part[name] = partial.astype({column: dtype for column, dtype in key_dtypes.items() if column in partial})
+        total = fold_aggregates(total, part)
+    return total
+
+
+def read_trip_chunks(trip_file, chunksize=None):
+    """
+    Raw trips of a TLC trip file, CSV or Parquet, whole or `chunksize` rows at a time.
+    Files with coordinates instead of LocationIDs get their LocationIDs assigned.
 
+    Parameters:
+        trip_file (str): Path of the trip file.
+        chunksize (int): Rows per chunk (the whole file in one chunk when None).
 
-# Grouping and aggregating pickup and dropoff data
-pickup_dropoff_stats = (
-    lyft.groupby(
-        ['PULocationID', 'DOLocationID', 'month', 'day_pickup', 'pickup_period'],
-        as_index=False,
-        observed=True  # Explicitly set observed=True to handle categorical data properly
-    )
-    .agg(
-        trip_count=('PULocationID', 'size'),        # Count trips
-        avg_trip_distance=('trip_distance', 'mean'),  # Average distance
-        avg_trip_duration=('trip_duration', 'mean')   # Average duration
-    )
-    .reset_index(drop=True)  # Reset index to avoid mismatches
-)
+    Returns:
+        generator: DataFrames of raw trips.
+    """
+    if trip_file.endswith('.parquet'):
+        if not chunksize:
+            yield _compact_read(add_location_ids(pd.read_parquet(trip_file, engine='pyarrow')))
+            return
+        for batch in pq.ParquetFile(trip_file).iter_batches(batch_size=chunksize):
+            yield _compact_read(add_location_ids(batch.to_pandas()))
+    elif chunksize:
+        for chunk in pd.read_csv(trip_file, chunksize=chunksize, dtype=read_dtypes):
+            yield add_location_ids(chunk)
+    else:
+        yield add_location_ids(pd.read_csv(trip_file, dtype=read_dtypes))
+
+
+def _compact_read(frame):
+    """Applies read_dtypes to trips read from Parquet."""
+    return frame.astype({column: dtype for column, dtype in read_dtypes.items() if column in frame})
+
+
+def add_location_ids(frame):
+    """
+    Replaces the coordinate_columns of trips without PULocationID or DOLocationID by the
+    LocationID of the zone they fall in. Trips with LocationIDs are returned as they are.
+    """
+    for id_column, (longitude, latitude) in coordinate_columns.items():
+        if id_column in frame or longitude not in frame or latitude not in frame:
+            continue
+        # Imported here, the zone index (and geopandas) is only needed for coordinates
+        from zone_assign import load_zone_index
+        with stage('assign_zones.' + id_column, len(frame)):
+            location_ids = load_zone_index().assign(frame[longitude], frame[latitude])
+            frame = frame.drop(columns=[longitude, latitude])
+            frame[id_column] = location_ids.astype(read_dtypes[id_column])
+    return frame
+
+
+def memory_report(frame):
+    """
+    Memory of every column with its compact type, next to the memory of the same values
+    as int64, float64 or Python strings (what pandas uses when no types are given).
 
+    Parameters:
+        frame (DataFrame): e.g. the cleaned trips.
+
+    Returns:
+        DataFrame: wide_dtype, wide_mb, dtype, mb and ratio per column, with a total row.
+    """
+    rows = {}
+    for column in frame:
+        values = frame[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            wide = values.astype(object)
+        elif pd.api.types.is_float_dtype(values):
+            wide = values.astype(np.float64)
+        elif pd.api.types.is_integer_dtype(values):
+            wide = values.astype(np.int64)
+        else:
+            wide = values
+        rows[column] = {
+            'wide_dtype': str(wide.dtype),
+            'wide_mb': wide.memory_usage(index=False, deep=True) / 2 ** 20,
+            'dtype': str(values.dtype),
+            'mb': values.memory_usage(index=False, deep=True) / 2 ** 20
+        }
+    report = pd.DataFrame.from_dict(rows, orient='index')
+    report.loc['total'] = ['', report['wide_mb'].sum(), '', report['mb'].sum()]
+    report['ratio'] = report['wide_mb'] / report['mb']
+    return report
+
+
+def run(path, format='csv', report=False):
+    """
+    Reads trips.csv in one go and writes the cleaned trips and the three aggregate tables.
+    With `report`, prints the memory used by each column of the cleaned trips.
+    """
+    with stage('run'):
+        with stage('read') as record:
+            lyft = next(read_trip_chunks(path+'trips.csv'))
+            record['rows_out'] = len(lyft)
+        rows, rejected = len(lyft), {}
+        with stage('clean_trips', len(lyft)) as record:
+            lyft = clean_trips(lyft, rejected)
+            record['rows_out'] = len(lyft)
+        print_rejections('trips.csv', rows, len(lyft), rejected)
+        with stage('add_od_means', len(lyft)):
+            lyft = add_od_means(lyft)
+        if report:
+            print(memory_report(lyft).round(2).to_string())
+        write_tables({'lyft_cleaned': label_od_pairs(lyft)}, path, format)
+
+        # Aggregating the data to get the number of trips from each start and to each end station
+        with stage('partial_aggregates', len(lyft)):
+            partials = partial_aggregates(lyft)
+
+        # Grouping and aggregating pickup and dropoff data
+        with stage('pickup_dropoff_stats', len(lyft)) as record:
+            stats = pickup_dropoff_stats(lyft)
+            record['rows_out'] = len(stats)
+        print(stats.head())
+
+        write_tables({
+            'pickup_cleaned': partials['pickup_cleaned'],
+            'dropoff_cleaned': partials['dropoff_cleaned'],
+            'pickup_dropoff_cleaned': stats,
+            'pickup_dropoff_sketch': compact_sketches(partials['pickup_dropoff_sketch'], pickup_dropoff_keys)
+        }, path, format)
+        with stage('write.od_matrix', len(partials['pickup_dropoff_cleaned'])):
+            write_od(partials['pickup_dropoff_cleaned'], path)
+
+        # A full run replaces whatever was ingested before
+        with stage('save_state'):
+            replace_state(path, partials)
+
+
+def read_trips(trip_file):
+    """Raw trips of a whole trip file (the load stage of `run_cached`)."""
+    return next(read_trip_chunks(trip_file))
+
+
+def clean_trip_file(lyft):
+    """Cleaned trips of a whole trip file, printing its rejections (the clean stage of `run_cached`)."""
+    rejected = {}
+    cleaned = clean_trips(lyft, rejected)
+    print_rejections('trips.csv', len(lyft), len(cleaned), rejected)
+    return cleaned
+
+
+def trip_od_means(lyft):
+    """Mean distance and duration of every pickup_dropoff key, see `finalize_od_means`."""
+    return finalize_od_means(partial_od_sums(lyft))
+
+
+def trip_counts(lyft, keys):
+    """Number of trips per group of `keys`, without empty groups."""
+    return finalize_counts(partial_counts(lyft, keys))
+
+
+def write_cleaned_trips(lyft, od_means, path, format='csv'):
+    """Writes lyft_cleaned from the cleaned trips and their pickup_dropoff means."""
+    write_table(label_od_pairs(add_od_means(lyft, od_means)), path, 'lyft_cleaned', format)
+
+
+def write_state(pickups, dropoffs, od_sums, sketches, path):
+    """Replaces the state by the partials of the stages of `run_cached`."""
+    replace_state(path, {
+        'pickup_cleaned': pickups,
+        'dropoff_cleaned': dropoffs,
+        'pickup_dropoff_cleaned': od_sums,
+        'pickup_dropoff_sketch': sketches
+    })
+
+
+def run_cached(path, format='csv', workers=1, force=False):
+    """
+    Same outputs as `run`, computed as a DAG of stages (see stage_dag.py) whose outputs
+    are cached in path+stage_cache_folder:
 
-# Drop rows with NaN values in any column
-pickup_dropoff_stats = pickup_dropoff_stats.dropna()
-pickup_dropoff_stats = pickup_dropoff_stats[pickup_dropoff_stats['trip_count'] > 0]
+        load -> clean -> od_means -> write.lyft_cleaned
+                      -> pickup_counts, dropoff_counts, od_sums, od_stats, sketches
+                         -> write of their table, od_matrix, state
+
+    A rerun only recomputes the stages whose code, parameters or inputs changed, and
+    skips the writes of the tables that are already up to date: with trips.csv and the
+    code unchanged, nothing is read or written. The calendar features are added by the
+    clean stage, the cleaning rules filtering on them.
+
+    Parameters:
+        path (str): Folder holding trips.csv and the cleaned outputs.
+        format (str): 'csv' or 'parquet'.
+        workers (int): Number of stages run at the same time (e.g. the aggregates).
+        force (bool): Recompute every stage.
+
+    Returns:
+        dict: Names of the stages 'run' and 'reused'.
+    """
+    trip_file = path + 'trips.csv'
+
+    def table_file(name):
+        return path + name + '.csv' if format == 'csv' else path + name
+
+    # Every stage lists in `depends` the helpers and modules it calls, so that editing one
+    # of them reruns it (the profiler stages only time them). zone_assign is given by
+    # name, geopandas being only imported for trip files with coordinates
+    dag = StageDAG(path + stage_cache_folder, workers)
+    dag.add('load', read_trips, params={'trip_file': trip_file}, sources=[trip_file],
+            config={'read_dtypes': read_dtypes, 'coordinate_columns': coordinate_columns},
+            depends=[read_trip_chunks, _compact_read, add_location_ids, 'zone_assign'])
+    # The calendar features and od_key are computed by clean_trips, the sketch buckets
+    # by the constants of quantile_sketch: their source is part of the stage keys
+    dag.add('clean', clean_trip_file, ['load'], config={'trip_dtypes': trip_dtypes, 'cleaning_rules': cleaning_rules,
+                                                        'od_key_bits': od_key_bits},
+            depends=[clean_trips, print_rejections, od_key, features])
+    dag.add('od_means', trip_od_means, ['clean'], output='array', config={'od_key_bits': od_key_bits},
+            depends=[partial_od_sums, finalize_od_means])
+    dag.add('pickup_counts', trip_counts, ['clean'], params={'keys': pickup_keys},
+            depends=[partial_counts, finalize_counts])
+    dag.add('dropoff_counts', trip_counts, ['clean'], params={'keys': dropoff_keys},
+            depends=[partial_counts, finalize_counts])
+    # Both only call pandas: their own source is all their key needs
+    dag.add('od_sums', partial_pickup_dropoff_stats, ['clean'], config={'keys': pickup_dropoff_keys})
+    dag.add('od_stats', pickup_dropoff_stats, ['clean'], config={'keys': pickup_dropoff_keys})
+    dag.add('sketches', partial_sketches, ['clean'], params={'keys': pickup_dropoff_keys}, depends=[quantile_sketch])
+
+    writes = {
+        'lyft_cleaned': ('write.lyft_cleaned', write_cleaned_trips, ['clean', 'od_means']),
+        'pickup_cleaned': ('write.pickup_cleaned', write_table, ['pickup_counts']),
+        'dropoff_cleaned': ('write.dropoff_cleaned', write_table, ['dropoff_counts']),
+        'pickup_dropoff_cleaned': ('write.pickup_dropoff_cleaned', write_table, ['od_stats']),
+        'pickup_dropoff_sketch': ('write.pickup_dropoff_sketch', write_sketches, ['sketches'])
+    }
+    for name, (stage_name, function, inputs) in writes.items():
+        params = {'path': path, 'format': format}
+        if function is write_table:
+            params['name'] = name
+        # The tables are partitioned by month (features.month_names) by storage
+        depends = [storage, features]
+        if function is write_cleaned_trips:
+            depends += [add_od_means, partial_od_sums, finalize_od_means, label_od_pairs]
+        if function is write_sketches:
+            depends += [quantile_sketch]
+        dag.add(stage_name, function, inputs, params=params, output=None, targets=[table_file(name)], depends=depends)
+    # The OD matrix is versioned by pickup_dropoff_cleaned, so it follows its changes too
+    dag.add('write.od_matrix', write_od, ['od_sums'], params={'path': path}, output=None,
+            targets=[path + od_folder, table_file('pickup_dropoff_cleaned')], after=['write.pickup_dropoff_cleaned'],
+            depends=[od_matrix, storage, query_cache, features])
+    dag.add('save_state', write_state, ['pickup_counts', 'dropoff_counts', 'od_sums', 'sketches'],
+            params={'path': path}, output=None, targets=[path + state_folder], sources=[trip_file],
+            depends=[replace_state, save_state, query_cache])
+
+    with stage('run_cached'):
+        stages = dag.run(force)
+    print('stages run: %s' % (', '.join(stages['run']) or 'none'))
+    print('stages reused: %s' % (', '.join(stages['reused']) or 'none'))
+    return stages
+
+
+def run_streaming(path, chunksize, format='csv'):
+    """
+    Same outputs as `run`, but reads trips.csv `chunksize` rows at a time.
 
-print(pickup_dropoff_stats.head())
+    The first pass folds every chunk into mergeable sums and counts for the three
+    aggregate tables and for the pickup_dropoff means. The second pass cleans the
+    chunks again and appends them to lyft_cleaned with the final means, so peak
+    memory depends on the chunk size and not on the file size.
+    """
+    pickups = dropoffs = stats = sketches = None
+    od_sums = 0
+    rows = trips = 0
+    rejected = {}
+    with stage('run_streaming'):
+        with stage('aggregate_pass'):
+            for chunk in profiled_chunks(read_trip_chunks(path+'trips.csv', chunksize)):
+                rows += len(chunk)
+                with stage('clean_trips', len(chunk)) as record:
+                    chunk = clean_trips(chunk, rejected)
+                    record['rows_out'] = len(chunk)
+                trips += len(chunk)
+                with stage('fold_partials', len(chunk)):
+                    od_sums = od_sums + partial_od_sums(chunk)
+                    pickups = fold_partials(pickups, partial_counts(chunk, pickup_keys), pickup_keys)
+                    dropoffs = fold_partials(dropoffs, partial_counts(chunk, dropoff_keys), dropoff_keys)
+                    stats = fold_partials(stats, partial_pickup_dropoff_stats(chunk), pickup_dropoff_keys, observed=True)
+                    sketches = fold_partials(sketches, partial_sketches(chunk, pickup_dropoff_keys),
+                                             *aggregate_keys['pickup_dropoff_sketch'])
+
+        print_rejections('trips.csv', rows, trips, rejected)
+        od_means = finalize_od_means(od_sums)
+        with stage('write_pass'):
+            chunks = profiled_chunks(read_trip_chunks(path+'trips.csv', chunksize))
+            for part, chunk in enumerate(chunks):
+                with stage('clean_trips', len(chunk)) as record:
+                    chunk = clean_trips(chunk)
+                    record['rows_out'] = len(chunk)
+                with stage('add_od_means', len(chunk)):
+                    chunk = add_od_means(chunk, od_means)
+                write_tables({'lyft_cleaned': label_od_pairs(chunk)}, path, format, part)
+
+        partials = {
+            'pickup_cleaned': finalize_counts(pickups),
+            'dropoff_cleaned': finalize_counts(dropoffs),
+            'pickup_dropoff_cleaned': stats,
+            'pickup_dropoff_sketch': sketches
+        }
+        write_aggregates(partials, path, format)
+
+        # A full run replaces whatever was ingested before
+        with stage('save_state'):
+            replace_state(path, partials)
+
+
+def ingest_partials(path, trip_file, fingerprint=None, chunksize=None, backend='pandas', threads=None):
+    """
+    Cleans and aggregates one trip file and keeps its partials in the state. Runs in
+    a worker process of `ingest_files`.
+
+    Parameters:
+        path (str): Folder holding the state.
+        trip_file (str): TLC trip file, CSV or Parquet.
+        fingerprint (str): Version of the trip file.
+        chunksize (int): Read the file this many rows at a time (whole when None, pandas only).
+        backend (str): 'pandas', or 'duckdb' to stream the file through DuckDB.
+        threads (int): DuckDB threads (all cores when None).
+
+    Returns:
+        dict: Source file, rows read, trips kept, rows rejected by reason, seconds spent
+        and worker process id.
+    """
+    start = time.perf_counter()
+    rows = trips = 0
+    partials = None
+    rejected = {}
+    if backend == 'duckdb':
+        # Imported here, DuckDB is only needed by this backend
+        from duckdb_backend import trip_partials
+        partials, rows, trips, rejected = trip_partials(trip_file, threads)
+    else:
+        for chunk in profiled_chunks(read_trip_chunks(trip_file, chunksize)):
+            rows += len(chunk)
+            with stage('clean_trips', len(chunk)) as record:
+                chunk = clean_trips(chunk, rejected)
+                record['rows_out'] = len(chunk)
+            trips += len(chunk)
+            with stage('fold_partials', len(chunk)):
+                partials = fold_aggregates(partials, partial_aggregates(chunk))
+    with stage('save_state'):
+        save_state(path, os.path.basename(trip_file), partials, fingerprint)
+    return {
+        'source': os.path.basename(trip_file),
+        'rows': rows,
+        'trips': trips,
+        'rejected': rejected,
+        'seconds': time.perf_counter() - start,
+        'worker': os.getpid()
+    }
+
+
+def print_throughput(results, seconds):
+    """Prints the files, rows and rows per second of every worker of `ingest_files`."""
+    workers = defaultdict(lambda: {'files': 0, 'rows': 0, 'seconds': 0.0})
+    for result in results:
+        worker = workers[result['worker']]
+        worker['files'] += 1
+        worker['rows'] += result['rows']
+        worker['seconds'] += result['seconds']
+    for pid, worker in sorted(workers.items()):
+        print('worker %d: %d files, %d rows in %.1f s (%.0f rows/s)' % (
+            pid, worker['files'], worker['rows'], worker['seconds'], worker['rows'] / max(worker['seconds'], 1e-9)))
+    rows = sum(result['rows'] for result in results)
+    print('total: %d files, %d rows in %.1f s (%.0f rows/s)' % (len(results), rows, seconds, rows / max(seconds, 1e-9)))
+
+
+def ingest_files(path, trip_files, format='csv', chunksize=None, workers=1, rebuild=False, backend='pandas'):
+    """
+    Adds trip files (typically newly published months) to the aggregate tables without
+    reading the files ingested before.
+
+    Each file is cleaned and aggregated on its own, over a pool of `workers` processes,
+    and its trip counts, distance/duration sums and sketches are kept in the state under
+    its name.
+    The partials of every ingested file are then folded and pickup_cleaned,
+    dropoff_cleaned and pickup_dropoff_cleaned are rewritten from them. Ingesting a
+    corrected version of a file replaces its earlier contribution; an unchanged file
+    is skipped. lyft_cleaned is left to full runs, since its per-trip pickup_dropoff
+    means depend on every month.
+
+    Parameters:
+        path (str): Folder holding the cleaned tables and the state.
+        trip_files (list): TLC trip files, CSV or Parquet.
+        format (str): 'csv' or 'parquet'.
+        chunksize (int): Read each file this many rows at a time (whole when None).
+        workers (int): Number of worker processes.
+        rebuild (bool): Forget every file ingested before, e.g. a previous full run.
+        backend (str): 'pandas', or 'duckdb' to clean and aggregate each file in one
+            multi-threaded full scan of all its columns (see duckdb_backend.py).
+    """
+    if rebuild:
+        shutil.rmtree(path + state_folder, ignore_errors=True)
+
+    sources = state_sources(path)
+    pending = []
+    for trip_file in trip_files:
+        fingerprint = file_fingerprint(trip_file)
+        if sources.get(os.path.basename(trip_file)) == fingerprint:
+            print('%s is already ingested, nothing to do.' % os.path.basename(trip_file))
+        else:
+            pending.append((trip_file, fingerprint))
+    if not pending:
+        return
+
+    with stage('ingest_files'):
+        start = time.perf_counter()
+        # Stages run in the worker processes are not seen by this process's profiler
+        with stage('ingest_partials', len(pending)):
+            if workers > 1 and len(pending) > 1:
+                workers = min(workers, len(pending))
+                # DuckDB threads are shared out between the worker processes
+                threads = max(1, (os.cpu_count() or 1) // workers) if backend == 'duckdb' else None
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(ingest_partials, path, trip_file, fingerprint, chunksize, backend, threads)
+                               for trip_file, fingerprint in pending]
+                    results = [future.result() for future in futures]
+            else:
+                results = [ingest_partials(path, trip_file, fingerprint, chunksize, backend)
+                           for trip_file, fingerprint in pending]
+        print_throughput(results, time.perf_counter() - start)
+        for result in results:
+            print_rejections(result['source'], result['rows'], result['trips'], result['rejected'])
+
+        with stage('load_state'):
+            partials = load_state(path)
+        write_aggregates(partials, path, format)
+
+
+def ingest(path, trip_file, format='csv', chunksize=None):
+    """Adds one trip file to the aggregate tables, see `ingest_files`."""
+    ingest_files(path, [trip_file], format, chunksize)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read and clean the TLC trip data.')
+    parser.add_argument('--path', default=path, help='Folder holding trips.csv and the cleaned outputs.')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='Stream trips.csv this many rows at a time instead of reading it whole.')
+    parser.add_argument('--format', choices=formats, default='csv',
+                        help='Write the cleaned tables as CSV files or as Parquet datasets partitioned by month.')
+    parser.add_argument('--ingest', nargs='+', metavar='TRIP_FILE',
+                        help='Add these trip files (e.g. a new month) to the existing aggregates instead of a full run.')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='Print the memory used by each column of the cleaned trips (whole-file runs).')
+    parser.add_argument('--cached', action='store_true',
+                        help='Run the whole-file pipeline as a DAG of stages cached in the data folder, '
+                             'only recomputing the stages whose inputs, parameters or code changed.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes the --ingest files are cleaned and aggregated by '
+                             '(with --cached, of independent stages run at the same time).')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='With --ingest, build the aggregates from the given files only '
+                             '(with --cached, recompute every stage).')
+    parser.add_argument('--profile', metavar='REPORT_JSON', default=None,
+                        help='Write the time, peak memory and rows of every stage to this JSON file '
+                             '(and flamegraph stacks to a .folded file next to it).')
+    parser.add_argument('--profile-hook', metavar='MODULE:FUNCTION', action='append', default=[],
+                        help='Call this function with the record of every finished stage, e.g. to forward it to monitoring.')
+    parser.add_argument('--backend', choices=backends, default='pandas',
+                        help='Engine the --ingest files are cleaned and aggregated with (pandas is the reference, '
+                             'duckdb does one multi-threaded full scan of each file; check them against each other '
+                             'with duckdb_backend.py).')
+    args = parser.parse_args()
+    if args.backend != 'pandas' and not args.ingest:
+        parser.error('--backend %s only applies to --ingest, full runs write lyft_cleaned with pandas' % args.backend)
+    if args.cached and (args.ingest or args.chunksize):
+        parser.error('--cached runs the whole-file pipeline, it does not apply to --ingest or --chunksize')
+
+    if args.profile:
+        profiler.enable()
+    for hook in args.profile_hook:
+        profiler.add_hook(load_hook(hook))
+
+    if args.ingest:
+        ingest_files(args.path, args.ingest, args.format, args.chunksize, args.workers, args.rebuild, args.backend)
+    elif args.chunksize:
+        run_streaming(args.path, args.chunksize, args.format)
+    elif args.cached:
+        run_cached(args.path, args.format, args.workers, args.rebuild)
+    else:
+        run(args.path, args.format, args.memory_report)
 
-pickup_dropoff_stats.to_csv(path_or_buf=path+'pickup_dropoff_cleaned.csv')
\ No newline at end of file
+    if args.profile:
+        profiler.write(args.profile)
@@ -0,0 +1,269 @@
+# Description:  Cleans and aggregates TLC trip files with DuckDB, as a lazy, multi-threaded alternative to the pandas code of data.py
+
+
+
+import argparse
+import math
+import os
+import sys
+
+import duckdb
+import numpy as np
+import pandas as pd
+
+from data import (clean_trips, cleaning_rules, dropoff_keys, key_dtypes, partial_aggregates,
+                  pickup_dropoff_keys, pickup_keys, read_trip_chunks, trip_dtypes)
+from features import period_codes, period_edges, period_order
+from profiler import stage
+from quantile_sketch import gamma, min_value, n_buckets, sketch_dtypes, sketch_metrics
+
+# Types of the aggregate columns returned by DuckDB, matching the pandas partials
+partial_dtypes = {
+    'PULocationID': trip_dtypes['PULocationID'],
+    'DOLocationID': trip_dtypes['DOLocationID'],
+    'trip_count': np.int64,
+    'trip_distance': trip_dtypes['trip_distance'],
+    'trip_duration': trip_dtypes['trip_duration'],
+    'bucket': sketch_dtypes['bucket']
+}
+
+# Bucket column grouped on for the sketch of every metric
+bucket_columns = {metric: metric.split('_')[1] + '_bucket' for metric in sketch_metrics}
+
+
+def period_sql(hour):
+    """SQL CASE giving the time period of an hour expression, from the period edges of features.py."""
+    cases = ' '.join("WHEN %s < %d THEN '%s'" % (hour, edge, period_order[code])
+                     for edge, code in zip(period_edges, period_codes))
+    return "CASE %s ELSE '%s' END" % (cases, period_order[period_codes[-1]])
+
+
+# SQL of the cleaned trip columns derived from the raw ones, named as in clean_trips
+derived_sql = {
+    'trip_duration': 'CAST((epoch_us(dropoff_time) - epoch_us(pickup_time)) / 60e6 AS DOUBLE)',
+    'month': 'monthname(pickup_time)',
+    'week': "'W' || lpad(CAST(week(pickup_time) AS VARCHAR), 2, '0')",
+    'day_pickup': 'dayname(pickup_time)',
+    'pickup_period': period_sql('hour(pickup_time)'),
+    'day_dropoff': 'dayname(dropoff_time)',
+    'dropoff_period': period_sql('hour(dropoff_time)')
+}
+
+
+def bucket_sql(column):
+    """SQL giving the sketch bucket of a column, as quantile_sketch.bucket_of does."""
+    # Computed in double precision, as numpy does, so values on a bucket bound agree
+    value = 'CAST(%s AS DOUBLE)' % column
+    return 'CASE WHEN %s >= %r THEN least(greatest(ceil(ln(%s / %r) / %r), 1), %d) ELSE 0 END' % (
+        value, min_value, value, min_value, math.log(gamma), n_buckets - 1)
+
+
+def scan_sql(trip_file):
+    """DuckDB table function reading a CSV or Parquet trip file."""
+    quoted = "'%s'" % trip_file.replace("'", "''")
+    if trip_file.endswith('.parquet'):
+        return 'read_parquet(%s)' % quoted
+    return 'read_csv(%s, header = true)' % quoted
+
+
+# SQL of the operators of cleaning_rules
+rule_operators_sql = {'==': '=', '<': '<'}
+
+
+def broken_sql(column, rule, value):
+    """SQL condition true for the trips that one entry of cleaning_rules rejects."""
+    value = "'%s'" % value if isinstance(value, str) else repr(value)
+    return '(%s %s %s)' % (derived_sql.get(column, column), rule_operators_sql[rule], value)
+
+
+def cleaned_trips_sql(trip_file, file_columns):
+    """
+    Query of every trip of a file, with the cleaned values of clean_trips, whether it is
+    complete, which cleaning_rules it breaks (broken_<rule>) and whether clean_trips
+    keeps it (kept), so that the rows read, the trips kept and the rows rejected by each
+    rule are counted in the same scan as the aggregates.
+
+    The null check covers every column of the file, as the missing_values stage does,
+    so all columns are read; the other columns are dropped right after the scan.
+
+    Parameters:
+        trip_file (str): TLC trip file, CSV or Parquet.
+        file_columns (list): Names of the columns of the file.
+    """
+    # Rules on the raw columns are checked in the scan, those on derived columns after it
+    raw_flags = ''.join(',\n                coalesce(%s, false) AS broken_%s' % (broken_sql(column, rule, value), name)
+                        for name, column, rule, value in cleaning_rules if column not in derived_sql)
+    derived_flags = ''.join(',\n                coalesce(%s, false) AS broken_%s' % (broken_sql(column, rule, value), name)
+                            for name, column, rule, value in cleaning_rules if column in derived_sql)
+    complete = ' AND '.join('"%s" IS NOT NULL' % column.replace('"', '""') for column in file_columns)
+    columns = ''.join(',\n                %s AS %s' % (sql, column) for column, sql in derived_sql.items())
+    broken = ' OR '.join('broken_%s' % name for name, _, _, _ in cleaning_rules)
+    return """
+        WITH raw AS (
+            SELECT
+                CAST(tpep_pickup_datetime AS TIMESTAMP) AS pickup_time,
+                CAST(tpep_dropoff_datetime AS TIMESTAMP) AS dropoff_time,
+                CAST(PULocationID AS USMALLINT) AS PULocationID,
+                CAST(DOLocationID AS USMALLINT) AS DOLocationID,
+                CAST(trip_distance AS DOUBLE) AS trip_distance,
+                coalesce(%s, false) AS complete%s
+            FROM %s
+        ), trips AS (
+            SELECT
+                * EXCLUDE (pickup_time, dropoff_time)%s%s
+            FROM raw
+        )
+        SELECT *, complete AND NOT (%s) AS kept
+        FROM trips
+    """ % (complete, raw_flags, scan_sql(trip_file), columns, derived_flags, broken)
+
+
+# Columns of the grouping sets, in the order of the GROUPING() bits
+grouping_columns = ['PULocationID', 'DOLocationID', 'month', 'day_pickup', 'pickup_period', 'day_dropoff', 'dropoff_period',
+                    *bucket_columns.values()]
+
+
+def grouping_id(keys):
+    """Value of GROUPING(grouping_columns) for the rows of the grouping set `keys` (bit set = not grouped)."""
+    return sum(1 << (len(grouping_columns) - 1 - i) for i, column in enumerate(grouping_columns) if column not in keys)
+
+
+def connect(threads=None):
+    """In-memory DuckDB connection, using `threads` threads (all cores when None)."""
+    config = {} if threads is None else {'threads': threads}
+    return duckdb.connect(config=config)
+
+
+def _partial(frame, keys):
+    """Casts a DuckDB aggregate to the types of the pandas partials and sorts it like groupby does."""
+    frame = frame.astype({column: dtype for column, dtype in partial_dtypes.items() if column in frame})
+    frame = frame.astype({column: dtype for column, dtype in key_dtypes.items() if column in keys})
+    return frame.sort_values(keys).reset_index(drop=True)
+
+
+def trip_partials(trip_file, threads=None):
+    """
+    Partial aggregates of one trip file, the same tables as `data.partial_aggregates`
+    of its cleaned trips (quantile sketches included), and the number of rows read,
+    computed in one scan of the file.
+
+    The cleaned trips are never materialized: DuckDB streams the file through the group
+    by over its threads, and spills to disk if the groups outgrow memory. This is a full
+    scan with nothing pushed down: every column is read, for the null check to match
+    clean_trips, and every row reaches the group by, where the cleaning rules are
+    FILTER clauses so that the rejections of each rule are counted in the same pass.
+
+    Parameters:
+        trip_file (str): TLC trip file, CSV or Parquet.
+        threads (int): DuckDB threads (all cores when None).
+
+    Returns:
+        tuple: The partials (dict by table name), the number of rows read, the number
+        of trips kept and the rows rejected by reason, as counted by clean_trips.
+    """
+    connection = connect(threads)
+    # Only the header (or the Parquet schema) and a sample of the rows are read
+    file_columns = [row[0] for row in connection.execute('DESCRIBE SELECT * FROM %s' % scan_sql(trip_file)).fetchall()]
+    with stage('duckdb.aggregate') as record:
+        # Pickup and pickup_dropoff groups come from the pickup_dropoff grouping set, the
+        # sketches from that set with each bucket column, dropoff groups from the dropoff
+        # set, and the empty set counts the rows read, the trips kept and the rows
+        # rejected by reason. Groups of rejected trips only are dropped
+        reasons = ['missing_values'] + [name for name, _, _, _ in cleaning_rules]
+        rejections = ''.join(',\n                count(*) FILTER (WHERE %s) AS rejected_%s' % (
+            'NOT complete' if name == 'missing_values' else 'complete AND broken_' + name, name) for name in reasons)
+        sketch_sets = ''.join(', (%s, %s)' % (', '.join(pickup_dropoff_keys), column) for column in bucket_columns.values())
+        buckets = ''.join(', %s AS %s' % (bucket_sql(metric), column) for metric, column in bucket_columns.items())
+        groups = connection.execute("""
+            SELECT
+                GROUPING(%s) AS grouping_id,
+                %s,
+                count(*) FILTER (WHERE kept) AS trip_count,
+                sum(trip_distance) FILTER (WHERE kept) AS trip_distance,
+                sum(trip_duration) FILTER (WHERE kept) AS trip_duration,
+                count(*) AS rows_read%s
+            FROM (SELECT *%s FROM (%s))
+            GROUP BY GROUPING SETS ((%s), (%s)%s, ())
+            HAVING count(*) FILTER (WHERE kept) > 0 OR GROUPING(%s) = %d
+        """ % (', '.join(grouping_columns), ', '.join(grouping_columns), rejections, buckets, cleaned_trips_sql(trip_file, file_columns),
+               ', '.join(pickup_dropoff_keys), ', '.join(dropoff_keys), sketch_sets,
+               ', '.join(grouping_columns), grouping_id([]))).df()
+        record['rows_out'] = len(groups)
+    connection.close()
+
+    pairs = groups[groups['grouping_id'] == grouping_id(pickup_dropoff_keys)][pickup_dropoff_keys + ['trip_count', 'trip_distance', 'trip_duration']]
+    dropoffs = groups[groups['grouping_id'] == grouping_id(dropoff_keys)][dropoff_keys + ['trip_count']]
+    total = groups[groups['grouping_id'] == grouping_id([])]
+    rows, trips = int(total['rows_read'].sum()), int(total['trip_count'].sum())
+    rejected = {name: int(total['rejected_' + name].sum()) for name in reasons}
+    pickups = pairs.groupby(pickup_keys, as_index=False, sort=False)['trip_count'].sum()
+    sketches = pd.concat([
+        groups[groups['grouping_id'] == grouping_id(pickup_dropoff_keys + [column])][pickup_dropoff_keys + [column, 'trip_count']]
+        .rename(columns={column: 'bucket'})
+        .assign(metric=metric)
+        for metric, column in bucket_columns.items()
+    ])
+    partials = {
+        'pickup_cleaned': _partial(pickups, pickup_keys),
+        'dropoff_cleaned': _partial(dropoffs, dropoff_keys),
+        'pickup_dropoff_cleaned': _partial(pairs, pickup_dropoff_keys),
+        'pickup_dropoff_sketch': _partial(sketches[pickup_dropoff_keys + ['metric', 'bucket', 'trip_count']],
+                                          pickup_dropoff_keys + ['metric', 'bucket'])
+    }
+    return partials, rows, trips, rejected
+
+
+def compare_partials(expected, actual, rtol=1e-9):
+    """
+    Differences between two sets of partial aggregates. Group keys and trip counts must
+    be identical; the distance and duration sums may differ by summation order.
+
+    Returns:
+        list: One message per table that differs (empty when they match).
+    """
+    differences = []
+    for name, frame in expected.items():
+        keys = [column for column in frame if column in key_dtypes]
+        left = frame.astype({column: key_dtypes[column] for column in keys}).sort_values(keys).reset_index(drop=True)
+        right = actual[name].astype({column: key_dtypes[column] for column in keys}).sort_values(keys).reset_index(drop=True)
+        try:
+            pd.testing.assert_frame_equal(left[keys + ['trip_count']], right[keys + ['trip_count']], check_dtype=False)
+            pd.testing.assert_frame_equal(left, right, check_dtype=False, check_exact=False, rtol=rtol)
+        except AssertionError as error:
+            differences.append('%s: %s' % (name, error))
+    return differences
+
+
+def check_backends(trip_file, threads=None):
+    """
+    Aggregates a trip file with pandas (the reference) and with DuckDB and compares them.
+
+    Returns:
+        list: Differences, see `compare_partials`.
+    """
+    rejected = {}
+    lyft = clean_trips(next(read_trip_chunks(trip_file)), rejected)
+    expected = partial_aggregates(lyft)
+    actual, rows, trips, actual_rejected = trip_partials(trip_file, threads)
+    differences = compare_partials(expected, actual)
+    if trips != len(lyft):
+        differences.append('trips kept: pandas %d, duckdb %d' % (len(lyft), trips))
+    if actual_rejected != rejected:
+        differences.append('rows rejected: pandas %s, duckdb %s' % (rejected, actual_rejected))
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that DuckDB and pandas aggregate TLC trip files identically.')
+    parser.add_argument('trip_files', nargs='+', metavar='TRIP_FILE', help='TLC trip files, CSV or Parquet.')
+    parser.add_argument('--threads', type=int, default=None, help='DuckDB threads (all cores by default).')
+    args = parser.parse_args()
+
+    failed = False
+    for trip_file in args.trip_files:
+        differences = check_backends(trip_file, args.threads)
+        print('%s: %s' % (os.path.basename(trip_file), 'OK' if not differences else 'DIFFERENT'))
+        for difference in differences:
+            print('  ' + difference)
+        failed = failed or bool(differences)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,99 @@
+# Description:  Vectorized calendar and time period features for the trip timestamps
+
+
+
+from bisect import bisect_right
+
+import numpy as np
+import pandas as pd
+
+month_names = ['January', 'February', 'March', 'April', 'May', 'June',
+               'July', 'August', 'September', 'October', 'November', 'December']
+day_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+period_order = ['night_time', 'am_rush', 'day_time', 'pm_rush']
+week_order = ['W%02d' % week for week in range(1, 54)]
+
+# Hours at which a new time period starts, and the period (index in period_order)
+# of each of the bins they delimit: [0, 6) [6, 10) [10, 16) [16, 19) [19, 24)
+period_edges = np.array([6, 10, 16, 19])
+period_codes = np.array([0, 1, 2, 3, 0], dtype=np.int8)
+
+_ns_per_hour = 3_600_000_000_000
+
+
+# Define a function to check if a given time is during rush hour
+def get_time_period(time):
+    """
+    Divides the day into four time periods based on the hour of the day.
+
+    Parameters:
+        time (datetime): Any object with an `hour` attribute (0-23).
+
+    Returns:
+        str: The time period (am_rush, day_time, pm_rush, night_time).
+    """
+    return period_order[period_codes[bisect_right(period_edges, time.hour)]]
+
+
+def time_period(hours):
+    """
+    Vectorized `get_time_period` over an array of hours.
+
+    Parameters:
+        hours (array-like): Hours in 24-hour format (0-23), -1 for missing.
+
+    Returns:
+        Categorical: The ordered time period of every hour.
+    """
+    hours = np.asarray(hours)
+    codes = period_codes[np.searchsorted(period_edges, hours, side='right')]
+    codes = np.where(hours < 0, -1, codes)
+    return pd.Categorical.from_codes(codes, categories=period_order, ordered=True)
+
+
+def calendar_features(timestamps, months=month_names):
+    """
+    Calendar attributes of every timestamp, computed once per distinct date.
+
+    The attributes are derived for each day between the first and last date only and
+    broadcast back to the rows by integer lookup, so no per-row strings are built.
+
+    Parameters:
+        timestamps (Series): datetime64 values.
+        months (list): Month categories; other months become NaN, like pd.Categorical does.
+
+    Returns:
+        DataFrame: hour, day, month, year, weekday, week and period columns aligned on
+        `timestamps`, with day, month, week and period as ordered categoricals.
+    """
+    values = timestamps.to_numpy(dtype='datetime64[ns]')
+    missing = np.isnat(values)
+    ticks = values.view(np.int64)
+    hours = np.where(missing, -1, ticks // _ns_per_hour % 24)
+
+    days = values.astype('datetime64[D]').view(np.int64)
+    first = days[~missing].min() if (~missing).any() else 0
+    offsets = np.where(missing, 0, days - first)
+    dates = pd.DatetimeIndex(np.arange(first, first + offsets.max(initial=0) + 1).astype('datetime64[D]'))
+
+    # One entry per date, looked up by each row's offset from the first date
+    weekday = dates.weekday.to_numpy()
+    month_codes = np.full(13, -1)
+    for code, name in enumerate(months):
+        month_codes[month_names.index(name) + 1] = code
+    month = month_codes[dates.month.to_numpy()]
+    week = dates.isocalendar().week.to_numpy(dtype=np.int64) - 1
+    year = dates.year.to_numpy()
+
+    def lookup(table):
+        return np.where(missing, -1, table[offsets])
+
+    return pd.DataFrame({
+        'hour': hours,
+        'day': pd.Categorical.from_codes(lookup(weekday), categories=day_order, ordered=True),
+        'month': pd.Categorical.from_codes(lookup(month), categories=months, ordered=True),
+        'year': lookup(year),
+        'weekday': lookup(weekday),
+        'week': pd.Categorical.from_codes(lookup(week), categories=week_order, ordered=True),
+        'period': time_period(hours),
+    }, index=timestamps.index)
@@ -2,109 +2,162 @@ import streamlit as st
 from streamlit_folium import st_folium
 import folium
 import altair as alt
+import numpy as np
 import pandas as pd
-import geopandas as gpd
 import zipfile
-import requests
-import io
 import os
 
+from artifacts import ArtifactStore
+from client_map import client_map_html, rows_data
+from od_cubes import build_od_cubes, filter_and_aggregate, load_zone_dimension, od_columns, sketch_columns, zone_ids
+from quantile_sketch import quantiles
+from query_cache import file_fingerprint, get_query_cache
+from storage import detect_format, read_table, table_months, table_path
+from zone_layer import choropleth_map, load_zone_layer, load_zone_topology
+
 # Load the datasets
-# URL of the zip file on GitHub 
-zip_file_url = "https://raw.githubusercontent.com/aminrad404/tlc_nyc/main/pickup+dopoff_cleaned.zip"
-# Download the zip file
-response = requests.get(zip_file_url)
-if response.status_code == 200:
-    # Open the zip file
-    with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
+# Where the zip file and the shapefiles come from: GitHub by default, or a local folder or a
+# local HTTP server standing in for it (e.g. TLC_ARTIFACT_SOURCE=./mirror TLC_OFFLINE=1)
+artifact_source = os.environ.get('TLC_ARTIFACT_SOURCE', "https://raw.githubusercontent.com/aminrad404/tlc_nyc/main/")
+# Never touch the network, start from the local folder or from what is already cached
+offline = os.environ.get('TLC_OFFLINE', '') not in ('', '0')
+# Downloaded files are kept here under their content hash and revalidated with ETag/If-Modified-Since
+artifact_cache_dir = "artifact_cache"
+zip_file_name = "pickup+dopoff_cleaned.zip"
+shapefile_names = ["taxi_zones.shp", "taxi_zones.shx", "taxi_zones.dbf", "taxi_zones.prj"]
+# Send the trips and the zone geometry to the browser once and filter there, instead of
+# rerunning the app on every filter change (e.g. TLC_CLIENT_SIDE=1)
+client_side = os.environ.get('TLC_CLIENT_SIDE', '') not in ('', '0')
+# Folder holding a Parquet pickup_dropoff_cleaned dataset (data.py --format parquet), read instead of the zip when present
+data_path = ""
+
+# Number of filter_and_aggregate results kept in memory for all sessions
+query_cache_size = 256
+
+# Columns of pickup_dropoff_cleaned used by this app
+csv_columns = od_columns
+
+
+@st.cache_resource
+def get_artifact_store():
+    """Local cache of the downloaded files, shared by all sessions."""
+    return ArtifactStore(artifact_cache_dir, artifact_source, offline=offline)
+
+
+def data_version():
+    """
+    Version of the tables this app reads: the fingerprint of the Parquet datasets, or the
+    content-addressed copy of the zip file. The cached loaders and cubes take it, so that
+    tables rewritten by data.py are read again without restarting the app.
+    """
+    if detect_format(data_path, 'pickup_dropoff_cleaned') == 'parquet':
+        return file_fingerprint(table_path(data_path, 'pickup_dropoff_cleaned'),
+                                table_path(data_path, 'pickup_dropoff_sketch'))
+    return get_artifact_store().fetch(zip_file_name)
+
+
+@st.cache_data
+def download_pickup_dropoff(zip_path):
+    """Reads the columns used by this app from the zipped pickup_dropoff_cleaned.csv."""
+    # Open the cached copy of the zip file
+    with zipfile.ZipFile(zip_path) as zip_ref:
         # Extract and read the CSV file
-        with zip_ref.open('pickup_dropoff_cleaned.csv') as file: 
-            csv_data = pd.read_csv(file)
-            
-# Define the raw URLs of the shapefiles
-shapefiles = {
-    "shp": "https://raw.githubusercontent.com/aminrad404/tlc_nyc/main/taxi_zones.shp",
-    "shx": "https://raw.githubusercontent.com/aminrad404/tlc_nyc/main/taxi_zones.shx",
-    "dbf": "https://raw.githubusercontent.com/aminrad404/tlc_nyc/main/taxi_zones.dbf",
-}
-
-# Create a temporary directory to store the files
+        with zip_ref.open('pickup_dropoff_cleaned.csv') as file:
+            return pd.read_csv(file, usecols=csv_columns)
+
+
+@st.cache_data
+def load_pickup_dropoff(month, version):
+    """
+    Reads pickup_dropoff_cleaned for one month (or 'All'). From a Parquet dataset only the
+    used columns of that month's partition are read; the zipped CSV is filtered after the read.
+    """
+    if detect_format(data_path, 'pickup_dropoff_cleaned') == 'parquet':
+        return read_table(data_path, 'pickup_dropoff_cleaned', columns=csv_columns,
+                          month=None if month == 'All' else month)
+
+    csv_data = download_pickup_dropoff(get_artifact_store().fetch(zip_file_name))
+    if month != 'All':
+        csv_data = csv_data[csv_data['month'] == month]
+    return csv_data
+
+
+@st.cache_data
+def load_sketches(month, version):
+    """
+    Reads the distance and duration sketches of pickup_dropoff_sketch for one month (or 'All'),
+    written by data.py next to the Parquet pickup_dropoff_cleaned. None when the trips are
+    read from the zip file, which only holds the means.
+    """
+    if detect_format(data_path, 'pickup_dropoff_cleaned') != 'parquet' or \
+            not os.path.exists(table_path(data_path, 'pickup_dropoff_sketch')):
+        return None
+    return read_table(data_path, 'pickup_dropoff_sketch', columns=sketch_columns,
+                      month=None if month == 'All' else month)
+
+
+@st.cache_data
+def load_months(version):
+    """Months available in pickup_dropoff_cleaned."""
+    if detect_format(data_path, 'pickup_dropoff_cleaned') == 'parquet':
+        return table_months(data_path, 'pickup_dropoff_cleaned')
+    return list(download_pickup_dropoff(get_artifact_store().fetch(zip_file_name))['month'].dropna().unique())
+
+
+# Directory the shapefile parts are placed in side by side
 temp_dir = "temp_shapefiles"
-os.makedirs(temp_dir, exist_ok=True)
 
-# Download each file
-for ext, url in shapefiles.items():
-    response = requests.get(url)
-    if response.status_code == 200:
-        with open(os.path.join(temp_dir, f"taxi_zones.{ext}"), "wb") as file:
-            file.write(response.content)
-    else:
-        print(f"Failed to download {ext} file.")
 
-# Load the shapefile into Geopandas
-shapefile_path = os.path.join(temp_dir, "taxi_zones.shp")
-gdf = gpd.read_file(shapefile_path)
+@st.cache_resource
+def fetch_shapefile():
+    """Fetches the parts of the shapefile concurrently, once per process, and returns the .shp path."""
+    return get_artifact_store().materialize(shapefile_names, temp_dir)["taxi_zones.shp"]
 
 
-# Ensure correct data types for merging
-csv_data['PULocationID'] = csv_data['PULocationID'].astype(int)
-csv_data['DOLocationID'] = csv_data['DOLocationID'].astype(int)
-shapefile['LocationID'] = shapefile['LocationID'].astype(int)
-
-# Merge for pickup locations
-pickup_gdf = csv_data.merge(
-    shapefile[['LocationID', 'zone', 'borough']],
-    left_on='PULocationID',
-    right_on='LocationID',
-    how='left'
-).rename(columns={
-    'zone': 'pickup_zone',
-    'borough': 'pickup_borough'
-}).drop(columns=['LocationID'])
-
-# Merge for dropoff locations
-dropoff_gdf = pickup_gdf.merge(
-    shapefile[['LocationID', 'zone', 'borough', 'geometry']],
-    left_on='DOLocationID',
-    right_on='LocationID',
-    how='left'
-).rename(columns={
-    'zone': 'dropoff_zone',
-    'borough': 'dropoff_borough',
-    'geometry': 'dropoff_geometry'
-}).drop(columns=['LocationID'])
-
-# Convert to GeoDataFrame for folium mapping
-gdf = gpd.GeoDataFrame(
-    dropoff_gdf,
-    geometry='dropoff_geometry',
-    crs=shapefile.crs
-)
+@st.cache_resource
+def load_zones(shapefile_path):
+    """Zone dimension (see od_cubes.load_zone_dimension), read once per process."""
+    return load_zone_dimension(shapefile_path)
 
-# Ensure geometry for pickup is retained if needed
-pickup_geometry = shapefile[['LocationID', 'geometry']].rename(columns={'geometry': 'pickup_geometry'})
-gdf = gdf.merge(
-    pickup_geometry,
-    left_on='PULocationID',
-    right_on='LocationID',
-    how='left'
-).drop(columns=['LocationID'])
-
-# Final GeoDataFrame for mapping
-gdf = gpd.GeoDataFrame(
-    gdf,
-    geometry='dropoff_geometry',  # Set dropoff as the main geometry
-    crs=shapefile.crs
-)
 
-# Sidebar Filters
-st.sidebar.title("Filter Parameters")
-# Clean and prepare unique values for dropdowns
-gdf['pickup_zone'] = gdf['pickup_zone'].fillna('Unknown').astype(str)
-gdf['dropoff_zone'] = gdf['dropoff_zone'].fillna('Unknown').astype(str)
+@st.cache_data
+def get_client_dashboard(data):
+    """
+    Page of the client-side mode: the pickup_dropoff rows of every month and the simplified
+    zone geometry, with the filters, the map and the top 5 table in JavaScript.
+    """
+    zones = load_zones(fetch_shapefile())
+    n_zones = int(max(data['PULocationID'].max(), data['DOLocationID'].max())) + 1
+
+    # LocationIDs of every zone name, as in load_cubes
+    zone_filters = [
+        {'column': column, 'ids': {name: ids.tolist() for name, ids in zone_ids(zones, data[column]).items()}}
+        for column in ['PULocationID', 'DOLocationID']
+    ]
+
+    dims = [
+        ('month', sorted(data['month'].dropna().unique(), key=lambda x: correct_month_order.index(x))),
+        ('day_pickup', sorted(data['day_pickup'].dropna().unique(), key=lambda x: correct_day_order.index(x))),
+        ('pickup_period', sorted(data['pickup_period'].dropna().unique(), key=lambda x: correct_time_order.index(x)))
+    ]
+    metrics = {'trip_count': np.uint32, 'avg_trip_duration': np.float32, 'avg_trip_distance': np.float32}
+    return client_map_html(
+        load_zone_topology(fetch_shapefile()),
+        rows_data(data, dims, ['PULocationID', 'DOLocationID'], metrics, n_zones),
+        controls=[('Month', ('dim', 0)), ('Pickup Location', ('zone', 0)), ('Dropoff Location', ('zone', 1)),
+                  ('Day', ('dim', 1)), ('Time Period', ('dim', 2))],
+        value='trip_count',
+        caption='Number of Trips',
+        palette='viridis',
+        tooltip=[('LocationID', 'Location ID'), ('zone', 'Zone:'), ('trip_count', 'Number of Trips:'), ('borough', 'Borough:')],
+        table={'title': 'Top 5 Zones by Trips', 'top_n': 5, 'columns': [
+            ('Location ID', 'LocationID'), ('Zone', 'zone'), ('Borough', 'borough'), ('Number of Trips', 'trip_count'),
+            ('Avg Duration (min)', 'avg_trip_duration'), ('Avg Distance (miles)', 'avg_trip_distance')]},
+        zone_filters=zone_filters,
+        averages={'avg_trip_duration': 0, 'avg_trip_distance': 2},
+        highlight=0
+    )
 
-pickup_location = st.sidebar.selectbox('Pickup Location', ['All'] + sorted(list(gdf['pickup_zone'].unique())))
-dropoff_location = st.sidebar.selectbox('Dropoff Location', ['All'] + sorted(list(gdf['dropoff_zone'].unique())))
 
 # Define the correct order for months, days, and time periods
 correct_month_order = ['January', 'February', 'March', 'April', 'May', 'June',
@@ -112,81 +165,78 @@ correct_month_order = ['January', 'February', 'March', 'April', 'May', 'June',
 correct_day_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 correct_time_order = ['night_time', 'am_rush', 'day_time', 'pm_rush']
 
-# Sort unique values based on the defined order
-sorted_months = sorted(gdf['month'].dropna().unique(), key=lambda x: correct_month_order.index(x))
-sorted_days = sorted(gdf['day_pickup'].dropna().unique(), key=lambda x: correct_day_order.index(x))
-sorted_time_order = sorted(gdf['pickup_period'].dropna().unique(), key=lambda x: correct_time_order.index(x))
+# In the client-side mode the trips of every month are sent to the browser with the page,
+# and the script only runs again when the page is reopened
+if client_side:
+    st.title("Taxi Trip Choropleth Map")
+    st.iframe(get_client_dashboard(load_pickup_dropoff('All', data_version())), height=1100)
+    st.stop()
 
+# Sidebar Filters
+st.sidebar.title("Filter Parameters")
+# The location filters are filled in once the month's trips are loaded
+location_filters = st.sidebar.container()
+
+version = data_version()
+sorted_months = sorted(load_months(version), key=lambda x: correct_month_order.index(x))
 month = st.sidebar.selectbox('Month', ['All'] + sorted_months)
+
+csv_data = load_pickup_dropoff(month, version)
+
+# Load the zone dimension
+shapefile_path = fetch_shapefile()
+zones = load_zones(shapefile_path)
+
+
+@st.cache_resource
+def get_zone_layer(shapefile_path):
+    """Simplified zone geometry, built once per process (and cached on disk as TopoJSON)."""
+    return load_zone_layer(shapefile_path)
+
+
+zone_layer = get_zone_layer(shapefile_path)
+
+
+# The trip facts keep the LocationIDs only, zone names and geometry are joined after aggregation
+csv_data['PULocationID'] = csv_data['PULocationID'].astype(int)
+csv_data['DOLocationID'] = csv_data['DOLocationID'].astype(int)
+
+pickup_location = location_filters.selectbox('Pickup Location', ['All'] + sorted(zone_ids(zones, csv_data['PULocationID'])))
+dropoff_location = location_filters.selectbox('Dropoff Location', ['All'] + sorted(zone_ids(zones, csv_data['DOLocationID'])))
+
+# Sort unique values based on the defined order
+sorted_days = sorted(csv_data['day_pickup'].dropna().unique(), key=lambda x: correct_day_order.index(x))
+sorted_time_order = sorted(csv_data['pickup_period'].dropna().unique(), key=lambda x: correct_time_order.index(x))
+
 day = st.sidebar.selectbox('Day', ['All'] + sorted_days)
 time_period = st.sidebar.selectbox('Time Period', ['All'] + sorted_time_order)
 
 
-# Filter and Aggregate Data
-@st.cache_data
-@st.cache_data
-def filter_and_aggregate(_data, month, day, time_period, pickup_location, dropoff_location):
-    filtered_data = _data.copy()
+@st.cache_resource
+def load_cubes(_data, month, _zones, _sketches, version):
+    """
+    Cubes behind filter_and_aggregate (see od_cubes.build_od_cubes) for the trips and
+    sketches of one month (or 'All'), built once per process, month and data version.
+    """
+    return build_od_cubes(_data, _zones, _sketches)
 
-    # Apply filters for pickup and dropoff locations
-    if pickup_location != 'All':
-        filtered_data = filtered_data[filtered_data['pickup_zone'] == pickup_location]
-    if dropoff_location != 'All':
-        filtered_data = filtered_data[filtered_data['dropoff_zone'] == dropoff_location]
 
-    # Apply filters for month, day, and time period
-    if month != 'All':
-        filtered_data = filtered_data[filtered_data['month'] == month]
-    if day != 'All':
-        filtered_data = filtered_data[filtered_data['day_pickup'] == day]
-    if time_period != 'All':
-        filtered_data = filtered_data[filtered_data['pickup_period'] == time_period]
-
-    # Aggregate by Pickup or Dropoff LocationID
-    if pickup_location == 'All':
-        aggregated_data = filtered_data.groupby('PULocationID').agg({
-            'pickup_zone': 'first',
-            'pickup_borough': 'first',
-            'trip_count': 'sum',
-            'avg_trip_duration': lambda x: round(x.mean(), 0),
-            'avg_trip_distance': lambda x: round(x.mean(), 2),
-            'pickup_geometry': 'first'  # Ensure geometry is retained
-        }).reset_index()
-        aggregated_data.rename(columns={
-            'PULocationID': 'LocationID',
-            'pickup_zone': 'zone',
-            'pickup_borough': 'borough',
-            'pickup_geometry': 'geometry'  # Rename geometry column
-        }, inplace=True)
-    else:
-        aggregated_data = filtered_data.groupby('DOLocationID').agg({
-            'dropoff_zone': 'first',
-            'dropoff_borough': 'first',
-            'trip_count': 'sum',
-            'avg_trip_duration': lambda x: round(x.mean(), 0),
-            'avg_trip_distance': lambda x: round(x.mean(), 2),
-            'dropoff_geometry': 'first'  # Ensure geometry is retained
-        }).reset_index()
-        aggregated_data.rename(columns={
-            'DOLocationID': 'LocationID',
-            'dropoff_zone': 'zone',
-            'dropoff_borough': 'borough',
-            'dropoff_geometry': 'geometry'  # Rename geometry column
-        }, inplace=True)
-
-    # Convert to GeoDataFrame
-    aggregated_data = gpd.GeoDataFrame(aggregated_data, geometry='geometry', crs=_data.crs)
-    return aggregated_data
-
-
-
-aggregated_data = filter_and_aggregate(
-    gdf,
-    month,
-    day,
-    time_period,
-    pickup_location,
-    dropoff_location
+cubes = load_cubes(csv_data, month, zones, load_sketches(month, version), version)
+
+
+# Results are shared by all sessions and keyed on the version of the loaded trips
+aggregated_data = get_query_cache('final_dashboard', query_cache_size).get(
+    cubes['version'],
+    (month, day, time_period, pickup_location, dropoff_location),
+    lambda: filter_and_aggregate(
+        cubes,
+        zones,
+        month,
+        day,
+        time_period,
+        pickup_location,
+        dropoff_location
+    )
 )
 
 if aggregated_data.empty:
@@ -221,6 +271,17 @@ st.sidebar.table(
     top_5_table[['Location ID', 'Zone', 'Borough', 'Number of Trips', 'Avg Duration (min)', 'Avg Distance (miles)']]
 )
 
+# Percentiles of the same zones' trips, when the sketches were loaded
+if cubes['sketches'] is not None:
+    st.sidebar.title("Trip Percentiles of the Top 5 Zones")
+    percentile_table = pd.DataFrame({'Zone': top_5_zones['zone']})
+    names = ' / '.join(quantiles)
+    percentile_table['Duration %s (min)' % names] = top_5_zones[['%s_trip_duration' % name for name in quantiles]].apply(
+        lambda row: ' / '.join('%d' % value for value in row), axis=1)
+    percentile_table['Distance %s (miles)' % names] = top_5_zones[['%s_trip_distance' % name for name in quantiles]].apply(
+        lambda row: ' / '.join('%.2f' % value for value in row), axis=1)
+    st.sidebar.table(percentile_table)
+
 
 # Bar Chart for Top 5 Zones
 bar_chart = alt.Chart(top_5_table).mark_bar().encode(
@@ -238,39 +299,15 @@ bar_chart = alt.Chart(top_5_table).mark_bar().encode(
 
 st.altair_chart(bar_chart)
 
-# Initialize the Folium map
-m = folium.Map(
-    location=[40.7685, -73.9822],
-    zoom_start=10,
-    tiles="CartoDB positron"
-)
-
-# Add GeoJSON with filtered data and style
-folium.Choropleth(
-    geo_data=aggregated_data,
-    data=aggregated_data,
-    columns=['LocationID', 'trip_count'],
-    key_on='feature.properties.LocationID',
-    fill_color='viridis',
-    nan_fill_color='rgba(0, 0, 0, 0)',
-    fill_opacity=0.7,
-    line_opacity=0.2,
-    legend_name='Number of Trips'
-).add_to(m)
-
-# Add tooltips
-folium.GeoJson(
-    aggregated_data,
-    style_function=lambda x: {'fillColor': 'transparent', 'color': 'black', 'weight': 0.3},
-    tooltip=folium.GeoJsonTooltip(
-        fields=['LocationID', 'zone', 'trip_count', 'borough'],
-        aliases=['Location ID', 'Zone:', 'Number of Trips:', 'Borough:']
-    )
-).add_to(m)
+# Color the cached zone geometry by trip count, with tooltips, in a single layer
+m = choropleth_map(zone_layer, aggregated_data, 'viridis')
 
 # Highlight the selected pickup location in RED
 if pickup_location != 'All' and dropoff_location != 'All':
-    selected_zone = shapefile[shapefile['zone'] == pickup_location]
+    selected_zone = {
+        'type': 'FeatureCollection',
+        'features': [feature for feature in zone_layer if feature['properties']['zone'] == pickup_location]
+    }
 
     # Add the selected pickup location as a separate layer
     folium.GeoJson(
@@ -297,4 +334,4 @@ folium.LayerControl().add_to(m)
 
 # Streamlit Folium Integration
 st.title("Taxi Trip Choropleth Map")
-st_folium(m, width=600, height=500)
+st_folium(m, width=600, height=500, returned_objects=[])
@@ -0,0 +1,349 @@
+# Description:  Live trip feed: tails a trip event source and keeps the pickup and dropoff counts of the last minutes per zone and time period
+
+
+
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from features import get_time_period, period_order
+
+# Windows (in minutes) the counts are kept for, and the length of the time buckets they are made of
+windows = [15, 30, 60]
+bucket_seconds = 60
+
+# Length of the zone axis: LocationIDs are below 512 (see od_key_bits in data.py)
+n_zones = 512
+
+# How far ahead of the newest bucket, and of the clock, an event may be before it is
+# rejected (TLC files hold timestamps like 2098). The clock bound is loose, the event
+# times being New York times read on a clock that may be in any time zone
+max_event_skew = timedelta(minutes=15)
+max_clock_skew = timedelta(days=1)
+
+# Columns of a trip event, one JSON object per line (the trips.csv column names)
+event_columns = ['tpep_pickup_datetime', 'tpep_dropoff_datetime', 'PULocationID', 'DOLocationID']
+
+# Time and zone of the pickup and of the dropoff of a trip event
+directions = {
+    'pickup': ('tpep_pickup_datetime', 'PULocationID'),
+    'dropoff': ('tpep_dropoff_datetime', 'DOLocationID')
+}
+
+_epoch = datetime(1970, 1, 1)
+
+
+class WindowCounts:
+    """
+    Trip counts per direction, time period and zone over the last minutes, in a ring of
+    time buckets as long as the largest window, with a running total per window.
+
+    Adding a trip increments its bucket and the totals of the windows holding it. When
+    a new bucket starts, the bucket leaving each window is subtracted from its total and
+    the oldest bucket is cleared for reuse. Both cost the same whatever the number of
+    trips and the window lengths, and the memory is fixed when the counts are created.
+
+    Time is the event time of the trips, not the clock, so the newest trip seen sets
+    the end of the windows; a trip older than the largest window is counted as late.
+    Callers check `is_ahead` first, so that one bad timestamp far in the future does
+    not clear the windows and make every later trip late.
+    """
+
+    def __init__(self, windows=windows, bucket_seconds=bucket_seconds, n_zones=n_zones):
+        """
+        Parameters:
+            windows (list): Window lengths in minutes, multiples of the bucket length.
+            bucket_seconds (int): Length of a time bucket.
+            n_zones (int): Length of the zone axis, i.e. the largest LocationID + 1.
+        """
+        if any(minutes * 60 % bucket_seconds for minutes in windows):
+            raise ValueError('Windows of %s minutes are not made of %d second buckets' % (windows, bucket_seconds))
+        self.windows = sorted(windows)
+        self.bucket_seconds = bucket_seconds
+        self.n_zones = n_zones
+        # Number of buckets in each window
+        self.spans = [minutes * 60 // bucket_seconds for minutes in self.windows]
+        self.n_slots = max(self.spans)
+
+        shape = (len(directions), len(period_order), n_zones)
+        self.slots = np.zeros((self.n_slots,) + shape, dtype=np.uint32)
+        self.totals = np.zeros((len(self.windows),) + shape, dtype=np.int64)
+        self.latest = None
+        self.late = 0
+
+    def add(self, direction, timestamp, location_id):
+        """
+        Counts one pickup or dropoff.
+
+        Parameters:
+            direction (str): 'pickup' or 'dropoff'.
+            timestamp (datetime): Time of the pickup or dropoff.
+            location_id (int): Its zone.
+
+        Returns:
+            bool: False when the trip is older than the largest window and was not counted.
+        """
+        bucket = int((timestamp - _epoch).total_seconds()) // self.bucket_seconds
+        if self.latest is None or bucket > self.latest:
+            self._advance(bucket)
+        age = self.latest - bucket
+        if age >= self.n_slots:
+            self.late += 1
+            return False
+
+        cell = (list(directions).index(direction), period_order.index(get_time_period(timestamp)), location_id)
+        self.slots[(bucket % self.n_slots,) + cell] += 1
+        for window, span in enumerate(self.spans):
+            if age < span:
+                self.totals[(window,) + cell] += 1
+        return True
+
+    def is_ahead(self, timestamp, now):
+        """
+        Whether `timestamp` is more than max_event_skew after the end of the windows and
+        more than max_clock_skew after the clock time `now`. A trip after a gap in the
+        feed is still in time with the clock, and the first trip is checked on the clock only.
+        """
+        end = self.end_time()
+        return (end is None or timestamp > end + max_event_skew) and timestamp > now + max_clock_skew
+
+    def _advance(self, bucket):
+        """Moves the end of the windows to `bucket`, dropping the buckets that leave them."""
+        if self.latest is not None and bucket - self.latest < self.n_slots:
+            for newest in range(self.latest + 1, bucket + 1):
+                for window, span in enumerate(self.spans):
+                    self.totals[window] -= self.slots[(newest - span) % self.n_slots]
+                # The slot of the new bucket held the one leaving the largest window
+                self.slots[newest % self.n_slots] = 0
+        else:
+            # Every bucket left the windows
+            self.slots[:] = 0
+            self.totals[:] = 0
+        self.latest = bucket
+
+    def window(self, direction, minutes, time_period='All'):
+        """
+        Trips per zone in one window.
+
+        Parameters:
+            direction (str): 'pickup' or 'dropoff'.
+            minutes (int): One of `windows`.
+            time_period (str): Time period, or 'All'.
+
+        Returns:
+            ndarray: Trip count of every LocationID (a copy).
+        """
+        totals = self.totals[self.windows.index(minutes), list(directions).index(direction)]
+        if time_period == 'All':
+            return totals.sum(axis=0)
+        return totals[period_order.index(time_period)].copy()
+
+    def end_time(self):
+        """End of the windows: the end of the newest time bucket, None before the first trip."""
+        if self.latest is None:
+            return None
+        return _epoch + timedelta(seconds=(self.latest + 1) * self.bucket_seconds)
+
+
+class LiveFeed:
+    """
+    Trip events of one source, counted into WindowCounts by a background thread. One
+    feed is shared by every session and by both views; `snapshot` copies the counts of
+    a window under the lock the thread updates them with.
+    """
+
+    def __init__(self, source, windows=windows, bucket_seconds=bucket_seconds, n_zones=n_zones):
+        """
+        Parameters:
+            source (str): Trip event source, see `open_source`.
+            windows (list): Window lengths in minutes.
+            bucket_seconds (int): Length of a time bucket.
+            n_zones (int): Largest LocationID + 1.
+        """
+        self.source = source
+        self.counts = WindowCounts(windows, bucket_seconds, n_zones)
+        self.windows = self.counts.windows
+        self.events = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Starts tailing the source in a daemon thread (once) and returns the feed."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='live-feed', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        for line in open_source(self.source):
+            self.ingest(line)
+
+    def ingest(self, line):
+        """
+        Counts the pickup and the dropoff of one trip event. Malformed events, unknown zones
+        and times too far in the future (see `WindowCounts.is_ahead`) are counted as rejected.
+        """
+        try:
+            trip = json.loads(line)
+            trip = {column: trip[column] for column in event_columns}
+            times = {direction: datetime.fromisoformat(trip[time_column]) for direction, (time_column, _) in directions.items()}
+            zones = {direction: int(trip[zone_column]) for direction, (_, zone_column) in directions.items()}
+        except (ValueError, KeyError, TypeError):
+            with self._lock:
+                self.rejected += 1
+            return
+        with self._lock:
+            now = datetime.now()
+            if not all(0 <= zone < self.counts.n_zones for zone in zones.values()) or \
+                    any(self.counts.is_ahead(timestamp, now) for timestamp in times.values()):
+                self.rejected += 1
+                return
+            self.events += 1
+            for direction in directions:
+                self.counts.add(direction, times[direction], zones[direction])
+
+    def snapshot(self, direction, minutes, time_period='All'):
+        """
+        Trips per zone in one window, with the end of the window and the feed counters.
+
+        Returns:
+            dict: 'trip_count' (ndarray by LocationID), 'end' (datetime or None), 'events',
+            'rejected' and 'late'.
+        """
+        with self._lock:
+            return {
+                'trip_count': self.counts.window(direction, minutes, time_period),
+                'end': self.counts.end_time(),
+                'events': self.events,
+                'rejected': self.rejected,
+                'late': self.counts.late
+            }
+
+
+def open_source(source, poll_seconds=0.5):
+    """
+    Lines of a trip event source, forever: 'tcp://host:port' reads a socket, any other
+    value is a file tailed as it is appended to.
+    """
+    if source.startswith('tcp://'):
+        host, port = source[len('tcp://'):].rsplit(':', 1)
+        return read_socket(host, int(port), poll_seconds)
+    return tail_file(source, poll_seconds)
+
+
+def tail_file(path, poll_seconds=0.5):
+    """
+    Lines of a file from its start, then the lines appended to it (like tail -f). A line
+    is only yielded once its newline is written. A file that is replaced (rotated) or
+    truncated is read again from its start.
+    """
+    file = None
+    partial = ''
+    while True:
+        if file is None:
+            if not os.path.exists(path):
+                time.sleep(poll_seconds)
+                continue
+            file = open(path, encoding='utf-8')
+            inode = os.fstat(file.fileno()).st_ino
+
+        line = file.readline()
+        if line:
+            partial += line
+            if partial.endswith('\n'):
+                yield partial
+                partial = ''
+            continue
+
+        # Nothing new: check whether the file was replaced or truncated before waiting
+        try:
+            stat = os.stat(path)
+            if stat.st_ino != inode or stat.st_size < file.tell():
+                file.close()
+                file = None
+                partial = ''
+                continue
+        except FileNotFoundError:
+            pass
+        time.sleep(poll_seconds)
+
+
+def read_socket(host, port, retry_seconds=0.5):
+    """Lines sent on a TCP connection to host:port, reconnecting whenever it is closed or refused."""
+    while True:
+        try:
+            with socket.create_connection((host, port)) as connection:
+                with connection.makefile('r', encoding='utf-8') as stream:
+                    yield from stream
+        except OSError:
+            pass
+        time.sleep(retry_seconds)
+
+
+def write_events(trip_file, events_path, speed=60.0):
+    """
+    Replays a trip file as a live source: appends its trips to `events_path` as JSON
+    lines, in dropoff order (when the trip becomes known), `speed` times faster than
+    they happened (as fast as possible when 0). Pipe the file into a socket server
+    (e.g. tail -f events.jsonl | nc -lk 9000) for a socket stand-in.
+
+    Parameters:
+        trip_file (str): TLC trip file (CSV).
+        events_path (str): JSON lines file the events are appended to.
+        speed (float): Replay speed-up.
+    """
+    trips = pd.read_csv(trip_file, usecols=event_columns).dropna()
+    trips = trips.sort_values('tpep_dropoff_datetime', kind='stable')
+    dropoffs = pd.to_datetime(trips['tpep_dropoff_datetime'])
+    start, first = time.monotonic(), dropoffs.iloc[0]
+
+    with open(events_path, 'a', encoding='utf-8') as file:
+        for trip, dropoff in zip(trips.itertuples(index=False), dropoffs):
+            if speed:
+                delay = (dropoff - first).total_seconds() / speed - (time.monotonic() - start)
+                if delay > 0:
+                    file.flush()
+                    time.sleep(delay)
+            file.write(json.dumps({
+                'tpep_pickup_datetime': trip.tpep_pickup_datetime,
+                'tpep_dropoff_datetime': trip.tpep_dropoff_datetime,
+                'PULocationID': int(trip.PULocationID),
+                'DOLocationID': int(trip.DOLocationID)
+            }) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Follow a live trip event source, or replay a trip file as one.')
+    parser.add_argument('source', nargs='?', help="JSON lines file being appended to, or tcp://host:port.")
+    parser.add_argument('--window', type=int, default=windows[0], choices=windows, help='Minutes counted.')
+    parser.add_argument('--every', type=float, default=5.0, help='Seconds between two printed summaries.')
+    parser.add_argument('--replay', metavar='TRIP_FILE', help='Append the trips of this file to --to as events.')
+    parser.add_argument('--to', metavar='EVENTS_FILE', help='Events file written by --replay.')
+    parser.add_argument('--speed', type=float, default=60.0, help='Replay speed-up (0 for as fast as possible).')
+    args = parser.parse_args()
+
+    if args.replay:
+        if not args.to:
+            parser.error('--replay needs --to')
+        write_events(args.replay, args.to, args.speed)
+    elif not args.source:
+        parser.error('give a source to follow, or --replay')
+    else:
+        feed = LiveFeed(args.source).start()
+        while True:
+            time.sleep(args.every)
+            for direction in directions:
+                snapshot = feed.snapshot(direction, args.window)
+                busiest = np.argsort(snapshot['trip_count'])[::-1][:5]
+                print('%s %s, last %d minutes: %s' % (
+                    snapshot['end'], direction, args.window,
+                    ', '.join('%d: %d' % (zone, snapshot['trip_count'][zone]) for zone in busiest if snapshot['trip_count'][zone])))
+            print('events %d, rejected %d, late %d' % (snapshot['events'], snapshot['rejected'], snapshot['late']))
@@ -0,0 +1,157 @@
+# Description:  Cubes of the pickup_dropoff statistics and the filter_and_aggregate query of final_dashboard, shared with the query API
+
+
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from cube import build_cube, build_pair_index, build_sketch_index, query_cube, query_pair_index, query_sketch_index
+from features import day_order, month_names, period_order
+from quantile_sketch import compact_sketches, n_buckets, quantiles, single_trip_sketches, sketch_metrics, sketch_quantiles
+from query_cache import frame_fingerprint
+
+# Columns of pickup_dropoff_cleaned used by the queries
+od_columns = ['PULocationID', 'DOLocationID', 'month', 'day_pickup', 'pickup_period',
+              'trip_count', 'avg_trip_distance', 'avg_trip_duration']
+# Columns of pickup_dropoff_sketch (data.py), the trips per distance or duration bucket
+sketch_columns = ['PULocationID', 'DOLocationID', 'month', 'day_pickup', 'pickup_period',
+                  'metric', 'bucket', 'trip_count']
+# Group columns of both tables
+od_keys = sketch_columns[:5]
+
+
+def load_zone_dimension(shapefile_path):
+    """
+    Zone dimension: one row per LocationID with its zone name, borough and geometry.
+    Zones split over several shapefile rows (56, 103) are merged.
+    """
+    zones = gpd.read_file(shapefile_path)
+    zones['LocationID'] = zones['LocationID'].astype(int)
+    return zones.dissolve(by='LocationID', aggfunc='first')[['zone', 'borough', 'geometry']]
+
+
+def zone_ids(zones, location_ids):
+    """LocationIDs of every zone name among `location_ids`, 'Unknown' for those missing from the shapefile."""
+    location_ids = np.unique(location_ids)
+    names = zones['zone'].reindex(location_ids).fillna('Unknown').astype(str).to_numpy()
+    return pd.Series(location_ids).groupby(names).unique().to_dict()
+
+
+def build_od_cubes(data, zones, sketches=None):
+    """
+    Cubes behind `filter_and_aggregate`: per pickup zone sums with every month/day/time
+    period rollup, and pair indexes for the queries that select a pickup or dropoff
+    location. With the sketches, the same three indexes of the distance and duration
+    sketches.
+
+    Parameters:
+        data (DataFrame): pickup_dropoff_cleaned rows (od_columns), with int LocationIDs.
+        zones (DataFrame): Output of `load_zone_dimension`.
+        sketches (DataFrame): pickup_dropoff_sketch rows of the same trips, or None. The
+            sketches of the groups of a single trip, left out of the table, are rebuilt
+            from `data`.
+
+    Returns:
+        dict: The cubes and indexes, the LocationIDs of every zone name and a version.
+    """
+    # Averages are averaged over the matching rows, so the rows are counted too
+    facts = data.assign(records=1)
+
+    present = [set(facts[column].dropna()) for column in ['month', 'day_pickup', 'pickup_period']]
+    dims = [
+        ('month', [month for month in month_names if month in present[0]]),
+        ('day_pickup', [day for day in day_order if day in present[1]]),
+        ('pickup_period', [period for period in period_order if period in present[2]])
+    ]
+    metrics = ['trip_count', 'avg_trip_duration', 'avg_trip_distance', 'records']
+    n_zones = max(facts['PULocationID'].max(), facts['DOLocationID'].max()) + 1
+
+    sketch_indexes = version = None
+    if sketches is not None:
+        version = frame_fingerprint(sketches)
+        # Compacted again, as tables written before the single trip groups were left out still hold them
+        sketches = pd.concat([compact_sketches(sketches, od_keys), single_trip_sketches(facts, od_keys)],
+                             ignore_index=True)
+        # The sketches of the pickup zones are merged over the dropoff zones in advance
+        by_pickup = sketches.groupby(['PULocationID', 'month', 'day_pickup', 'pickup_period', 'metric', 'bucket'],
+                                     as_index=False, observed=True)['trip_count'].sum()
+        sketch_indexes = {}
+        for metric in sketch_metrics:
+            pickups, pairs = by_pickup[by_pickup['metric'] == metric], sketches[sketches['metric'] == metric]
+            sketch_indexes[metric] = {
+                'by_pickup': build_sketch_index(pickups, 'PULocationID', 'PULocationID', dims, n_zones, n_buckets),
+                'pickups_by_dropoff': build_sketch_index(pairs, 'DOLocationID', 'PULocationID', dims, n_zones, n_buckets),
+                'dropoffs_by_pickup': build_sketch_index(pairs, 'PULocationID', 'DOLocationID', dims, n_zones, n_buckets),
+            }
+
+    return {
+        'version': (frame_fingerprint(facts), version),
+        'by_pickup': build_cube(facts, 'PULocationID', dims, metrics, n_zones),
+        'pickups_by_dropoff': build_pair_index(facts, 'DOLocationID', 'PULocationID', dims, metrics, n_zones),
+        'dropoffs_by_pickup': build_pair_index(facts, 'PULocationID', 'DOLocationID', dims, metrics, n_zones),
+        'pickup_ids': zone_ids(zones, facts['PULocationID']),
+        'dropoff_ids': zone_ids(zones, facts['DOLocationID']),
+        'sketches': sketch_indexes,
+    }
+
+
+def filter_and_aggregate(cubes, zones, month, day, time_period, pickup_location, dropoff_location):
+    """
+    Trips by pickup zone (by dropoff zone when a pickup location is selected) for one
+    combination of filters, 'All' for no filter.
+
+    Parameters:
+        cubes (dict): Output of `build_od_cubes`.
+        zones (DataFrame): Output of `load_zone_dimension`.
+        month, day, time_period (str): Calendar filters.
+        pickup_location, dropoff_location (str): Zone names.
+
+    Returns:
+        GeoDataFrame: LocationID, zone, borough, trip_count, the average duration and
+        distance, the percentiles when the cubes have sketches, and the geometry of the
+        zones with trips.
+    """
+    selection = (month, day, time_period)
+
+    # Aggregate by Pickup or Dropoff LocationID
+    if pickup_location == 'All':
+        if dropoff_location == 'All':
+            sums = query_cube(cubes['by_pickup'], selection)
+            index, keys = 'by_pickup', range(len(sums['records']))
+        else:
+            index, keys = 'pickups_by_dropoff', cubes['dropoff_ids'].get(dropoff_location, [])
+            sums = query_pair_index(cubes[index], keys, selection)
+    else:
+        index, keys = 'dropoffs_by_pickup', cubes['pickup_ids'].get(pickup_location, [])
+        sums = query_pair_index(cubes[index], keys, selection)
+        if dropoff_location != 'All':
+            selected = np.isin(np.arange(len(sums['records'])), cubes['dropoff_ids'].get(dropoff_location, []))
+            sums = {metric: np.where(selected, values, 0) for metric, values in sums.items()}
+
+    location_ids = np.flatnonzero(sums['records'] > 0)
+    records = sums['records'][location_ids]
+
+    # Join the zone dimension on the aggregated rows only
+    zone_rows = zones.reindex(location_ids)
+    aggregated_data = pd.DataFrame({
+        'LocationID': location_ids,
+        'zone': zone_rows['zone'].fillna('Unknown').to_numpy(),
+        'borough': zone_rows['borough'].to_numpy(),
+        'trip_count': sums['trip_count'][location_ids].astype(int),
+        'avg_trip_duration': np.round(sums['avg_trip_duration'][location_ids] / records, 0),
+        'avg_trip_distance': np.round(sums['avg_trip_distance'][location_ids] / records, 2),
+        'geometry': zone_rows['geometry'].to_numpy()
+    })
+
+    # Percentiles of the trips of every zone, from the same rows' sketches merged per zone
+    if cubes['sketches'] is not None:
+        for metric, decimals in [('trip_duration', 0), ('trip_distance', 2)]:
+            counts = query_sketch_index(cubes['sketches'][metric][index], keys, selection)[location_ids]
+            values = sketch_quantiles(counts, list(quantiles.values()))
+            for name, column in zip(quantiles, values.T):
+                aggregated_data['%s_%s' % (name, metric)] = np.round(column, decimals)
+
+    # Convert to GeoDataFrame
+    aggregated_data = gpd.GeoDataFrame(aggregated_data, geometry='geometry', crs=zones.crs)
+    return aggregated_data
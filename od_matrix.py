@@ -0,0 +1,247 @@
+# Description:  Dense origin-destination matrix of trip counts and distance/duration sums, memory-mapped from .npy files
+
+
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+from features import day_order, month_names, period_order
+from query_cache import frame_fingerprint
+
+od_folder = 'od_matrix'
+
+# Metrics stored, the column of the pickup_dropoff partials they come from, and their type
+od_metrics = {
+    'count': ('trip_count', np.uint32),
+    'distance': ('trip_distance', np.float32),
+    'duration': ('trip_duration', np.float32)
+}
+
+# Axes of every metric array; the pickup and dropoff axes are indexed by LocationID
+od_axes = ['month', 'day', 'period', 'pickup', 'dropoff']
+od_labels = {'month': month_names, 'day': day_order, 'period': period_order}
+od_columns = {'month': 'month', 'day': 'day_pickup', 'period': 'pickup_period',
+              'pickup': 'PULocationID', 'dropoff': 'DOLocationID'}
+
+
+def write_od_matrix(stats, path, n_zones=266, version=None):
+    """
+    Writes the trip count, distance sum and duration sum of every month, day, time
+    period, pickup zone and dropoff zone as dense .npy arrays in path+od_folder.
+
+    The metadata keeps a digest of the partials of every month. When a matrix of the
+    same shape is already there, only the months whose partials changed (e.g. the
+    ingested ones) are rewritten in place, and nothing but the metadata when none did;
+    the version is cleared while the months are rewritten, so that readers checking it
+    (query_api.py) do not use a half-updated matrix.
+
+    Parameters:
+        stats (DataFrame): pickup_dropoff partials with the trip_count, trip_distance and
+            trip_duration sums per PULocationID, DOLocationID, month, day_pickup and pickup_period.
+        path (str): Folder holding the cleaned tables.
+        n_zones (int): Length of the zone axes, at least the largest LocationID + 1.
+        version (str): Version of the data the matrix was built from, kept in its metadata.
+    """
+    if len(stats):
+        n_zones = max(n_zones, int(stats['PULocationID'].max()) + 1, int(stats['DOLocationID'].max()) + 1)
+    shape = (len(month_names), len(day_order), len(period_order), n_zones, n_zones)
+
+    codes = []
+    keep = np.ones(len(stats), dtype=bool)
+    for axis in od_axes:
+        values = stats[od_columns[axis]]
+        if axis in od_labels:
+            axis_codes = np.asarray(values.astype(str).map({label: code for code, label in enumerate(od_labels[axis])})
+                                    .fillna(-1), dtype=np.int64)
+        else:
+            axis_codes = values.to_numpy().astype(np.int64)
+        keep &= axis_codes >= 0
+        codes.append(axis_codes)
+
+    # Digest of the partials of every month, in any row order
+    columns = list(od_columns.values()) + [column for column, _ in od_metrics.values()]
+    months = {month_names[code]: frame_fingerprint(stats.loc[keep & (codes[0] == code), columns])
+              for code in np.unique(codes[0][keep])}
+    meta = {'axes': od_axes, 'labels': od_labels, 'n_zones': n_zones, 'version': version, 'months': months}
+
+    folder = path + od_folder
+    current = _read_meta(folder)
+    if current is not None and current.get('n_zones') == n_zones and 'months' in current and \
+            all(os.path.exists(os.path.join(folder, metric + '.npy')) for metric in od_metrics):
+        changed = [code for code, month in enumerate(month_names) if current['months'].get(month) != months.get(month)]
+        if changed:
+            _write_meta(folder, dict(current, version=None))
+            arrays = {metric: np.load(os.path.join(folder, metric + '.npy'), mmap_mode='r+') for metric in od_metrics}
+            _fill_months(arrays, stats, codes, keep, changed)
+            del arrays
+        _write_meta(folder, meta)
+        return
+
+    # Written next to the current matrix and swapped in once complete
+    temp_folder = folder + '.tmp'
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    os.makedirs(temp_folder)
+    arrays = {metric: np.lib.format.open_memmap(os.path.join(temp_folder, metric + '.npy'), mode='w+', dtype=dtype,
+                                                shape=shape)
+              for metric, (_, dtype) in od_metrics.items()}
+    # New files are all zeros, only the months with trips are filled
+    _fill_months(arrays, stats, codes, keep, sorted(set(codes[0][keep])))
+    del arrays
+    _write_meta(temp_folder, meta)
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(temp_folder, folder)
+
+
+def _fill_months(arrays, stats, codes, keep, months):
+    """Sets the slices of the `months` (codes) of every metric array from the partials, one month at a time."""
+    shape = next(iter(arrays.values())).shape[1:]
+    for month in months:
+        rows = keep & (codes[0] == month)
+        cells = np.ravel_multi_index([axis_codes[rows] for axis_codes in codes[1:]], shape)
+        for metric, (column, _) in od_metrics.items():
+            values = np.bincount(cells, weights=stats[column].to_numpy()[rows], minlength=int(np.prod(shape)))
+            arrays[metric][month] = values.reshape(shape)
+    for array in arrays.values():
+        array.flush()
+
+
+def _read_meta(folder):
+    """Metadata of the matrix in `folder`, None when there is none."""
+    meta_path = os.path.join(folder, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as file:
+        return json.load(file)
+
+
+def _write_meta(folder, meta):
+    with open(os.path.join(folder, 'meta.json.tmp'), 'w') as file:
+        json.dump(meta, file)
+    os.replace(os.path.join(folder, 'meta.json.tmp'), os.path.join(folder, 'meta.json'))
+
+
+class ODMatrix:
+    """
+    Read-only view of a matrix written by `write_od_matrix`. The arrays are memory-mapped,
+    so only the pages a query touches are read from disk.
+
+    Filters are labels ('March', 'Friday', 'am_rush') or 'All'. A single cell is one index;
+    any other query sums the selected block over the axes that are not kept.
+    """
+
+    def __init__(self, path):
+        folder = path + od_folder
+        with open(os.path.join(folder, 'meta.json')) as file:
+            self.meta = json.load(file)
+        self.n_zones = self.meta['n_zones']
+        self.arrays = {metric: np.load(os.path.join(folder, metric + '.npy'), mmap_mode='r') for metric in od_metrics}
+
+    def _index(self, axis, value):
+        """Index or slice selecting `value` on a filter axis."""
+        if value == 'All':
+            return slice(None)
+        return self.meta['labels'][axis].index(value)
+
+    def cell(self, month, day, period, pickup, dropoff):
+        """
+        Count, distance sum and duration sum of one pickup/dropoff pair for one combination
+        of filters. With no 'All' this is a single index per array.
+
+        Returns:
+            dict: Scalar per metric.
+        """
+        block = self.select(month, day, period)
+        return {metric: values[..., pickup, dropoff].sum() for metric, values in block.items()}
+
+    def select(self, month='All', day='All', period='All', pickups=None, dropoffs=None):
+        """
+        The block of every metric for one combination of filters, without summing.
+
+        Parameters:
+            month, day, period (str): Labels or 'All'.
+            pickups, dropoffs (list): LocationIDs kept on the zone axes (all when None).
+
+        Returns:
+            dict: Per-metric array views (memory-mapped when no zone list is given).
+        """
+        index = (self._index('month', month), self._index('day', day), self._index('period', period))
+        if pickups is not None:
+            pickups = np.unique(np.asarray(pickups, dtype=np.int64))
+        if dropoffs is not None:
+            dropoffs = np.unique(np.asarray(dropoffs, dtype=np.int64))
+        block = {}
+        for metric, values in self.arrays.items():
+            values = values[index]
+            if pickups is not None:
+                values = np.take(values, pickups, axis=-2)
+            if dropoffs is not None:
+                values = np.take(values, dropoffs, axis=-1)
+            block[metric] = values
+        return block
+
+    def pairs(self, month='All', day='All', period='All'):
+        """
+        Count and sums of every pickup/dropoff pair for one combination of filters.
+
+        Returns:
+            dict: (n_zones, n_zones) array per metric, indexed [pickup, dropoff].
+        """
+        return {metric: self._sum_to(values, 2) for metric, values in self.select(month, day, period).items()}
+
+    def marginal(self, direction, month='All', day='All', period='All', pickups=None, dropoffs=None):
+        """
+        Count and sums per pickup zone or per dropoff zone, optionally restricted to trips
+        from `pickups` or to `dropoffs`.
+
+        Parameters:
+            direction (str): 'pickup' or 'dropoff', the zone axis that is kept.
+            month, day, period (str): Labels or 'All'.
+            pickups, dropoffs (list): LocationIDs the trips start or end in (all when None).
+
+        Returns:
+            dict: Array indexed by LocationID per metric.
+        """
+        block = self.select(month, day, period, pickups, dropoffs)
+        pickups = None if pickups is None else np.unique(np.asarray(pickups, dtype=np.int64))
+        dropoffs = None if dropoffs is None else np.unique(np.asarray(dropoffs, dtype=np.int64))
+        marginals = {}
+        for metric, values in block.items():
+            values = self._sum_to(values, 2)
+            marginals[metric] = values.sum(axis=1) if direction == 'pickup' else values.sum(axis=0)
+        if direction == 'pickup' and pickups is not None:
+            marginals = {metric: self._scatter(values, pickups) for metric, values in marginals.items()}
+        if direction == 'dropoff' and dropoffs is not None:
+            marginals = {metric: self._scatter(values, dropoffs) for metric, values in marginals.items()}
+        return marginals
+
+    def means(self, sums):
+        """Mean distance and duration from the output of `cell`, `pairs` or `marginal` (NaN without trips)."""
+        count = np.asarray(sums['count'], dtype=np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {
+                'distance': np.where(count > 0, sums['distance'] / count, np.nan),
+                'duration': np.where(count > 0, sums['duration'] / count, np.nan)
+            }
+
+    def _sum_to(self, values, ndim):
+        """Sums the leading (filter) axes until `ndim` axes are left, in float64 for the sums."""
+        dtype = np.uint64 if values.dtype == np.uint32 else np.float64
+        axes = tuple(range(values.ndim - ndim))
+        return values.sum(axis=axes, dtype=dtype) if axes else np.asarray(values, dtype=dtype)
+
+    def _scatter(self, values, location_ids):
+        """Puts values of the selected zones back at their LocationID."""
+        full = np.zeros(self.n_zones, dtype=values.dtype)
+        full[location_ids] = values
+        return full
+
+
+def load_od_matrix(path):
+    """The OD matrix of `path`, or None when data.py has not written one."""
+    if not os.path.exists(os.path.join(path + od_folder, 'meta.json')):
+        return None
+    return ODMatrix(path)
@@ -0,0 +1,240 @@
+# Description:  Renders the dashboards' choropleth maps for every combination of filters as static HTML files, over a process pool
+
+
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import folium
+import pandas as pd
+
+from od_cubes import build_od_cubes, filter_and_aggregate, load_zone_dimension, od_columns
+from query_cache import frame_fingerprint
+from storage import read_table
+from zone_layer import choropleth_map, from_topojson, load_zone_topology
+from zone_store import ZoneMetricStore
+
+# Maps rendered, with the palette of the dashboard they come from: the pickup and
+# dropoff maps of tlc_pickup.py and tlc_dropoff.py (zone_view.py), and the map of the
+# pickups of final_dashboard.py, which can be filtered on a pickup or dropoff zone
+maps = {
+    'pickup': {'palette': 'YlOrRd'},
+    'dropoff': {'palette': 'YlOrRd'},
+    'pickup_dropoff': {'palette': 'viridis'}
+}
+
+# Changes whenever the maps are drawn differently, so that every artifact is rendered again
+render_version = '1'
+
+# Records which inputs every artifact was rendered from, in the output folder
+manifest_name = 'manifest.json'
+
+# Columns of the rows a map is drawn from
+map_columns = ['LocationID', 'zone', 'trip_count', 'borough']
+
+# Zone geometry of the worker processes, decoded once per process by `_init_worker`
+_zone_layer = None
+
+
+def slug(value):
+    """File name part of a filter value, e.g. 'Stuy Town/PCV' -> 'Stuy_Town_PCV'."""
+    return re.sub(r'[^A-Za-z0-9]+', '_', str(value)).strip('_')
+
+
+def artifact_name(map_name, filters):
+    """
+    Path of an artifact in the output folder: one folder level per filter, in order, e.g.
+    pickup/January/Monday/am_rush.html.
+    """
+    return '/'.join([map_name] + [slug(value) for value in filters.values()]) + '.html'
+
+
+def zone_store_maps(store, direction):
+    """
+    Filters and rows of every map of tlc_pickup.py or tlc_dropoff.py.
+
+    Yields:
+        tuple: Filters (dict of month, day and time_period) and the rows of the map.
+    """
+    for selection in product(*[['All'] + labels for labels in store.labels(direction)]):
+        rows = store.aggregate(direction, *selection)
+        yield dict(zip(['month', 'day', 'time_period'], selection)), pd.DataFrame(rows[map_columns])
+
+
+def pickup_dropoff_maps(path, shapefile_path, with_zones=False):
+    """
+    Filters and rows of every map of final_dashboard.py: the trips by pickup zone of
+    every month, day and time period, and with `with_zones` also those from every
+    pickup zone and to every dropoff zone. A pickup and a dropoff zone together only
+    highlight the pickup zone in the dashboard, so these are not rendered.
+
+    Parameters:
+        path (str): Folder holding pickup_dropoff_cleaned.
+        shapefile_path (str): Path of taxi_zones.shp.
+        with_zones (bool): Also render the maps filtered on one zone.
+
+    Yields:
+        tuple: Filters (dict of pickup_location, dropoff_location, month, day and
+        time_period) and the rows of the map.
+    """
+    facts = read_table(path, 'pickup_dropoff_cleaned', columns=od_columns)
+    facts['PULocationID'] = facts['PULocationID'].astype(int)
+    facts['DOLocationID'] = facts['DOLocationID'].astype(int)
+    zones = load_zone_dimension(shapefile_path)
+    cubes = build_od_cubes(facts, zones)
+
+    locations = [('All', 'All')]
+    if with_zones:
+        locations += [(name, 'All') for name in sorted(cubes['pickup_ids'])]
+        locations += [('All', name) for name in sorted(cubes['dropoff_ids'])]
+
+    for pickup_location, dropoff_location in locations:
+        for selection in product(*[['All'] + labels for labels in cubes['by_pickup']['labels']]):
+            rows = filter_and_aggregate(cubes, zones, *selection, pickup_location, dropoff_location)
+            filters = dict(zip(['pickup_location', 'dropoff_location', 'month', 'day', 'time_period'],
+                               (pickup_location, dropoff_location) + selection))
+            yield filters, pd.DataFrame(rows[map_columns])
+
+
+def rows_digest(map_name, rows, geometry):
+    """Version of the inputs of one artifact: the rows and palette it is drawn from and the zone geometry."""
+    inputs = '|'.join([render_version, folium.__version__, map_name, maps[map_name]['palette'], geometry,
+                       '%d' % len(rows), frame_fingerprint(rows)])
+    return hashlib.sha1(inputs.encode()).hexdigest()
+
+
+def _init_worker(topology):
+    """Decodes the zone geometry once in every worker process."""
+    global _zone_layer
+    _zone_layer = from_topojson(topology)
+
+
+def render(task):
+    """
+    Renders one artifact, written to a temporary file first so that a page never serves
+    a half-written map.
+
+    Parameters:
+        task (tuple): Output folder, artifact name, map name and rows.
+
+    Returns:
+        str: The artifact name.
+    """
+    output, name, map_name, rows = task
+    m = choropleth_map(_zone_layer, rows, maps[map_name]['palette'])
+    if map_name == 'pickup_dropoff':
+        folium.LayerControl().add_to(m)
+
+    file_path = os.path.join(output, name)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    m.save(file_path + '.tmp')
+    os.replace(file_path + '.tmp', file_path)
+    return name
+
+
+def read_manifest(output):
+    """Artifacts of the previous run, by name (empty when there was none)."""
+    manifest_path = os.path.join(output, manifest_name)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as file:
+        return json.load(file)['artifacts']
+
+
+def prerender(path, output, map_names=tuple(maps), with_zones=False, workers=1, shapefile_path=None, force=False):
+    """
+    Renders the choropleth of every combination of filters of the dashboards as a static
+    HTML file, e.g. for status pages that cannot run Streamlit.
+
+    The rows of every map are queried in this process from the same cubes as the
+    dashboards; only the maps whose rows, palette or zone geometry changed since the
+    previous run are rendered, over a pool of `workers` processes. The simplified zone
+    geometry is sent to each worker once, as the TopoJSON it is cached in. Maps without
+    trips are not rendered (the dashboards show a warning instead), and the files of
+    maps that are no longer produced are removed. manifest.json lists every artifact
+    with its filters.
+
+    Parameters:
+        path (str): Folder holding the cleaned tables and taxi_zones.shp.
+        output (str): Folder the artifacts are written to.
+        map_names (list): Maps to render, from `maps`.
+        with_zones (bool): Also render the pickup_dropoff maps of every pickup and
+            dropoff zone (about 500 times as many maps).
+        workers (int): Number of rendering processes.
+        shapefile_path (str): Path of taxi_zones.shp (in `path` when None).
+        force (bool): Render every map, changed or not.
+
+    Returns:
+        dict: Number of maps rendered, unchanged and without trips.
+    """
+    shapefile_path = shapefile_path or path + 'taxi_zones.shp'
+    topology = load_zone_topology(shapefile_path)
+    store = ZoneMetricStore(path, shapefile_path)
+
+    previous = {} if force else read_manifest(output)
+    artifacts = {}
+    pending = []
+    empty = 0
+    for map_name in map_names:
+        if map_name == 'pickup_dropoff':
+            combinations = pickup_dropoff_maps(path, shapefile_path, with_zones)
+        else:
+            combinations = zone_store_maps(store, map_name)
+        for filters, rows in combinations:
+            if rows.empty:
+                empty += 1
+                continue
+            name = artifact_name(map_name, filters)
+            digest = rows_digest(map_name, rows, topology['source'])
+            artifacts[name] = {'map': map_name, 'filters': filters, 'digest': digest}
+            if previous.get(name, {}).get('digest') != digest or not os.path.exists(os.path.join(output, name)):
+                pending.append((output, name, map_name, rows))
+
+    start = time.perf_counter()
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(topology,)) as executor:
+            # Maps are sent in batches, their rows being much smaller than a rendered page
+            for _ in executor.map(render, pending, chunksize=max(1, min(32, len(pending) // (4 * workers)))):
+                pass
+    else:
+        _init_worker(topology)
+        for task in pending:
+            render(task)
+    seconds = time.perf_counter() - start
+
+    # Files of the previous run that no longer have trips or whose map was left out
+    for name in set(previous) - set(artifacts):
+        if previous[name]['map'] in map_names and os.path.exists(os.path.join(output, name)):
+            os.remove(os.path.join(output, name))
+    # The other maps of the previous run are kept as they were
+    kept = {name: artifact for name, artifact in previous.items() if artifact['map'] not in map_names}
+
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, manifest_name), 'w') as file:
+        json.dump({'artifacts': dict(kept, **artifacts)}, file, indent=1)
+
+    counts = {'rendered': len(pending), 'unchanged': len(artifacts) - len(pending), 'empty': empty}
+    print('rendered %d maps in %.1f s (%.1f maps/s), %d unchanged, %d without trips' % (
+        counts['rendered'], seconds, counts['rendered'] / max(seconds, 1e-9), counts['unchanged'], counts['empty']))
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the choropleth maps of every filter combination as static HTML files.')
+    parser.add_argument('path', help='Folder holding the cleaned tables and taxi_zones.shp.')
+    parser.add_argument('--output', default='prerendered/', help='Folder the HTML files and manifest.json are written to.')
+    parser.add_argument('--maps', nargs='+', choices=list(maps), default=list(maps), help='Maps to render.')
+    parser.add_argument('--zones', action='store_true',
+                        help='Also render the pickup_dropoff maps filtered on every pickup and every dropoff zone.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Number of rendering processes.')
+    parser.add_argument('--shapefile', default=None, help='Path of taxi_zones.shp (in the data folder by default).')
+    parser.add_argument('--force', action='store_true', help='Render every map, even those whose inputs did not change.')
+    args = parser.parse_args()
+
+    prerender(args.path, args.output, args.maps, args.zones, args.workers, args.shapefile, args.force)
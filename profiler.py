@@ -0,0 +1,213 @@
+# Description:  Named pipeline stages with wall time, peak memory and row counts, and hooks to forward them
+
+
+
+import importlib
+import json
+import os
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def current_rss():
+    """
+    Resident memory of this process in bytes. Uses psutil when installed, /proc on Linux,
+    and the peak so far from getrusage elsewhere.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == 'Darwin' else peak * 1024
+    return 0
+
+
+class StageProfiler:
+    """
+    Records the wall time, peak resident memory and rows in/out of named stages, which
+    may be nested. A background thread samples the memory while a stage runs, so peaks
+    inside a stage are seen even when the memory is released before it ends.
+
+    Disabled by default: `stage` then costs next to nothing. Every finished stage is
+    passed to the hooks added with `add_hook`, e.g. to forward it to a monitoring system.
+    """
+
+    def __init__(self, sample_interval=0.01):
+        self.sample_interval = sample_interval
+        self.enabled = False
+        self.records = []
+        self.hooks = []
+        self._active = []
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._started = 0
+
+    def enable(self):
+        self.enabled = True
+
+    def add_hook(self, hook):
+        """
+        Calls hook(record) after every stage, and enables the profiler.
+
+        Parameters:
+            hook (callable): Receives the stage record (dict with name, path, seconds,
+                peak_rss, rss_start, rss_end, rows_in and rows_out, and 'rejected' when
+                the stage sets it).
+        """
+        self.hooks.append(hook)
+        self.enable()
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._sampler = None
+                    return
+                rss = current_rss()
+                for record in self._active:
+                    record['peak_rss'] = max(record['peak_rss'], rss)
+            time.sleep(self.sample_interval)
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Profiles the enclosed block as the stage `name`, nested in the stages already running
+        in this thread.
+
+        Parameters:
+            name (str): Stage name.
+            rows_in (int): Rows the stage starts from.
+
+        Yields:
+            dict: The stage record; set its 'rows_out' inside the block, and for a
+            filtering stage its 'rejected' rows by rule (dict of rule name to rows).
+        """
+        record = {'name': name, 'rows_in': rows_in, 'rows_out': None}
+        if not self.enabled:
+            yield record
+            return
+
+        rss = current_rss()
+        thread = threading.get_ident()
+        with self._lock:
+            # Stages of other threads run alongside this one rather than around it; a worker
+            # thread's stages are nested in those of the main thread that started it
+            enclosing = [active for active in self._active if active['thread'] == thread]
+            if thread != threading.main_thread().ident:
+                main = threading.main_thread().ident
+                enclosing = [active for active in self._active if active['thread'] == main] + enclosing
+            record.update({
+                'path': ';'.join([active['name'] for active in enclosing] + [name]),
+                'thread': thread,
+                'started': self._started,
+                'rss_start': rss,
+                'peak_rss': rss
+            })
+            self._started += 1
+            self._active.append(record)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, daemon=True)
+                self._sampler.start()
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            rss = current_rss()
+            with self._lock:
+                self._active.remove(record)
+                record['rss_end'] = rss
+                record['peak_rss'] = max(record['peak_rss'], rss)
+                # The enclosing stages saw this peak too
+                for active in self._active:
+                    active['peak_rss'] = max(active['peak_rss'], record['peak_rss'])
+                self.records.append(record)
+            for hook in self.hooks:
+                try:
+                    hook(record)
+                except Exception as error:
+                    # Monitoring must never stop the pipeline
+                    warnings.warn('Profiler hook %r failed: %s' % (hook, error))
+
+    def report(self):
+        """
+        Stages aggregated by path (a stage run once per chunk appears once, with its
+        number of calls), in the order they first started.
+
+        Returns:
+            dict: 'stages' (list of per-path totals) and the overall 'peak_rss_mb'.
+        """
+        stages = {}
+        for record in sorted(self.records, key=lambda record: record['started']):
+            total = stages.setdefault(record['path'], {
+                'path': record['path'], 'name': record['name'], 'calls': 0, 'seconds': 0.0,
+                'peak_rss_mb': 0.0, 'rows_in': None, 'rows_out': None
+            })
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss'] / 2 ** 20)
+            for key in ['rows_in', 'rows_out']:
+                if record[key] is not None:
+                    total[key] = (total[key] or 0) + int(record[key])
+            for rule, rows in record.get('rejected', {}).items():
+                rejected = total.setdefault('rejected', {})
+                rejected[rule] = rejected.get(rule, 0) + int(rows)
+        return {
+            'stages': list(stages.values()),
+            'peak_rss_mb': max([total['peak_rss_mb'] for total in stages.values()], default=0.0)
+        }
+
+    def folded(self):
+        """
+        Stage self times in the folded stack format read by flamegraph.pl and speedscope,
+        one 'outer;inner microseconds' line per stage path.
+        """
+        totals = {}
+        for record in self.records:
+            totals[record['path']] = totals.get(record['path'], 0.0) + record['seconds']
+        lines = []
+        for path, seconds in totals.items():
+            children = sum(child_seconds for child, child_seconds in totals.items()
+                           if child.startswith(path + ';') and child.count(';') == path.count(';') + 1)
+            lines.append('%s %d' % (path, max(seconds - children, 0) * 1e6))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, report_path):
+        """Writes the report as JSON to `report_path` and the folded stacks next to it (.folded)."""
+        with open(report_path, 'w') as file:
+            json.dump(self.report(), file, indent=1)
+        with open(os.path.splitext(report_path)[0] + '.folded', 'w') as file:
+            file.write(self.folded())
+
+
+def load_hook(spec):
+    """
+    Imports a hook given as 'module:function', e.g. 'monitoring:send_stage'.
+
+    Returns:
+        callable: The hook.
+    """
+    module, _, function = spec.partition(':')
+    return getattr(importlib.import_module(module), function)
+
+
+# Profiler of the pipeline, enabled by data.py --profile or by adding a hook
+profiler = StageProfiler()
+stage = profiler.stage
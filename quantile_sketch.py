@@ -0,0 +1,146 @@
+# Description:  Mergeable log-bucket quantile sketches of trip distance and duration
+
+
+
+import numpy as np
+import pandas as pd
+
+# Every value is kept within 1% of its true value: the buckets grow geometrically by gamma
+relative_accuracy = 0.01
+gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+
+# Values below min_value (miles or minutes), including zero and negative ones, fall in
+# bucket 0 and are estimated as 0; it is half the 0.01 mile step of the trip distances,
+# so the shortest recorded trips are kept. The last bucket ends at
+# min_value * gamma ** 1023, about 3.8 million, and also holds anything above it
+min_value = 0.005
+n_buckets = 1024
+
+# Trip columns sketched, and the quantiles shown by the dashboards
+sketch_metrics = ['trip_distance', 'trip_duration']
+quantiles = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+
+# Types of the sketch columns, the metric and the bucket being group keys of the sketch tables
+sketch_dtypes = {
+    'metric': pd.CategoricalDtype(sketch_metrics),
+    'bucket': np.uint16
+}
+
+# Estimate of every bucket: the value within relative_accuracy of both of its bounds
+bucket_values = np.concatenate([[0.0], 2 * min_value * gamma ** np.arange(1, n_buckets) / (gamma + 1)])
+
+# Average column of pickup_dropoff_cleaned giving the value of every metric for the
+# groups of a single trip, whose sketches are left out of pickup_dropoff_sketch
+average_columns = {metric: 'avg_' + metric for metric in sketch_metrics}
+
+# Size of pickup_dropoff_sketch. A group (a pair of zones, month, day and time period)
+# holds few trips, so its sketch has about one bucket per trip and metric, whatever the
+# accuracy: the table grows by two rows per trip. The sketch of a single trip, the bucket
+# of its value, is rebuilt from pickup_dropoff_cleaned when queried (see
+# `compact_sketches`), so the table only grows with the trips sharing a group:
+# - 145k trips over 9 months, nearly all alone in their group: 3.3k rows instead of
+#   290k, 0.2 MB of CSV or 0.1 MB of Parquet instead of 17 MB or 1.2 MB;
+# - per million synthetic.py trips over 7 months, 60% of them sharing a group: 1.05
+#   million rows instead of 1.8 million, 62 MB of CSV or 2.5 MB of Parquet instead of
+#   107 MB or 4.8 MB.
+# Coarser buckets (10%) only remove 15% of these rows, and coarser groups do not help
+# either, as they still hold few trips each. The state keeps every sketch, a group
+# gaining trips when other files are ingested.
+
+
+def bucket_of(values):
+    """
+    Sketch bucket of every value: bucket i > 0 holds the values in
+    (min_value * gamma ** (i - 1), min_value * gamma ** i].
+
+    Parameters:
+        values (array-like): Trip distances or durations.
+
+    Returns:
+        ndarray: uint16 bucket numbers.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        buckets = np.ceil(np.log(values / min_value) / np.log(gamma))
+    return np.where(values >= min_value, np.clip(buckets, 1, n_buckets - 1), 0).astype(np.uint16)
+
+
+def partial_sketches(lyft, keys):
+    """
+    Sketches of trip distance and duration per group of `keys`, as the number of trips
+    in every bucket. Sketches of the same group are merged by adding these counts.
+
+    Parameters:
+        lyft (DataFrame): Cleaned trips, or one chunk of them.
+        keys (list): Group columns.
+
+    Returns:
+        DataFrame: keys, metric, bucket and trip_count, one row per non-empty bucket.
+    """
+    sketches = []
+    for metric in sketch_metrics:
+        buckets = lyft[keys].assign(metric=metric, bucket=bucket_of(lyft[metric]))
+        sketches.append(
+            buckets.groupby(keys + ['metric', 'bucket'], as_index=False, observed=True)
+            .size()
+            .rename(columns={'size': 'trip_count'})
+        )
+    sketches = pd.concat(sketches, ignore_index=True)
+    return sketches.astype({column: dtype for column, dtype in sketch_dtypes.items()})
+
+
+def compact_sketches(sketches, keys):
+    """
+    Sketches of the groups of more than one trip, the ones written to pickup_dropoff_sketch.
+    The sketch of a single trip is the bucket of its value, which `single_trip_sketches`
+    rebuilds exactly from the group's average.
+
+    Parameters:
+        sketches (DataFrame): Output of `partial_sketches` (or merged sketches).
+        keys (list): Group columns.
+
+    Returns:
+        DataFrame: The rows of the groups with more than one trip.
+    """
+    trips = sketches.groupby(keys + ['metric'], observed=True)['trip_count'].transform('sum')
+    return sketches[trips.to_numpy() > 1]
+
+
+def single_trip_sketches(stats, keys):
+    """
+    Sketches of the groups of a single trip, left out by `compact_sketches`.
+
+    Parameters:
+        stats (DataFrame): trip_count and the average_columns of every group of `keys`.
+        keys (list): Group columns.
+
+    Returns:
+        DataFrame: keys, metric, bucket and trip_count (1), one row per group and metric.
+    """
+    single = stats[stats['trip_count'] == 1]
+    sketches = pd.concat([
+        single[keys].assign(metric=metric, bucket=bucket_of(single[column]), trip_count=1)
+        for metric, column in average_columns.items()
+    ], ignore_index=True)
+    return sketches.astype({column: dtype for column, dtype in sketch_dtypes.items()})
+
+
+def sketch_quantiles(counts, levels):
+    """
+    Quantiles of merged sketches, from the trips counted in each bucket.
+
+    Parameters:
+        counts (ndarray): Trips per bucket, shape (..., n_buckets), e.g. one sketch per zone.
+        levels (list): Quantile levels between 0 and 1.
+
+    Returns:
+        ndarray: Shape (..., len(levels)), NaN for the sketches without trips.
+    """
+    cumulative = np.cumsum(counts, axis=-1)
+    total = cumulative[..., -1:]
+    # Nearest rank: the quantile is the first trip with at least level * trips trips up to it
+    # (rounded first, so that 0.9 * 10 trips is 9 and not 9.000000000000002)
+    ranks = np.ceil(np.round(np.asarray(levels, dtype=np.float64) * total, 9))
+    buckets = (cumulative[..., None, :] < ranks[..., :, None]).sum(axis=-1)
+    values = bucket_values[np.minimum(buckets, n_buckets - 1)]
+    return np.where(total > 0, values, np.nan)
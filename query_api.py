@@ -0,0 +1,367 @@
+# Description:  Asynchronous HTTP JSON API over the pickup, dropoff and pickup-dropoff aggregates, for services outside Streamlit
+
+
+
+import argparse
+import asyncio
+import json
+import os
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from od_cubes import build_od_cubes, filter_and_aggregate, load_zone_dimension, od_columns, sketch_columns
+from od_matrix import load_od_matrix
+from quantile_sketch import quantiles
+from query_cache import QueryCache, file_fingerprint
+from storage import read_table, table_path
+from zone_store import ZoneMetricStore, directions
+
+# Number of encoded responses kept in memory
+response_cache_size = 4096
+# Largest request body and number of queries accepted in one batch
+max_body_bytes = 1 << 20
+max_batch_queries = 1000
+
+# Kinds of query: the trips by zone of tlc_pickup.py and tlc_dropoff.py, the trips of
+# final_dashboard.py, which can be filtered on a pickup and a dropoff zone, and the
+# totals of the trips between a pickup and a dropoff zone, from the OD matrix of data.py
+kinds = list(directions) + ['od', 'pair']
+location_kinds = ['od', 'pair']
+filter_names = ['month', 'day', 'time_period']
+location_names = ['pickup_location', 'dropoff_location']
+
+# Columns returned for each kind (the od percentiles are added when the sketches exist)
+zone_columns = ['LocationID', 'zone', 'borough', 'trip_count']
+od_result_columns = zone_columns + ['avg_trip_duration', 'avg_trip_distance']
+
+
+class AggregateIndex:
+    """
+    The pickup and dropoff trip count cubes of the zone store, the cubes of the
+    pickup_dropoff statistics of final_dashboard.py and the memory-mapped OD matrix,
+    loaded once when the API starts, with the encoded responses kept in a shared cache.
+    Restart the API to serve new tables.
+    """
+
+    def __init__(self, path, shapefile_path=None, cache_size=response_cache_size):
+        """
+        Parameters:
+            path (str): Folder holding the cleaned tables and taxi_zones.shp.
+            shapefile_path (str): Path of taxi_zones.shp (in `path` when None).
+            cache_size (int): Number of encoded responses kept.
+        """
+        shapefile_path = shapefile_path or path + 'taxi_zones.shp'
+        tables = ['pickup_cleaned', 'dropoff_cleaned', 'pickup_dropoff_cleaned', 'pickup_dropoff_sketch']
+        self.version = file_fingerprint(*[table_path(path, table) for table in tables], shapefile_path)
+
+        self.store = ZoneMetricStore(path, shapefile_path, query_cache_size=0)
+        self.zones = load_zone_dimension(shapefile_path)
+
+        facts = read_table(path, 'pickup_dropoff_cleaned', columns=od_columns)
+        facts['PULocationID'] = facts['PULocationID'].astype(int)
+        facts['DOLocationID'] = facts['DOLocationID'].astype(int)
+        sketches = None
+        if os.path.exists(table_path(path, 'pickup_dropoff_sketch')):
+            sketches = read_table(path, 'pickup_dropoff_sketch', columns=sketch_columns)
+        self.cubes = build_od_cubes(facts, self.zones, sketches)
+
+        # Pair queries are only served by a matrix built from the pickup_dropoff_cleaned served
+        self.matrix = load_od_matrix(path)
+        if self.matrix is not None and self.matrix.meta['version'] != file_fingerprint(table_path(path, 'pickup_dropoff_cleaned')):
+            self.matrix = None
+
+        # Simplified geometry of the GeoJSON responses, by LocationID
+        self.geometry = {feature['properties']['LocationID']: feature['geometry'] for feature in self.store.zone_layer}
+        self._cache = QueryCache(cache_size)
+
+        # Values accepted by every filter of every kind of query, 'All' aside
+        self._labels = {direction: dict(zip(filter_names, self.store.labels(direction))) for direction in directions}
+        self._labels['od'] = dict(zip(filter_names, self.cubes['by_pickup']['labels']))
+        self._labels['od']['pickup_location'] = sorted(self.cubes['pickup_ids'])
+        self._labels['od']['dropoff_location'] = sorted(self.cubes['dropoff_ids'])
+        if self.matrix is not None:
+            self._labels['pair'] = self._labels['od']
+
+    def labels(self):
+        """Values accepted by every filter of every kind of query, 'All' aside."""
+        return self._labels
+
+    def _location(self, name, value):
+        """
+        Zone name of a location filter given as a zone name or a LocationID. A zone of the
+        shapefile without trips is accepted, its queries have no rows.
+        """
+        ids = self.cubes[name.replace('_location', '_ids')]
+        if value == 'All' or value in ids or value in self.zones['zone'].values:
+            return value
+        if value.isdigit():
+            # LocationIDs missing from the shapefile are grouped under 'Unknown'
+            for zone, location_ids in ids.items():
+                if int(value) in location_ids:
+                    return zone
+            if int(value) in self.zones.index:
+                return self.zones.loc[int(value), 'zone']
+        raise ValueError('unknown %s %r' % (name, value))
+
+    def _pair(self, filters, locations):
+        """
+        Trips between the selected pickup and dropoff zones (a zone name may have several
+        LocationIDs), from one block of the OD matrix: their count and their mean distance
+        and duration, weighted by trip rather than by pickup_dropoff_cleaned row.
+        """
+        zone_ids = [None if location == 'All' else self.cubes[name.replace('_location', '_ids')].get(location, [])
+                    for name, location in zip(location_names, locations)]
+        block = self.matrix.select(*filters, *zone_ids)
+        sums = {metric: values.sum(dtype=np.float64) for metric, values in block.items()}
+        means = self.matrix.means(sums)
+        count = int(sums['count'])
+        return {
+            'trip_count': count,
+            'avg_trip_duration': round(float(means['duration']), 0) if count else None,
+            'avg_trip_distance': round(float(means['distance']), 2) if count else None
+        }
+
+    def _query(self, kind, filters, locations):
+        """Rows of the zones with trips for one query, without the cache."""
+        if kind == 'od':
+            rows = filter_and_aggregate(self.cubes, self.zones, *filters, *locations)
+            columns = od_result_columns + [column for column in rows if column.split('_')[0] in quantiles]
+        else:
+            rows = self.store.aggregate(kind, *filters)
+            columns = zone_columns
+        return pd.DataFrame(rows[columns])
+
+    def query(self, params):
+        """
+        Encoded response of one query, from the cache when the same query was answered before.
+
+        Parameters:
+            params (dict): 'kind' ('pickup', 'dropoff', 'od' or 'pair'), optional month,
+                day and time_period, pickup_location and dropoff_location (od and pair
+                only, zone names or LocationIDs), 'top' (keep the K zones with the most
+                trips) and 'geometry' (a GeoJSON FeatureCollection instead of rows), which
+                do not apply to pair.
+
+        Returns:
+            bytes: The JSON response.
+
+        Raises:
+            ValueError: For an unknown kind, filter value or parameter.
+        """
+        params = {name: str(value).strip() for name, value in params.items() if value is not None}
+        kind = params.pop('kind', None)
+        if kind not in kinds:
+            raise ValueError('kind must be one of %s, not %r' % (', '.join(kinds), kind))
+        if kind == 'pair' and self.matrix is None:
+            raise ValueError('pair queries need the OD matrix of the tables served, written by data.py')
+        labels = self._labels[kind]
+
+        filters = tuple(params.pop(name, 'All') for name in filter_names)
+        for name, value in zip(filter_names, filters):
+            if value != 'All' and value not in labels[name]:
+                raise ValueError('unknown %s %r, expected All or one of %s' % (name, value, ', '.join(labels[name])))
+        locations = ()
+        if kind in location_kinds:
+            locations = tuple(self._location(name, params.pop(name, 'All')) for name in location_names)
+
+        top = params.pop('top', '')
+        if top and (not top.isdigit() or int(top) == 0):
+            raise ValueError('top must be a positive integer, not %r' % top)
+        geometry = params.pop('geometry', '0').lower() in ('1', 'true', 'yes')
+        if kind == 'pair' and (top or geometry):
+            raise ValueError('top and geometry do not apply to pair queries')
+        if params:
+            raise ValueError('unknown parameters: %s' % ', '.join(sorted(params)))
+
+        return self._cache.get(
+            self.version,
+            (kind,) + filters + locations + (top, geometry),
+            lambda: self.encode(kind, filters, locations, int(top) if top else None, geometry)
+        )
+
+    def encode(self, kind, filters, locations, top, geometry):
+        """Computes and encodes the response of `query`."""
+        if kind == 'pair':
+            response = {'kind': kind, 'filters': dict(zip(filter_names + location_names, filters + locations))}
+            response.update(self._pair(filters, locations))
+            return json.dumps(response, separators=(',', ':')).encode()
+
+        rows = self._query(kind, filters, locations)
+        zones, total = len(rows), int(rows['trip_count'].sum())
+        rows = rows.sort_values(['trip_count', 'LocationID'], ascending=[False, True])
+        if top:
+            rows = rows.head(top)
+        # Missing names and percentiles become null
+        records = rows.astype(object).where(rows.notna(), None).to_dict('records')
+
+        response = {
+            'kind': kind,
+            'filters': dict(zip(filter_names + (location_names if kind in location_kinds else []), filters + locations)),
+            'zones': zones,
+            'trip_count': total
+        }
+        if geometry:
+            response.update({'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'geometry': self.geometry.get(record['LocationID']), 'properties': record}
+                for record in records
+            ]})
+        else:
+            response['rows'] = records
+        return json.dumps(response, default=_json_default, separators=(',', ':')).encode()
+
+    def cache_stats(self):
+        """Hits and misses of the response cache."""
+        return self._cache.stats()
+
+
+def _json_default(value):
+    """NumPy scalars left in the rows, as Python numbers."""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+class QueryServer:
+    """
+    HTTP/1.1 server of the API on asyncio streams, with keep-alive connections. Queries
+    run in worker threads, so that a slow query does not hold up the other connections.
+
+    GET /pickup, /dropoff, /od and /pair take the parameters of `AggregateIndex.query`
+    in the query string; POST /batch takes {"queries": [params, ...]} and answers every query
+    (or its error) in order; GET /labels lists the filter values and GET /health the
+    version and the cache counters.
+    """
+
+    def __init__(self, index):
+        self.index = index
+
+    async def handle(self, reader, writer):
+        """Answers the requests of one connection until it is closed."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    method, target, protocol = request_line.decode('latin-1').split()
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    await self.send(writer, HTTPStatus.BAD_REQUEST, _error('malformed request'), keep_alive=False)
+                    break
+                if length > max_body_bytes:
+                    await self.send(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, _error('body over %d bytes' % max_body_bytes),
+                                    keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b''
+
+                keep_alive = protocol == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                status, content_type, payload = await self.respond(method, target, body)
+                await self.send(writer, status, payload, content_type, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target, body):
+        """Status, content type and body of the response to one request."""
+        url = urlsplit(target)
+        route = url.path.rstrip('/') or '/'
+        try:
+            if route in ['/' + kind for kind in kinds]:
+                if method != 'GET':
+                    return _not_allowed('GET')
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                params['kind'] = route[1:]
+                payload = await asyncio.to_thread(self.index.query, params)
+                return HTTPStatus.OK, _content_type(params), payload
+            if route == '/batch':
+                if method != 'POST':
+                    return _not_allowed('POST')
+                return HTTPStatus.OK, 'application/json', await asyncio.to_thread(self.batch, body)
+            if route == '/labels':
+                return HTTPStatus.OK, 'application/json', json.dumps(self.index.labels()).encode()
+            if route == '/health':
+                health = {'status': 'ok', 'version': self.index.version, 'cache': self.index.cache_stats()}
+                return HTTPStatus.OK, 'application/json', json.dumps(health).encode()
+        except ValueError as error:
+            return HTTPStatus.BAD_REQUEST, 'application/json', _error(str(error))
+        return HTTPStatus.NOT_FOUND, 'application/json', _error('no route %s' % url.path)
+
+    def batch(self, body):
+        """
+        Encoded answers of a batch of queries, in order; a failing query gets an error
+        object and does not fail the others. Cached answers are reused as they are.
+        """
+        try:
+            queries = json.loads(body)['queries']
+        except (ValueError, KeyError, TypeError):
+            raise ValueError('the body must be {"queries": [...]}')
+        if not isinstance(queries, list) or len(queries) > max_batch_queries:
+            raise ValueError('queries must be a list of at most %d queries' % max_batch_queries)
+
+        answers = []
+        for params in queries:
+            try:
+                if not isinstance(params, dict):
+                    raise ValueError('every query must be an object')
+                answers.append(self.index.query(params))
+            except ValueError as error:
+                answers.append(_error(str(error)))
+        return b'{"results":[' + b','.join(answers) + b']}'
+
+    async def send(self, writer, status, payload, content_type='application/json', keep_alive=True):
+        writer.write((
+            'HTTP/1.1 %d %s\r\n'
+            'Content-Type: %s\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: %s\r\n'
+            '\r\n' % (status, status.phrase, content_type, len(payload), 'keep-alive' if keep_alive else 'close')
+        ).encode('latin-1') + payload)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        """Serves the API on host:port until cancelled."""
+        server = await asyncio.start_server(self.handle, host, port)
+        print('Serving the aggregates on http://%s:%d' % (host, port))
+        async with server:
+            await server.serve_forever()
+
+
+def _error(message):
+    return json.dumps({'error': message}).encode()
+
+
+def _not_allowed(method):
+    return HTTPStatus.METHOD_NOT_ALLOWED, 'application/json', _error('use %s' % method)
+
+
+def _content_type(params):
+    if str(params.get('geometry', '0')).lower() in ('1', 'true', 'yes'):
+        return 'application/geo+json'
+    return 'application/json'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the trip aggregates as an HTTP JSON API.')
+    parser.add_argument('path', help='Folder holding the cleaned tables and taxi_zones.shp.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--shapefile', default=None, help='Path of taxi_zones.shp (in the data folder by default).')
+    parser.add_argument('--cache-size', type=int, default=response_cache_size, help='Number of responses kept in memory.')
+    args = parser.parse_args()
+
+    index = AggregateIndex(args.path, args.shapefile, args.cache_size)
+    asyncio.run(QueryServer(index).serve(args.host, args.port))
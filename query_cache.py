@@ -0,0 +1,124 @@
+# Description:  Process-wide LRU cache for the dashboards' filter_and_aggregate results
+
+
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+# One cache per dashboard, shared by every Streamlit session of the process
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class QueryCache:
+    """
+    Least recently used cache of query results keyed on a dataset version and the
+    normalized filter values, with hit and miss counters.
+
+    Results are shared between sessions, so callers must not modify them in place.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, version, filters, compute):
+        """
+        Returns the cached result of a query, computing and storing it on a miss.
+
+        Parameters:
+            version (str): Fingerprint of the data the query runs on.
+            filters (tuple): Filter values of the query.
+            compute (callable): Computes the result when it is not cached.
+
+        Returns:
+            The query result.
+        """
+        key = (version, normalize_filters(filters))
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+
+        # Computed outside the lock so that other sessions are not blocked meanwhile
+        result = compute()
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return result
+
+    def stats(self):
+        """Hits, misses and number of cached results."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def clear(self):
+        """Drops every cached result and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+def get_query_cache(name, maxsize=256):
+    """
+    The process-wide cache called `name`, created on first use.
+
+    Parameters:
+        name (str): Cache name, one per dashboard.
+        maxsize (int): Number of results kept before the least recently used is evicted.
+
+    Returns:
+        QueryCache: The shared cache.
+    """
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = QueryCache(maxsize)
+        cache = _caches[name]
+        cache.maxsize = maxsize
+        return cache
+
+
+def normalize_filters(filters):
+    """Makes equivalent filter values equal: None means 'All' and values are stripped strings."""
+    return tuple('All' if value is None else str(value).strip() for value in filters)
+
+
+def file_fingerprint(*paths):
+    """
+    Version of files or folders (such as Parquet datasets) from their names, sizes and
+    modification times, without reading them.
+
+    Parameters:
+        paths (str): Files or folders.
+
+    Returns:
+        str: Hex digest that changes when any of the files changes.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(folder, name) for folder, _, names in os.walk(path) for name in names)
+        for file in files:
+            if os.path.exists(file):
+                stat = os.stat(file)
+                digest.update(('%s|%d|%d;' % (file, stat.st_size, stat.st_mtime_ns)).encode())
+            else:
+                digest.update(('%s|missing;' % file).encode())
+    return digest.hexdigest()
+
+
+def frame_fingerprint(frame):
+    """Version of an in-memory DataFrame from a hash of its contents."""
+    return '%016x' % (int(pd.util.hash_pandas_object(frame, index=False).sum()) & (2 ** 64 - 1))
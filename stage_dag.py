@@ -0,0 +1,326 @@
+# Description:  Small DAG of pipeline stages whose outputs are cached on disk under a hash of their code, parameters and inputs
+
+
+
+import argparse
+import hashlib
+import importlib
+import importlib.util
+import inspect
+import json
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from profiler import stage
+from query_cache import file_fingerprint
+
+# File suffix of the cached output of each kind of stage
+output_suffixes = {'frame': '.parquet', 'array': '.npy'}
+
+# Key and output digest of every stage's last run, in the cache folder
+manifest_name = 'manifest.json'
+
+
+class StageDAG:
+    """
+    Stages added in dependency order, each a function called with the outputs of the
+    stages it depends on. The key of a stage hashes its name, the source of its function
+    and of the helpers and modules it calls, its parameters, the fingerprint of its
+    source files and the digests of the contents of its inputs, so an upstream stage that
+    runs again but returns the same data does not invalidate the stages after it.
+
+    `run` resolves the stages in order: a stage whose key matches its last run reuses
+    its cached output, the others run; the outputs they need from unchanged stages are
+    read back from the cache. A stage that writes files (output None) is skipped when
+    its key is the one it last ran with and its files were not changed since.
+    Independent stages run in parallel threads.
+
+    A change to code the stage function calls only changes its key when that code is in
+    its `depends` (a module covers its constants too, and may be given by name so it is
+    not imported); pass other values it depends on as `config`, or use `run(force=True)`.
+    `check_invalidation` checks that editing a helper reruns the stages after it.
+    """
+
+    def __init__(self, cache_dir, workers=1):
+        """
+        Parameters:
+            cache_dir (str): Folder the stage outputs are kept in, one sub-folder per stage.
+            workers (int): Number of stages run at the same time.
+        """
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, function, inputs=(), params=None, output='frame', sources=(), targets=(), after=(), config=None,
+            depends=()):
+        """
+        Adds a stage, after the stages it depends on.
+
+        Parameters:
+            name (str): Stage name.
+            function (callable): Called as function(*input outputs, **params).
+            inputs (list): Stages whose outputs are passed to the function, in order.
+            params (dict): Keyword arguments of the function.
+            output (str): 'frame' (DataFrame), 'array' (ndarray) or None for a stage that
+                only writes `targets`.
+            sources (list): Files read by the stage, fingerprinted into its key.
+            targets (list): Files or folders written by a stage without output, or whose
+                changes it must follow.
+            after (list): Stages that must run first, without passing their output.
+            config (dict): Values the function depends on without taking them as
+                parameters, e.g. module constants.
+            depends (list): Functions and modules (or module names) the function calls,
+                whose source is hashed into the key.
+        """
+        for upstream in list(inputs) + list(after):
+            if upstream not in self.stages:
+                raise ValueError('Stage %s depends on %s, which must be added before it' % (name, upstream))
+        if output is not None and output not in output_suffixes:
+            raise ValueError('Unknown output %r of stage %s' % (output, name))
+        self.stages[name] = {
+            'name': name, 'function': function, 'inputs': list(inputs), 'params': params or {},
+            'output': output, 'sources': list(sources), 'targets': list(targets), 'after': list(after),
+            'config': config or {}, 'depends': list(depends)
+        }
+
+    def key(self, name, digests):
+        """Key of a stage, from its definition and the `digests` (by stage name) of the stages it depends on."""
+        definition = self.stages[name]
+        digest = hashlib.sha1()
+        for part in [
+            name,
+            inspect.getsource(definition['function']),
+            ''.join(dependency_source(dependency) for dependency in definition['depends']),
+            json.dumps([definition['params'], definition['config'], definition['output']], sort_keys=True, default=str),
+            file_fingerprint(*definition['sources']) if definition['sources'] else '',
+            ' '.join(digests[upstream] for upstream in definition['inputs'] + definition['after'])
+        ]:
+            digest.update(part.encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _output_path(self, name, key):
+        return os.path.join(self.cache_dir, name, key + output_suffixes[self.stages[name]['output']])
+
+    def read_manifest(self):
+        """Key and digest of the last run of every stage (empty before the first run)."""
+        manifest_path = os.path.join(self.cache_dir, manifest_name)
+        if not os.path.exists(manifest_path):
+            return {}
+        with open(manifest_path) as file:
+            return json.load(file)
+
+    def _write_manifest(self, manifest):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        manifest_path = os.path.join(self.cache_dir, manifest_name)
+        with open(manifest_path + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def _is_current(self, name, key, entry):
+        """Whether the last run of the stage had `key` and its output is still there as it was written."""
+        if entry is None or entry['key'] != key:
+            return False
+        definition = self.stages[name]
+        if definition['output'] is not None:
+            return os.path.exists(self._output_path(name, key))
+        return entry['targets'] == file_fingerprint(*definition['targets'])
+
+    def _save(self, name, key, value):
+        """Caches a stage output under its key, dropping the outputs of its previous keys."""
+        output_path = self._output_path(name, key)
+        folder = os.path.dirname(output_path)
+        os.makedirs(folder, exist_ok=True)
+        with open(output_path + '.tmp', 'wb') as file:
+            if self.stages[name]['output'] == 'frame':
+                value.to_parquet(file, engine='pyarrow')
+            else:
+                np.save(file, value)
+        os.replace(output_path + '.tmp', output_path)
+        for old in os.listdir(folder):
+            if old != os.path.basename(output_path):
+                os.remove(os.path.join(folder, old))
+
+    def _load(self, name, key):
+        output_path = self._output_path(name, key)
+        if self.stages[name]['output'] == 'frame':
+            return pd.read_parquet(output_path, engine='pyarrow')
+        return np.load(output_path)
+
+    def run(self, force=False):
+        """
+        Runs the stages whose outputs are missing or outdated.
+
+        Parameters:
+            force (bool): Run every stage, as if nothing was cached.
+
+        Returns:
+            dict: Names of the stages 'run' and 'reused', in the order they were resolved.
+        """
+        manifest = self.read_manifest()
+        digests = {}
+        keys = {}
+        ran, reused = [], []
+
+        # Outputs are kept in memory until every stage taking them is resolved
+        values = {}
+        load_locks = {name: threading.Lock() for name in self.stages}
+        users = {name: sum(name in definition['inputs'] for definition in self.stages.values()) for name in self.stages}
+
+        def input_value(name):
+            # Outputs of reused stages are read from the cache once, by the first stage needing them
+            with load_locks[name]:
+                with self._lock:
+                    if name in values:
+                        return values[name]
+                value = self._load(name, keys[name])
+                with self._lock:
+                    values[name] = value
+                return value
+
+        def release_inputs(name):
+            with self._lock:
+                for upstream in self.stages[name]['inputs']:
+                    users[upstream] -= 1
+                    if not users[upstream]:
+                        values.pop(upstream, None)
+
+        def run_stage(name):
+            definition = self.stages[name]
+            args = []
+            for upstream in definition['inputs']:
+                value = input_value(upstream)
+                # Stages running in parallel each get their own frame (sharing the data),
+                # as pandas caches columns on the frame object
+                args.append(value.copy(deep=False) if isinstance(value, pd.DataFrame) else value)
+            rows_in = len(args[0]) if args and isinstance(args[0], pd.DataFrame) else None
+            with stage(name, rows_in) as record:
+                value = definition['function'](*args, **definition['params'])
+                if isinstance(value, pd.DataFrame):
+                    record['rows_out'] = len(value)
+
+            entry = {'key': keys[name]}
+            if definition['output'] is None:
+                entry.update({'digest': keys[name], 'targets': file_fingerprint(*definition['targets'])})
+            else:
+                with stage('cache.' + name):
+                    entry['digest'] = content_digest(value)
+                    self._save(name, keys[name], value)
+            with self._lock:
+                if definition['output'] is not None and users[name]:
+                    values[name] = value
+                manifest[name] = entry
+                self._write_manifest(manifest)
+            release_inputs(name)
+            return entry['digest']
+
+        def resolve(remaining, submit):
+            # Reuses or submits every stage whose dependencies are resolved, until none is left
+            progress = True
+            while progress:
+                progress = False
+                for name in list(remaining):
+                    definition = self.stages[name]
+                    if not all(upstream in digests for upstream in definition['inputs'] + definition['after']):
+                        continue
+                    remaining.remove(name)
+                    keys[name] = self.key(name, digests)
+                    if not force and self._is_current(name, keys[name], manifest.get(name)):
+                        digests[name] = manifest[name]['digest']
+                        reused.append(name)
+                        release_inputs(name)
+                        progress = True
+                    else:
+                        ran.append(name)
+                        submit(name)
+                        progress = True
+
+        remaining = list(self.stages)
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                running = {}
+                resolve(remaining, lambda name: running.update({executor.submit(run_stage, name): name}))
+                while running:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        digests[running.pop(future)] = future.result()
+                    resolve(remaining, lambda name: running.update({executor.submit(run_stage, name): name}))
+        else:
+            resolve(remaining, lambda name: digests.update({name: run_stage(name)}))
+
+        return {'run': ran, 'reused': reused}
+
+
+def dependency_source(dependency):
+    """Source of a function or module of a stage's `depends`, a module given by name being read without importing it."""
+    if isinstance(dependency, str):
+        with open(importlib.util.find_spec(dependency).origin) as file:
+            return file.read()
+    return inspect.getsource(dependency)
+
+
+def content_digest(value):
+    """Hash of the contents of a stage output: the values, index and dtypes of a DataFrame, or an array's bytes."""
+    digest = hashlib.sha1()
+    if isinstance(value, pd.DataFrame):
+        digest.update(str(list(zip(value.columns, value.dtypes.astype(str)))).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    else:
+        digest.update(str((value.dtype, value.shape)).encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    return digest.hexdigest()
+
+
+def check_invalidation():
+    """
+    Runs a small DAG whose stages call the helpers of a module written to a temporary
+    folder, edits one helper and runs it again: the stages calling it directly or
+    through their depends, and the stages after them, must run again, the others be reused.
+
+    Returns:
+        list: Differences from the expected stages run, empty when the check passes.
+    """
+    helper_source = 'def scale(values):\n    return values * %d\n\n\ndef shift(values):\n    return values + 1\n'
+    with tempfile.TemporaryDirectory() as folder:
+        module_path = os.path.join(folder, 'stage_dag_helpers.py')
+        sys.path.insert(0, folder)
+        dont_write_bytecode, sys.dont_write_bytecode = sys.dont_write_bytecode, True
+        try:
+            differences = []
+            for factor, expected in [(2, None), (3, ['scaled', 'summed', 'by_name'])]:
+                with open(module_path, 'w') as file:
+                    file.write(helper_source % factor)
+                helpers = importlib.reload(sys.modules['stage_dag_helpers']) if factor != 2 else \
+                    importlib.import_module('stage_dag_helpers')
+
+                dag = StageDAG(os.path.join(folder, 'cache'))
+                dag.add('values', lambda: pd.DataFrame({'value': np.arange(10)}))
+                dag.add('scaled', lambda frame: frame.assign(value=helpers.scale(frame['value'])), ['values'],
+                        depends=[helpers.scale])
+                dag.add('shifted', lambda frame: frame.assign(value=helpers.shift(frame['value'])), ['values'],
+                        depends=[helpers.shift])
+                dag.add('summed', lambda frame: frame.sum().to_frame('total'), ['scaled'])
+                dag.add('by_name', lambda frame: frame, ['values'], depends=['stage_dag_helpers'])
+                ran = dag.run()['run']
+                if expected is not None and ran != expected:
+                    differences.append('after editing scale: ran %s, expected %s' % (ran, expected))
+            return differences
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+            sys.path.remove(folder)
+            sys.modules.pop('stage_dag_helpers', None)
+
+
+if __name__ == '__main__':
+    argparse.ArgumentParser(description='Check that editing a helper of a stage reruns the stages after it.').parse_args()
+    differences = check_invalidation()
+    print('stage invalidation: %s' % ('OK' if not differences else 'FAILED'))
+    for difference in differences:
+        print('  ' + difference)
@@ -0,0 +1,135 @@
+# Description:  Reads and writes the cleaned tables as CSV or as Parquet datasets partitioned by month
+
+
+
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from features import month_names
+
+formats = ['csv', 'parquet']
+partition_column = 'month'
+
+
+def detect_format(path, name):
+    """
+    Tells how a cleaned table is stored.
+
+    Parameters:
+        path (str): Folder holding the cleaned tables.
+        name (str): Table name without extension, e.g. 'pickup_cleaned'.
+
+    Returns:
+        str: 'parquet' when a Parquet dataset folder of the table exists, 'csv' otherwise.
+        When both exist (written before `write_table` removed the other format), the
+        newer one.
+    """
+    if not os.path.isdir(path + name):
+        return 'csv'
+    if os.path.exists(path + name + '.csv') and os.path.getmtime(path + name + '.csv') > os.path.getmtime(path + name):
+        return 'csv'
+    return 'parquet'
+
+
+def table_path(path, name):
+    """File (CSV) or folder (Parquet dataset) holding a cleaned table."""
+    return path + name if detect_format(path, name) == 'parquet' else path + name + '.csv'
+
+
+def write_table(frame, path, name, format='csv', part=None):
+    """
+    Writes a cleaned table as path+name+'.csv', or as a Parquet dataset in the folder
+    path+name with one sub-folder per month. Categorical columns are kept as
+    dictionary-encoded Parquet columns.
+
+    Parameters:
+        frame (DataFrame): The table, or one chunk of it.
+        path (str): Output folder.
+        name (str): Table name without extension.
+        format (str): 'csv' or 'parquet'.
+        part (int): Chunk number when the table is written chunk by chunk; the first
+            chunk (0 or None) replaces any previous output of the table, in either
+            format, later chunks are appended.
+    """
+    if format == 'csv':
+        # The readers would otherwise keep serving an older Parquet dataset of the table
+        if not part and os.path.isdir(path + name):
+            shutil.rmtree(path + name)
+        frame.to_csv(path_or_buf=path+name+'.csv', mode='a' if part else 'w', header=not part)
+        return
+
+    if not part:
+        if os.path.isdir(path + name):
+            shutil.rmtree(path + name)
+        if os.path.exists(path + name + '.csv'):
+            os.remove(path + name + '.csv')
+    frame.to_parquet(
+        path + name,
+        engine='pyarrow',
+        index=False,
+        partition_cols=[partition_column],
+        basename_template='part-%d-{i}.parquet' % (part or 0)
+    )
+
+
+def read_table(path, name, columns=None, month=None):
+    """
+    Reads a cleaned table written by `write_table`, in whichever format it was stored.
+
+    For Parquet only the requested columns are read, and the month filter is pushed
+    down to the reader so that the other month partitions are never opened.
+
+    Parameters:
+        path (str): Folder holding the cleaned tables.
+        name (str): Table name without extension.
+        columns (list): Columns to read (all when None).
+        month (str): Only read this month (all months when None).
+
+    Returns:
+        DataFrame: The table, with month as an ordered categorical.
+    """
+    if detect_format(path, name) == 'csv':
+        usecols = columns
+        if columns is not None and month is not None and partition_column not in columns:
+            usecols = list(columns) + [partition_column]
+        frame = pd.read_csv(path + name + '.csv', usecols=usecols)
+        if month is not None:
+            frame = frame[frame[partition_column] == month].reset_index(drop=True)
+        if usecols is not columns:
+            frame = frame.drop(columns=partition_column)
+    else:
+        filters = None if month is None else [(partition_column, '==', month)]
+        # Read the month folders as plain strings, trips without a month have a null partition
+        partitioning = ds.partitioning(pa.schema([(partition_column, pa.string())]), flavor='hive')
+        frame = pd.read_parquet(path + name, engine='pyarrow', columns=columns, filters=filters,
+                                partitioning=partitioning)
+
+    if partition_column in frame:
+        frame[partition_column] = frame[partition_column].astype(
+            pd.CategoricalDtype(month_names, ordered=True))
+    return frame
+
+
+def table_months(path, name):
+    """
+    Months present in a cleaned table. For Parquet this only lists the partition folders.
+
+    Parameters:
+        path (str): Folder holding the cleaned tables.
+        name (str): Table name without extension.
+
+    Returns:
+        list: Month names.
+    """
+    if detect_format(path, name) == 'csv':
+        return list(pd.read_csv(path + name + '.csv', usecols=[partition_column])[partition_column].dropna().unique())
+
+    prefix = partition_column + '='
+    return [
+        folder[len(prefix):] for folder in os.listdir(path + name)
+        if folder.startswith(prefix) and folder[len(prefix):] in month_names
+    ]
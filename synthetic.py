@@ -0,0 +1,167 @@
+# Description:  Deterministic synthetic TLC yellow taxi trips for benchmarks and machines without the real data
+
+
+
+import argparse
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+zones_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taxi_zones.shp')
+
+# Share of trips starting in each hour of the day (0-23) and on each weekday (Monday first),
+# shaped after the published TLC yellow taxi volumes
+hour_weights = np.array([2.9, 2.0, 1.4, 1.0, 0.8, 1.0, 2.0, 3.4, 4.3, 4.4, 4.6, 4.8,
+                         5.1, 5.2, 5.5, 5.8, 5.9, 6.2, 6.8, 6.5, 5.8, 5.5, 5.0, 4.0])
+day_weights = np.array([13.2, 14.2, 15.0, 15.4, 15.6, 14.6, 12.0])
+
+# Values of the categorical columns and their shares; 99 and 0 are the invalid codes data.py drops
+passenger_counts = ([0, 1, 2, 3, 4, 5, 6], [2, 72, 14, 4, 2, 3, 3])
+ratecode_ids = ([1, 2, 3, 4, 5, 99], [93, 3, 0.5, 0.3, 0.7, 2.5])
+
+# Share of trips with the nullable columns missing, as in the TLC files
+missing_share = 0.03
+# LocationIDs 264 and 265 (unknown zones) are in the TLC files but not in the shapefile
+unknown_ids = [264, 265]
+
+trip_columns = ['VendorID', 'tpep_pickup_datetime', 'tpep_dropoff_datetime', 'passenger_count', 'trip_distance',
+                'RatecodeID', 'store_and_fwd_flag', 'PULocationID', 'DOLocationID', 'fare_amount']
+
+
+def zone_weights(seed=0, shapefile_path=zones_path):
+    """
+    LocationIDs of the taxi zones and how often trips start or end in each of them.
+    Manhattan zones are busier, the unknown zones get a small share.
+
+    Parameters:
+        seed (int): Seed of the per-zone popularity.
+        shapefile_path (str): Path of taxi_zones.shp.
+
+    Returns:
+        tuple: (LocationIDs, weights summing to 1)
+    """
+    zones = gpd.read_file(shapefile_path, ignore_geometry=True).drop_duplicates('LocationID')
+    rng = np.random.default_rng(seed)
+    weights = rng.lognormal(0, 1.2, len(zones)) * np.where(zones['borough'] == 'Manhattan', 8, 1)
+    ids = np.r_[zones['LocationID'].to_numpy(dtype=np.int64), unknown_ids]
+    weights = np.r_[weights, np.full(len(unknown_ids), weights.sum() * 0.005)]
+    return ids, weights / weights.sum()
+
+
+def generate_trips(rows, rng, zones, start='2024-01-01', end='2024-08-01'):
+    """
+    One batch of synthetic trips with the columns of the TLC yellow taxi files.
+
+    Parameters:
+        rows (int): Number of trips.
+        rng (Generator): Random generator the batch is drawn from.
+        zones (tuple): Output of `zone_weights`.
+        start (str): First pickup date.
+        end (str): Day after the last pickup date.
+
+    Returns:
+        DataFrame: The trips, in no particular order.
+    """
+    # Pickup dates weighted by their weekday, then the hour, then minutes and seconds
+    dates = pd.date_range(start, end, freq='D', inclusive='left')
+    date_weights = day_weights[dates.weekday]
+    days = rng.choice(dates.to_numpy(), rows, p=date_weights / date_weights.sum())
+    seconds = rng.choice(24, rows, p=hour_weights / hour_weights.sum()) * 3600 + rng.integers(0, 3600, rows)
+    pickup = days + seconds.astype('timedelta64[s]')
+
+    # Distance in miles and a duration from a noisy average speed
+    distance = np.round(rng.lognormal(np.log(1.9), 0.8, rows), 2)
+    speed = np.clip(rng.normal(11, 3, rows), 3, 40)
+    duration = distance / speed * 3600 + rng.integers(60, 300, rows)
+    dropoff = pickup + duration.astype('timedelta64[s]')
+
+    ids, weights = zones
+    pickup_ids = rng.choice(ids, rows, p=weights)
+    dropoff_ids = np.where(rng.random(rows) < 0.1, pickup_ids, rng.choice(ids, rows, p=weights))
+
+    passenger_count = rng.choice(passenger_counts[0], rows, p=np.divide(passenger_counts[1], sum(passenger_counts[1])))
+    ratecode = rng.choice(ratecode_ids[0], rows, p=np.divide(ratecode_ids[1], sum(ratecode_ids[1])))
+    missing = rng.random(rows) < missing_share
+
+    return pd.DataFrame({
+        'VendorID': rng.choice([1, 2], rows, p=[0.3, 0.7]),
+        'tpep_pickup_datetime': pickup,
+        'tpep_dropoff_datetime': dropoff,
+        'passenger_count': np.where(missing, np.nan, passenger_count),
+        'trip_distance': distance,
+        'RatecodeID': np.where(missing, np.nan, ratecode),
+        'store_and_fwd_flag': np.where(missing, None, np.where(rng.random(rows) < 0.005, 'Y', 'N')),
+        'PULocationID': pickup_ids,
+        'DOLocationID': dropoff_ids,
+        'fare_amount': np.round(3 + 2.5 * distance + duration / 60 * 0.5, 2)
+    }, columns=trip_columns)
+
+
+def write_trips(path, rows, seed=0, start='2024-01-01', end='2024-08-01', format='csv', chunk_rows=1_000_000,
+                monthly=False):
+    """
+    Writes `rows` synthetic trips as path+'trips.csv' (or trips.parquet), generated and
+    written `chunk_rows` at a time so that any row count fits in memory. The same
+    arguments always give the same file.
+
+    Parameters:
+        path (str): Output folder.
+        rows (int): Number of trips, e.g. 1_000_000 to 100_000_000.
+        seed (int): Seed of the whole file.
+        start (str): First pickup date.
+        end (str): Day after the last pickup date.
+        format (str): 'csv' or 'parquet'.
+        chunk_rows (int): Trips generated per batch.
+        monthly (bool): Write one file per pickup month (trips_2024-01.csv, ...) instead,
+            like the monthly files TLC publishes.
+
+    Returns:
+        list: Paths of the written files.
+    """
+    os.makedirs(path, exist_ok=True)
+    zones = zone_weights(seed)
+    writers = {}
+    files = []
+
+    for chunk, offset in enumerate(range(0, rows, chunk_rows)):
+        # Each batch has its own stream, so the output does not depend on what ran before
+        rng = np.random.default_rng([seed, chunk])
+        trips = generate_trips(min(chunk_rows, rows - offset), rng, zones, start, end)
+        groups = trips.groupby(trips['tpep_pickup_datetime'].dt.strftime('_%Y-%m')) if monthly else [('', trips)]
+
+        for suffix, group in groups:
+            file = os.path.join(path, 'trips%s.%s' % (suffix, format))
+            if format == 'csv':
+                group.to_csv(file, mode='a' if file in files else 'w', header=file not in files, index=False)
+            else:
+                table = pa.Table.from_pandas(group, preserve_index=False)
+                if file not in writers:
+                    writers[file] = pq.ParquetWriter(file, table.schema)
+                writers[file].write_table(table.cast(writers[file].schema))
+            if file not in files:
+                files.append(file)
+
+    for writer in writers.values():
+        writer.close()
+    return files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic TLC trips.')
+    parser.add_argument('--path', default='synthetic/', help='Output folder.')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='Number of trips.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--start', default='2024-01-01', help='First pickup date.')
+    parser.add_argument('--end', default='2024-08-01', help='Day after the last pickup date.')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--chunk-rows', type=int, default=1_000_000, help='Trips generated per batch.')
+    parser.add_argument('--monthly', action='store_true', help='Write one file per pickup month.')
+    args = parser.parse_args()
+
+    for file in write_trips(args.path, args.rows, args.seed, args.start, args.end, args.format, args.chunk_rows,
+                            args.monthly):
+        print(file)
@@ -0,0 +1,150 @@
+# Description:  Assigns taxi zone LocationIDs to pickup and dropoff coordinates with a spatial index over taxi_zones.shp
+
+
+
+import os
+from functools import lru_cache
+
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from query_cache import file_fingerprint
+
+zones_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'taxi_zones.shp')
+
+# LocationIDs the TLC uses for trips without a zone: missing coordinates, and points outside every zone
+unknown_id = 264
+outside_id = 265
+
+# Cells per side of the lookup grid laid over the zones' bounding box (about 45 by 35 meters)
+grid_size = 1024
+
+# Grid value of the cells that straddle a zone border, looked up exactly
+border_cell = 0
+
+
+class ZoneIndex:
+    """
+    Taxi zone polygons in longitude/latitude, reprojected from the shapefile CRS once so
+    the points are looked up as they come, with an STRtree over them and a lookup grid.
+
+    Every grid cell lying inside a single zone holds its LocationID, and every cell outside
+    all zones holds outside_id, so most points are assigned by indexing the grid. Only the
+    points in cells crossed by a zone border are tested against the polygons.
+    """
+
+    def __init__(self, geometries, location_ids, grid=None):
+        """
+        Parameters:
+            geometries (ndarray): Zone polygons in longitude/latitude (EPSG:4326).
+            location_ids (ndarray): LocationID of every polygon; a zone may have several.
+            grid (ndarray): Lookup grid from an earlier index (built when None).
+        """
+        self.geometries = geometries
+        self.location_ids = np.asarray(location_ids, dtype=np.uint16)
+        self.tree = shapely.STRtree(geometries)
+        self.bounds = shapely.total_bounds(geometries)
+        shapely.prepare(geometries)
+        self.grid = self._build_grid() if grid is None else grid
+
+    def _build_grid(self):
+        """Classifies the grid cells with one bulk STRtree query of their boxes."""
+        west, south, east, north = self.bounds
+        xs = np.linspace(west, east, grid_size + 1)
+        ys = np.linspace(south, north, grid_size + 1)
+        x0, y0 = np.meshgrid(xs[:-1], ys[:-1])
+        x1, y1 = np.meshgrid(xs[1:], ys[1:])
+        boxes = shapely.box(x0.ravel(), y0.ravel(), x1.ravel(), y1.ravel())
+
+        cell_index, zone_index = self.tree.query(boxes, predicate='intersects')
+        zones_per_cell = np.bincount(cell_index, minlength=len(boxes))
+        grid = np.where(zones_per_cell == 0, outside_id, border_cell).astype(np.uint16)
+
+        # Cells touching a single zone, and lying entirely inside it
+        single = zones_per_cell[cell_index] == 1
+        cell_index, zone_index = cell_index[single], zone_index[single]
+        inside = shapely.contains_properly(self.geometries[zone_index], boxes[cell_index])
+        grid[cell_index[inside]] = self.location_ids[zone_index[inside]]
+        return grid.reshape(grid_size, grid_size)
+
+    def assign(self, longitude, latitude):
+        """
+        LocationID of the zone every point falls in. A point on the border of two zones
+        gets the one that comes first in the shapefile.
+
+        Parameters:
+            longitude (array-like): Longitudes, NaN when missing.
+            latitude (array-like): Latitudes, NaN when missing.
+
+        Returns:
+            ndarray: uint16 LocationIDs, unknown_id for missing coordinates and outside_id
+            for points outside every zone.
+        """
+        longitude = np.asarray(longitude, dtype=np.float64)
+        latitude = np.asarray(latitude, dtype=np.float64)
+        location_ids = np.full(len(longitude), outside_id, dtype=np.uint16)
+        location_ids[np.isnan(longitude) | np.isnan(latitude)] = unknown_id
+
+        # Bounding box prefilter, which also drops the missing and the zero coordinates
+        west, south, east, north = self.bounds
+        rows = np.flatnonzero((longitude >= west) & (longitude <= east) & (latitude >= south) & (latitude <= north))
+        x, y = longitude[rows], latitude[rows]
+
+        columns = np.minimum(((x - west) / (east - west) * grid_size).astype(np.int64), grid_size - 1)
+        lines = np.minimum(((y - south) / (north - south) * grid_size).astype(np.int64), grid_size - 1)
+        cell_ids = self.grid[lines, columns]
+        location_ids[rows] = cell_ids
+
+        # Points near a border: one bulk query of the tree gives the polygons whose box holds
+        # each point, which are then tested exactly, all pairs at once. A point on a border
+        # matches both zones: the first one in the shapefile is kept
+        border = np.flatnonzero(cell_ids == border_cell)
+        rows, x, y = rows[border], x[border], y[border]
+        point_index, zone_index = self.tree.query(shapely.points(x, y))
+        # Pairs of the same polygon side by side, which the exact test runs faster on
+        order = np.argsort(zone_index, kind='stable')
+        point_index, zone_index = point_index[order], zone_index[order]
+        inside = shapely.intersects_xy(self.geometries[zone_index], x[point_index], y[point_index])
+        point_index, zone_index = point_index[inside], zone_index[inside]
+        first = np.full(len(rows), len(self.geometries))
+        np.minimum.at(first, point_index, zone_index)
+        found = first < len(self.geometries)
+        location_ids[rows] = outside_id
+        location_ids[rows[found]] = self.location_ids[first[found]]
+        return location_ids
+
+
+@lru_cache(maxsize=4)
+def load_zone_index(shapefile_path=zones_path):
+    """
+    Spatial index of the taxi zones. The reprojected polygons and the lookup grid are cached
+    next to the shapefile and only rebuilt when the shapefile changes; the tree itself is
+    built from them in milliseconds. Loaded once per process.
+
+    Parameters:
+        shapefile_path (str): Path of taxi_zones.shp.
+
+    Returns:
+        ZoneIndex: The index.
+    """
+    index_path = os.path.splitext(shapefile_path)[0] + '.zone_index.npz'
+    source = file_fingerprint(shapefile_path)
+
+    if os.path.exists(index_path):
+        with np.load(index_path, allow_pickle=False) as cached:
+            if str(cached['source']) == source and cached['grid'].shape == (grid_size, grid_size):
+                wkb = cached['wkb'].tobytes()
+                offsets = cached['offsets']
+                geometries = shapely.from_wkb([wkb[start:end] for start, end in zip(offsets[:-1], offsets[1:])])
+                return ZoneIndex(geometries, cached['location_ids'], cached['grid'])
+
+    zones = gpd.read_file(shapefile_path, columns=['LocationID']).to_crs('EPSG:4326')
+    geometries = zones.geometry.to_numpy()
+    # The WKB of all polygons back to back, with the offset where each one starts
+    wkb = shapely.to_wkb(geometries)
+    offsets = np.concatenate([[0], np.cumsum([len(polygon) for polygon in wkb])])
+    index = ZoneIndex(geometries, zones['LocationID'].to_numpy())
+    np.savez(index_path, source=source, wkb=np.frombuffer(b''.join(wkb), dtype=np.uint8),
+             offsets=offsets, location_ids=index.location_ids, grid=index.grid)
+    return index
@@ -0,0 +1,229 @@
+# Description:  Simplified taxi zone geometry, cached as TopoJSON, and the choropleth layer drawn from it
+
+
+
+import json
+import os
+
+import folium
+import geopandas as gpd
+import numpy as np
+from branca.colormap import StepColormap
+from branca.utilities import color_brewer
+
+from query_cache import file_fingerprint
+
+# Simplification tolerance in the shapefile's unit (US feet), invisible at city zoom levels
+simplify_tolerance = 25
+# Size of the integer grid the TopoJSON coordinates are snapped to
+quantization = 100000
+
+# View every choropleth opens on
+map_center = [40.7685, -73.9822]
+map_zoom = 10
+
+zone_properties = ['LocationID', 'zone', 'borough']
+
+
+def _encode_ring(ring, translate, scale):
+    """Quantizes a ring's coordinates and delta-encodes them into a TopoJSON arc."""
+    points = np.round((np.asarray(ring)[:, :2] - translate) / scale).astype(np.int64)
+    deltas = np.vstack([points[:1], np.diff(points, axis=0)])
+    # Drop the points that collapse onto the previous one after quantization
+    keep = np.r_[True, (deltas[1:] != 0).any(axis=1)]
+    return deltas[keep].tolist()
+
+
+def to_topojson(features):
+    """
+    Encodes GeoJSON Polygon/MultiPolygon features as a quantized TopoJSON topology.
+
+    Parameters:
+        features (list): GeoJSON features in longitude/latitude.
+
+    Returns:
+        dict: TopoJSON topology with a single 'zones' object.
+    """
+    coordinates = np.vstack([
+        np.asarray(ring)[:, :2]
+        for feature in features
+        for polygon in _polygons(feature['geometry'])
+        for ring in polygon
+    ])
+    translate = coordinates.min(axis=0)
+    scale = (coordinates.max(axis=0) - translate) / (quantization - 1)
+
+    arcs = []
+    geometries = []
+    for feature in features:
+        polygons = []
+        for polygon in _polygons(feature['geometry']):
+            rings = []
+            for ring in polygon:
+                rings.append([len(arcs)])
+                arcs.append(_encode_ring(ring, translate, scale))
+            polygons.append(rings)
+        geometries.append({
+            'type': 'MultiPolygon',
+            'arcs': polygons,
+            'properties': feature['properties']
+        })
+
+    return {
+        'type': 'Topology',
+        'transform': {'scale': scale.tolist(), 'translate': translate.tolist()},
+        'objects': {'zones': {'type': 'GeometryCollection', 'geometries': geometries}},
+        'arcs': arcs
+    }
+
+
+def from_topojson(topology):
+    """
+    Decodes a topology written by `to_topojson` back into GeoJSON features.
+
+    Parameters:
+        topology (dict): TopoJSON topology.
+
+    Returns:
+        list: GeoJSON MultiPolygon features.
+    """
+    scale = np.asarray(topology['transform']['scale'])
+    translate = np.asarray(topology['transform']['translate'])
+    arcs = [np.round(np.cumsum(np.asarray(arc), axis=0) * scale + translate, 6).tolist()
+            for arc in topology['arcs']]
+
+    return [
+        {
+            'type': 'Feature',
+            'properties': geometry['properties'],
+            'geometry': {
+                'type': 'MultiPolygon',
+                'coordinates': [[arcs[ring[0]] for ring in polygon] for polygon in geometry['arcs']]
+            }
+        }
+        for geometry in topology['objects']['zones']['geometries']
+    ]
+
+
+def _polygons(geometry):
+    """Coordinates of a GeoJSON Polygon or MultiPolygon as a list of polygons."""
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    return geometry['coordinates']
+
+
+def load_zone_layer(shapefile_path):
+    """
+    Taxi zones simplified and reprojected to longitude/latitude. The result is cached as
+    TopoJSON next to the shapefile and only rebuilt when the shapefile changes.
+
+    Parameters:
+        shapefile_path (str): Path of taxi_zones.shp.
+
+    Returns:
+        list: GeoJSON features with the LocationID, zone and borough properties.
+    """
+    return from_topojson(load_zone_topology(shapefile_path))
+
+
+def load_zone_topology(shapefile_path):
+    """The cached TopoJSON topology behind `load_zone_layer`, built when missing or outdated."""
+    topojson_path = os.path.splitext(shapefile_path)[0] + '.topojson'
+    source = file_fingerprint(shapefile_path)
+
+    if os.path.exists(topojson_path):
+        with open(topojson_path) as file:
+            topology = json.load(file)
+        if topology.get('source') == source:
+            return topology
+
+    zones = gpd.read_file(shapefile_path)
+    zones['geometry'] = zones.geometry.simplify(simplify_tolerance, preserve_topology=True)
+    zones = zones.to_crs('EPSG:4326')
+    features = json.loads(zones[zone_properties + ['geometry']].to_json(drop_id=True))['features']
+
+    topology = to_topojson(features)
+    topology['source'] = source
+    with open(topojson_path, 'w') as file:
+        json.dump(topology, file, separators=(',', ':'))
+    return topology
+
+
+def step_colormap(values, palette, caption, bins=6):
+    """Same equal-width color bins as folium.Choropleth uses by default."""
+    edges = np.histogram_bin_edges(np.asarray(values, dtype=float), bins=bins)
+    return StepColormap(color_brewer(palette, n=bins), index=edges, vmin=edges[0], vmax=edges[-1], caption=caption)
+
+
+def choropleth_layer(zone_layer, data, value_column, fields, aliases, colormap):
+    """
+    One GeoJson layer with the fill color and the tooltip of every zone in `data`.
+
+    The geometry comes from the cached zone layer, so it is not read, simplified or
+    reprojected again, but it is still serialized into the page with the values: a
+    Streamlit rerun sends the whole map. Only the client-side mode (client_map.py,
+    TLC_CLIENT_SIDE=1) sends the geometry once and then recolors the zones in the browser.
+
+    Parameters:
+        zone_layer (list): Output of `load_zone_layer`.
+        data (DataFrame): Aggregated rows with a LocationID column.
+        value_column (str): Column the zones are colored by.
+        fields (list): Columns shown in the tooltip.
+        aliases (list): Tooltip labels of `fields`.
+        colormap (StepColormap): Maps values to colors.
+
+    Returns:
+        folium.GeoJson: The layer.
+    """
+    rows = data.set_index('LocationID')
+    rows = rows[~rows.index.duplicated()]
+    values = rows[[field for field in fields if field != 'LocationID']].to_dict('index')
+    colors = {location_id: colormap(value) for location_id, value in rows[value_column].items()}
+
+    features = []
+    for feature in zone_layer:
+        location_id = feature['properties']['LocationID']
+        if location_id in values:
+            # The geometry is shared with the cached layer, only the properties are new
+            properties = dict(values[location_id], LocationID=location_id, fill=colors[location_id])
+            features.append({'type': 'Feature', 'geometry': feature['geometry'], 'properties': properties})
+
+    return folium.GeoJson(
+        {'type': 'FeatureCollection', 'features': features},
+        style_function=lambda feature: {
+            'fillColor': feature['properties']['fill'],
+            'fillOpacity': 0.7,
+            'color': 'black',
+            'weight': 0.3
+        },
+        tooltip=folium.GeoJsonTooltip(fields=fields, aliases=aliases)
+    )
+
+
+def choropleth_map(zone_layer, data, palette, caption='Number of Trips'):
+    """
+    Folium map of the zones in `data` colored by their trip count, with its legend and
+    the Location ID, zone, trip count and borough tooltips of the dashboards.
+
+    Parameters:
+        zone_layer (list): Output of `load_zone_layer`.
+        data (DataFrame): Aggregated rows with LocationID, zone, trip_count and borough.
+        palette (str): ColorBrewer palette, e.g. 'YlOrRd'.
+        caption (str): Legend title.
+
+    Returns:
+        folium.Map: The map.
+    """
+    m = folium.Map(location=map_center, zoom_start=map_zoom, tiles="CartoDB positron")
+
+    colormap = step_colormap(data['trip_count'], palette, caption)
+    choropleth_layer(
+        zone_layer,
+        data,
+        'trip_count',
+        fields=['LocationID', 'zone', 'trip_count', 'borough'],
+        aliases=['Location ID', 'Zone:', 'Number of Trips:', 'Borough:'],
+        colormap=colormap
+    ).add_to(m)
+    colormap.add_to(m)
+    return m
@@ -0,0 +1,129 @@
+# Description:  Read-only store of the taxi zones and their pickup and dropoff trip counts, shared by the zone views
+
+
+
+import geopandas as gpd
+import numpy as np
+
+from cube import build_cube, query_cube
+from features import day_order, month_names, period_order
+from query_cache import QueryCache, file_fingerprint
+from storage import read_table, table_path
+from zone_layer import load_zone_layer
+
+# Table and columns of the trip counts of each direction
+directions = {
+    'pickup': {
+        'table': 'pickup_cleaned',
+        'zone_column': 'PULocationID',
+        'day_column': 'day_pickup',
+        'period_column': 'pickup_period'
+    },
+    'dropoff': {
+        'table': 'dropoff_cleaned',
+        'zone_column': 'DOLocationID',
+        'day_column': 'day_dropoff',
+        'period_column': 'dropoff_period'
+    }
+}
+
+
+def store_version(path, shapefile_path=None):
+    """Version of the files a store is built from, from their sizes and modification times."""
+    shapefile_path = shapefile_path or path + 'taxi_zones.shp'
+    return file_fingerprint(*[table_path(path, config['table']) for config in directions.values()], shapefile_path)
+
+
+class ZoneMetricStore:
+    """
+    The zone names, boroughs and geometry held once, with one trip count cube per
+    direction ('pickup' or 'dropoff'). The trip tables are only read to build the
+    cubes, so the store's size does not depend on the number of trips.
+
+    The store and its query results are shared by every session, so callers must not
+    modify them.
+    """
+
+    def __init__(self, path, shapefile_path=None, query_cache_size=256):
+        """
+        Parameters:
+            path (str): Folder holding pickup_cleaned and dropoff_cleaned.
+            shapefile_path (str): Path of taxi_zones.shp (in `path` when None).
+            query_cache_size (int): Number of query results kept for all sessions.
+        """
+        shapefile_path = shapefile_path or path + 'taxi_zones.shp'
+        self.version = store_version(path, shapefile_path)
+
+        # One row per LocationID with its zone, borough and geometry
+        gdf = gpd.read_file(shapefile_path)
+        self.zones = gdf.drop_duplicates('LocationID').set_index('LocationID')[['zone', 'borough', 'geometry']]
+        self.n_zones = self.zones.index.max() + 1
+        # Simplified geometry the maps are drawn from (cached on disk as TopoJSON)
+        self.zone_layer = load_zone_layer(shapefile_path)
+
+        self.cubes = {direction: self._load_cube(path, **config) for direction, config in directions.items()}
+        self._cache = QueryCache(query_cache_size)
+
+    def _load_cube(self, path, table, zone_column, day_column, period_column):
+        """Sums the trip counts of one direction into a cube over month, day and time period."""
+        counts = read_table(path, table, columns=[zone_column, 'month', day_column, period_column, 'trip_count'])
+
+        # Labels in calendar order, keeping only those present in the data
+        present = [set(counts[column].dropna()) for column in ['month', day_column, period_column]]
+        dims = [
+            ('month', [month for month in month_names if month in present[0]]),
+            (day_column, [day for day in day_order if day in present[1]]),
+            (period_column, [period for period in period_order if period in present[2]])
+        ]
+        return build_cube(counts, zone_column, dims, ['trip_count'], self.n_zones)
+
+    def labels(self, direction):
+        """Months, days and time periods with trips in `direction`, in calendar order."""
+        return self.cubes[direction]['labels']
+
+    def query(self, direction, month, day, time_period):
+        """
+        Trip count of every zone for one combination of filters ('All' for no filter).
+
+        Parameters:
+            direction (str): 'pickup' or 'dropoff'.
+            month (str): Month name or 'All'.
+            day (str): Day name or 'All'.
+            time_period (str): Time period or 'All'.
+
+        Returns:
+            GeoDataFrame: LocationID, zone, borough, trip_count and geometry of the zones
+            with trips, leaving out the LocationIDs missing from the shapefile.
+        """
+        return self._cache.get(
+            self.version,
+            (direction, month, day, time_period),
+            lambda: self.aggregate(direction, month, day, time_period)
+        )
+
+    def aggregate(self, direction, month, day, time_period):
+        """Computes the result of `query` without the cache."""
+        return self.join_zones(query_cube(self.cubes[direction], (month, day, time_period))['trip_count'])
+
+    def join_zones(self, trip_count):
+        """
+        Zones with trips of a trip count array, e.g. a query result or live counts.
+
+        Parameters:
+            trip_count (ndarray): Trip count of every LocationID.
+
+        Returns:
+            GeoDataFrame: As returned by `query`.
+        """
+        # Zones with trips, leaving out the LocationIDs missing from the shapefile
+        location_ids = np.flatnonzero(trip_count > 0)
+        location_ids = location_ids[np.isin(location_ids, self.zones.index)]
+
+        # Join zone names and geometries on the aggregated rows only
+        aggregated_data = self.zones.loc[location_ids].reset_index()
+        aggregated_data.insert(3, 'trip_count', trip_count[location_ids].astype(int))
+        return gpd.GeoDataFrame(aggregated_data, geometry='geometry', crs=self.zones.crs)
+
+    def cache_stats(self):
+        """Hits and misses of the shared query cache."""
+        return self._cache.stats()
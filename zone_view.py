@@ -0,0 +1,168 @@
+# Description:  Streamlit choropleth of the pickup or dropoff trip counts by taxi zone, queried from the shared zone store
+
+
+
+import os
+
+import numpy as np
+import streamlit as st
+from streamlit_folium import st_folium
+
+from client_map import client_map_html, cube_data
+from features import period_order
+from live_feed import LiveFeed
+from zone_layer import choropleth_map, load_zone_topology
+from zone_store import ZoneMetricStore, store_version
+
+# Number of query results kept in memory for all sessions
+query_cache_size = 256
+
+# Send the trip count cube and the zone geometry to the browser once and filter there,
+# instead of rerunning the app on every filter change (e.g. TLC_CLIENT_SIDE=1)
+client_side = os.environ.get('TLC_CLIENT_SIDE', '') not in ('', '0')
+
+# Show the trips of the last minutes from a live trip event source instead of the cleaned
+# tables: a JSON lines file being appended to, or tcp://host:port (see live_feed.py)
+live_source = os.environ.get('TLC_LIVE_FEED', '')
+# Seconds between two redraws of the live map
+live_refresh_seconds = 10
+
+# Fields behind the columns of the top 10 table
+table_fields = {'Location ID': 'LocationID', 'Zone': 'zone', 'Number of Trips': 'trip_count'}
+
+# What differs between the pickup and the dropoff view
+views = {
+    'pickup': {
+        'title': "Taxi Trip Pickup Locations Choropleth Map",
+        'table_columns': ['Location ID', 'Number of Trips']
+    },
+    'dropoff': {
+        'title': "Taxi Trip Dropoff Locations Choropleth Map",
+        'table_columns': ['Location ID', 'Zone', 'Number of Trips']
+    }
+}
+
+
+@st.cache_resource(max_entries=2)
+def get_zone_store(path, version):
+    """
+    The zone store of `path`, built once per process and shared by every session and
+    by both views. A new store is built when the files it was read from change.
+    """
+    return ZoneMetricStore(path, query_cache_size=query_cache_size)
+
+
+@st.cache_resource(max_entries=4)
+def get_client_view(path, version, direction):
+    """
+    Page of the client-side mode: the trip count cube of one direction with its 'All'
+    rollups and the simplified zone geometry, with the filters, map and table in JavaScript.
+    Built once per process and direction.
+    """
+    store = get_zone_store(path, version)
+    return client_map_html(
+        load_zone_topology(path + 'taxi_zones.shp'),
+        cube_data(store.cubes[direction], {'trip_count': np.uint32}),
+        controls=[('Month', ('dim', 0)), ('Day', ('dim', 1)), ('Time Period', ('dim', 2))],
+        value='trip_count',
+        caption='Number of Trips',
+        palette='YlOrRd',
+        tooltip=[('LocationID', 'Location ID'), ('zone', 'Zone:'), ('trip_count', 'Number of Trips:'), ('borough', 'Borough:')],
+        table={'title': 'Top 10 Stations', 'top_n': 10,
+               'columns': [(column, table_fields[column]) for column in views[direction]['table_columns']]},
+        known_zones_only=True
+    )
+
+
+@st.cache_resource
+def get_live_feed(source):
+    """The live feed of `source`, started once per process and shared by every session and by both views."""
+    return LiveFeed(source).start()
+
+
+def zone_map(store, aggregated_data):
+    """Folium map of the zones of `aggregated_data`, colored by their trip count."""
+    # Color the shared zone geometry by trip count, with tooltips, in a single layer
+    return choropleth_map(store.zone_layer, aggregated_data, 'YlOrRd')
+
+
+def show_live_view(direction, store, feed):
+    """
+    Draws the window filters and, redrawn every live_refresh_seconds, the choropleth map
+    and the top 10 table of the trips of one direction in the last minutes.
+    """
+    st.sidebar.title("Live Feed")
+    minutes = st.sidebar.selectbox('Window', feed.windows, format_func=lambda minutes: 'Last %d minutes' % minutes)
+    time_period = st.sidebar.selectbox('Time Period', ['All'] + period_order)
+    st.title(views[direction]['title'])
+
+    # Only the map and the table are rerun, the sidebar cannot be written from a fragment
+    @st.fragment(run_every=live_refresh_seconds)
+    def live_map():
+        snapshot = feed.snapshot(direction, minutes, time_period)
+        if snapshot['end'] is None:
+            st.info("Waiting for the first trips from %s." % feed.source)
+            return
+        st.caption("%d trips in the %d minutes up to %s (%d events, %d rejected, %d too late)" % (
+            snapshot['trip_count'].sum(), minutes, snapshot['end'], snapshot['events'], snapshot['rejected'], snapshot['late']))
+
+        aggregated_data = store.join_zones(snapshot['trip_count'])
+        if aggregated_data.empty:
+            st.warning("No trips in this window.")
+            return
+        st_folium(zone_map(store, aggregated_data), width=600, height=500, returned_objects=[], key='live_map')
+
+        st.subheader("Top 10 Stations")
+        top_10_stations = aggregated_data.sort_values(by='trip_count', ascending=False).head(10)
+        top_10_table = top_10_stations.rename(columns={field: column for column, field in table_fields.items()})
+        st.table(top_10_table[views[direction]['table_columns']])
+
+    live_map()
+
+
+def show_zone_view(direction, path):
+    """
+    Draws the sidebar filters, the top 10 table and the choropleth map of one direction.
+
+    Parameters:
+        direction (str): 'pickup' or 'dropoff'.
+        path (str): Folder holding the cleaned tables and taxi_zones.shp.
+    """
+    version = store_version(path)
+    store = get_zone_store(path, version)
+
+    # In the client-side mode the script only runs when the page is opened
+    if client_side:
+        st.title(views[direction]['title'])
+        st.iframe(get_client_view(path, version, direction), height=1000)
+        return
+
+    if live_source:
+        show_live_view(direction, store, get_live_feed(live_source))
+        return
+
+    months, days, time_periods = store.labels(direction)
+
+    # Sidebar Filters
+    st.sidebar.title("Filter Parameters")
+    month = st.sidebar.selectbox('Month', ['All'] + months)
+    day = st.sidebar.selectbox('Day', ['All'] + days)
+    time_period = st.sidebar.selectbox('Time Period', ['All'] + time_periods)
+
+    aggregated_data = store.query(direction, month, day, time_period)
+
+    if aggregated_data.empty:
+        st.warning("No data available for the selected filters.")
+        st.stop()
+
+    # Top 10 stations based on trip count
+    top_10_stations = aggregated_data.sort_values(by='trip_count', ascending=False).head(10)
+
+    # Display the Top 10 table in the sidebar
+    st.sidebar.title("Top 10 Stations")
+    top_10_table = top_10_stations.rename(columns={field: column for column, field in table_fields.items()})
+    st.sidebar.table(top_10_table[views[direction]['table_columns']])
+
+    # Streamlit Folium Integration
+    st.title(views[direction]['title'])
+    st_folium(zone_map(store, aggregated_data), width=600, height=500, returned_objects=[])